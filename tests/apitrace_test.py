@@ -0,0 +1,167 @@
+import unittest
+import os
+import shutil
+import sys
+import tempfile
+
+import fake_ida
+from get_cfg_test import IDA_DIR, load_get_cfg
+
+sys.path.append(IDA_DIR)
+import apitrace
+
+
+class ReplayModuleTest(unittest.TestCase):
+    """ Test that answers are replayed in the order they were recorded. """
+
+    def setUp(self):
+        self.db = fake_ida.FakeDatabase()
+        self.db.add_segment(0x1000, [1, 2, 3, 4], self.db.idc.SEG_DATA)
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _roundTrip(self, recorder):
+        path = os.path.join(self.tmp_dir, "trace")
+        recorder.save(path, argv=[], exports=None, syms=[])
+        trace = apitrace.Trace.load(path)
+        return dict((name, apitrace.ReplayModule(trace, name))
+                    for name in apitrace.MODULES)
+
+    def testReplay(self):
+        recorder = apitrace.TraceRecorder()
+        idc = recorder.wrap(self.db.idc)
+        idaapi = recorder.wrap(self.db.idaapi)
+        self.assertEqual(1, idc.Byte(0x1000))
+        self.db.bytes[0x1000] = 5
+        self.assertEqual(5, idc.Byte(0x1000))
+        self.assertEqual(0x1004, idaapi.getseg(0x1000).endEA)
+
+        modules = self._roundTrip(recorder)
+        idc, idaapi = modules["idc"], modules["idaapi"]
+        self.assertEqual(self.db.idc.BADADDR, idc.BADADDR)
+        self.assertEqual(2, modules["idc"].unread())
+        self.assertEqual(1, idc.Byte(0x1000))
+        self.assertEqual(5, idc.Byte(0x1000))
+        self.assertEqual(0x1004, idaapi.getseg(0x1000).endEA)
+        self.assertEqual(0, idc.unread())
+        self.assertEqual(0, idaapi.unread())
+
+    def testDrift(self):
+        recorder = apitrace.TraceRecorder()
+        idc = recorder.wrap(self.db.idc)
+        idc.Byte(0x1000)
+
+        idc = self._roundTrip(recorder)["idc"]
+        idc.Byte(0x1000)
+        self.assertRaises(apitrace.ReplayError, idc.Byte, 0x1000)
+        self.assertRaises(apitrace.ReplayError, idc.Byte, 0x1001)
+
+    def testReplayArgs(self):
+        trace = apitrace.Trace()
+        trace.meta = {
+            "argv": ["--arch", "amd64", "--output", "a.cfg", "--log_file=a.log",
+                     "-e", "exports.txt", "--pie-mode", "--syms=syms.txt",
+                     "--function-costs", "costs.csv"],
+            "exports": ["main\n"],
+            "syms": ["start 1000\n"],
+        }
+        argv = apitrace.replay_args(trace, "b.cfg", "b.log", self.tmp_dir)
+
+        exports = os.path.join(self.tmp_dir, "exports-to-lift")
+        syms = os.path.join(self.tmp_dir, "syms")
+        self.assertEqual(
+            ["--arch", "amd64", "--pie-mode", "--output", "b.cfg",
+             "--log_file", "b.log", "--exports-to-lift", exports,
+             "--syms", syms], argv)
+        with open(exports) as f:
+            self.assertEqual("main\n", f.read())
+        with open(syms) as f:
+            self.assertEqual("start 1000\n", f.read())
+
+
+@unittest.skipUnless(sys.version_info[0] == 2,
+                     "get_cfg.py is Python 2 only, like IDAPython")
+class RoundTripTest(unittest.TestCase):
+    """ Test that replaying a recorded run of `get_cfg.main` makes the same
+    calls into the IDA API, in the same order. """
+
+    def setUp(self):
+        self.db = fake_ida.FakeDatabase()
+        self.db.begin_ea = 0x1000
+        self.db.add_segment(
+            0x1000, [0x90] * 16, self.db.idc.SEG_CODE, ".text")
+        self.db.add_segment(
+            0x2000, [1, 2] + [None] * 14, self.db.idc.SEG_DATA, ".data")
+        self.db.entries.append((0x1000, "main"))
+        self.get_cfg = load_get_cfg(self.db)
+        self.tmp_dir = tempfile.mkdtemp()
+
+        # The real `recoverCfg` needs `CFG_pb2`. This one does a little of
+        # its work instead.
+        get_cfg = self.get_cfg
+        def recoverCfg(eps, outf, exports_are_apis=False, costs_path=None):
+            for seg_ea in get_cfg.idautils.Segments():
+                outf.write(get_cfg.getSegmentSnapshot(seg_ea).data)
+            for ea in (0x1000, 0x1004, 0x2000):
+                outf.write(str(get_cfg.classifyAddress(ea)))
+            outf.close()
+        self.recoverCfg = get_cfg.recoverCfg
+        get_cfg.recoverCfg = recoverCfg
+
+    def tearDown(self):
+        self.get_cfg.recoverCfg = self.recoverCfg
+        self.get_cfg.API_RECORDER = None
+        shutil.rmtree(self.tmp_dir)
+
+    def _path(self, name):
+        return os.path.join(self.tmp_dir, name)
+
+    def _read(self, name):
+        with open(self._path(name)) as f:
+            return f.read()
+
+    def _roundTrip(self, *extra_args):
+        get_cfg = self.get_cfg
+        argv = ["--arch", "amd64", "--os", "linux",
+                "--output", self._path("recorded.cfg"),
+                "--log_file", self._path("recorded.log"),
+                "--record-trace", self._path("trace")] + list(extra_args)
+        self.assertEqual(0, get_cfg.main(argv))
+        self.assertNotIn("Traceback", self._read("recorded.log"))
+
+        trace = apitrace.Trace.load(self._path("trace"))
+        modules = [apitrace.ReplayModule(trace, name)
+                   for name in apitrace.MODULES]
+        get_cfg.idc, get_cfg.idaapi, get_cfg.idautils = modules
+        get_cfg.resetSegmentSnapshots()
+        get_cfg.resetFileType()
+        get_cfg.resetAddressClasses()
+
+        argv = apitrace.replay_args(
+            trace, self._path("replayed.cfg"), self._path("replayed.log"),
+            self.tmp_dir)
+        self.assertEqual(0, get_cfg.main(argv))
+        self.assertNotIn("Traceback", self._read("replayed.log"))
+        self.assertEqual(self._read("recorded.cfg"), self._read("replayed.cfg"))
+        self.assertEqual(0, sum(module.unread() for module in modules))
+
+    def testAllExports(self):
+        self._roundTrip()
+        self.assertEqual(1, self.db.calls["Entries"])
+
+    def testExportsAndSymbols(self):
+        with open(self._path("exports.txt"), "w") as f:
+            f.write("main\n")
+        with open(self._path("syms.txt"), "w") as f:
+            f.write("start 1004\n")
+
+        self._roundTrip("-e", self._path("exports.txt"),
+                        "--syms", self._path("syms.txt"))
+        self.assertEqual("start", self.db.names[0x1004])
+        self.assertEqual(0, self.db.calls["Entries"])
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,178 @@
+import unittest
+import sys
+import tempfile
+import os
+import json
+import stat
+import subprocess
+import shutil
+import time
+
+DISASS_DIR = os.path.realpath(
+    os.path.join(os.path.dirname(__file__), "..", "tools", "mcsema_disass"))
+
+# A stand-in for IDA. It is run the way `ida/disass.py` runs IDA, and writes
+# a small CFG instead of running `get_cfg.py`. The CFG holds one function,
+# whose address depends on the `--shard` that the copy was given.
+FAKE_IDA = """#!{python}
+import os
+import sys
+
+sys.path.append({ida_dir!r})
+
+mode, script, binary = sys.argv[1:4]
+script_args = script[len("-S"):].split()
+def arg(name, default=None):
+    if name in script_args:
+        return script_args[script_args.index(name) + 1]
+    return default
+
+sys.stderr.write("fake ida {{}} {{}}\\n".format(mode, os.path.basename(binary)))
+
+shard = int(arg("--shard", "0/1").split("/")[0])
+try:
+    import CFG_pb2
+    M = CFG_pb2.Module()
+    M.module_name = os.path.basename(binary)
+    F = M.internal_funcs.add()
+    F.entry_address = 0x1000 + shard
+    data = M.SerializeToString()
+except ImportError:
+    data = b"cfg"
+
+with open(arg("--output"), "wb") as f:
+    f.write(data)
+"""
+
+
+def can_merge():
+    """Can the driver merge CFGs? This needs `protobuf`, and the `CFG_pb2.py`
+    that the build puts into `ida/`."""
+    try:
+        __import__("google.protobuf")
+    except ImportError:
+        return False
+    return os.path.isfile(os.path.join(DISASS_DIR, "ida", "CFG_pb2.py"))
+
+
+class DisassTest(unittest.TestCase):
+    """ Test the mcsema-disass driver against a stand-in for IDA. """
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+
+        # The driver only knows how to run disassemblers named like IDA.
+        self.disassembler = os.path.join(self.test_dir, "idal64")
+        with open(self.disassembler, "w") as f:
+            f.write(FAKE_IDA.format(
+                python=sys.executable,
+                ida_dir=os.path.join(DISASS_DIR, "ida")))
+        os.chmod(self.disassembler, stat.S_IRWXU)
+
+        self.binary = os.path.join(self.test_dir, "test.elf")
+        with open(self.binary, "wb") as f:
+            f.write(b"\x7fELF")
+
+        self.output = os.path.join(self.test_dir, "test.cfg")
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def _disass(self, *extra_args, **kwargs):
+        cmd = [sys.executable, os.path.join(DISASS_DIR, "__main__.py"),
+               "--disassembler", self.disassembler,
+               "--arch", "amd64",
+               "--os", "linux",
+               "--binary", self.binary,
+               "--output", self.output,
+               "--entrypoint", "main"]
+        if not kwargs.get("cache", False):
+            cmd.append("--no-cache")
+        cmd.extend(extra_args)
+        po = subprocess.Popen(cmd, cwd=self.test_dir, stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE)
+        _, err = po.communicate()
+        return po.returncode, err.decode("utf-8", "replace")
+
+    def testCache(self):
+        # Relative to where `mcsema-disass` is run.
+        ret, err = self._disass("--cache-dir", "cache", cache=True)
+        self.assertEqual(0, ret, err)
+        self.assertIn("fake ida", err)
+        self.assertTrue(os.path.isdir(os.path.join(self.test_dir, "cache")))
+
+        ret, err = self._disass("--cache-dir", "cache", cache=True)
+        self.assertEqual(0, ret, err)
+        self.assertNotIn("fake ida", err)
+
+        # Updating the disassembler invalidates the cached CFG.
+        st = os.stat(self.disassembler)
+        os.utime(self.disassembler, (st.st_atime, st.st_mtime + 10))
+        ret, err = self._disass("--cache-dir", "cache", cache=True)
+        self.assertEqual(0, ret, err)
+        self.assertIn("fake ida", err)
+
+    @unittest.skipUnless(can_merge(), "needs protobuf and CFG_pb2.py")
+    def testShardedMerge(self):
+        ret, err = self._disass("--jobs", "2")
+        self.assertEqual(0, ret, err)
+
+        sys.path.append(DISASS_DIR)
+        import merge
+        M = merge.load_cfg(self.output)
+        self.assertEqual("test.elf", M.module_name)
+        self.assertEqual([0x1000, 0x1001],
+                         [F.entry_address for F in M.internal_funcs])
+
+    @unittest.skipUnless(can_merge(), "needs protobuf and CFG_pb2.py")
+    def testBatchCountsFunctions(self):
+        manifest = os.path.join(self.test_dir, "manifest.json")
+        results = os.path.join(self.test_dir, "results.jsonl")
+        with open(manifest, "w") as f:
+            json.dump([{"binary": "test.elf", "output": "test.cfg"}], f)
+
+        ret = subprocess.call(
+            [sys.executable, os.path.join(DISASS_DIR, "batch.py"), manifest,
+             "--disassembler", self.disassembler,
+             "--results", results,
+             "--arch", "amd64",
+             "--os", "linux",
+             "--no-cache"],
+            cwd=self.test_dir, stderr=open(os.devnull, "w"))
+        self.assertEqual(0, ret)
+
+        with open(results) as f:
+            result = json.loads(f.readline())
+        self.assertEqual("ok", result["status"])
+        self.assertEqual(1, result["function_count"])
+
+    def testServer(self):
+        server = subprocess.Popen(
+            [sys.executable, os.path.join(DISASS_DIR, "server.py"),
+             "--socket", "server.sock"],
+            cwd=self.test_dir, stderr=open(os.devnull, "w"))
+        try:
+            sock_path = os.path.join(self.test_dir, "server.sock")
+            for _ in range(100):
+                if os.path.exists(sock_path):
+                    break
+                time.sleep(0.1)
+
+            ret, err = self._disass("--server", "server.sock")
+        finally:
+            server.terminate()
+            server.wait()
+
+        self.assertEqual(0, ret, err)
+        self.assertTrue(os.path.isfile(self.output))
+        self.assertIn("fake ida -B test.elf", err)
+
+    def testServerNotRunning(self):
+        ret, err = self._disass("--server", "missing.sock")
+        self.assertEqual(1, ret)
+        self.assertIn("Could not connect to mcsema-disass-server", err)
+        self.assertNotIn("Traceback", err)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,181 @@
+"""Stand-ins for IDA's `idc`, `idaapi` and `idautils` modules, so that the
+scripts in `tools/mcsema_disass/ida` can be tested without IDA."""
+
+import collections
+import itertools
+import sys
+import types
+
+_VALUES = itertools.count(0x1000)
+
+
+class Constant(int):
+    """An IDA constant that the test didn't give a value. Each one gets its
+    own value, and can have constants of its own (e.g. enums in `CFG_pb2`)."""
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        value = Constant(next(_VALUES))
+        setattr(self, name, value)
+        return value
+
+
+class FakeModule(types.ModuleType):
+    """An IDA API module. Attributes that weren't set are `Constant`s."""
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        value = Constant(next(_VALUES))
+        setattr(self, name, value)
+        return value
+
+
+MODULES = ("idc", "idaapi", "idautils")
+
+FF_CODE = 1
+FF_DATA = 2
+FF_VALUE = 4
+
+
+class Segment(object):
+    def __init__(self, start, end, type, name, perm):
+        self.startEA = start
+        self.endEA = end
+        self.type = type
+        self.name = name
+        self.perm = perm
+
+
+class Processor(object):
+    def __init__(self, flag):
+        self.flag = flag
+
+
+class FakeDatabase(object):
+    """A tiny database of segments, and the flags, bytes and names of their
+    addresses. `modules` answer from it, and count the calls made to each of
+    their functions in `calls`."""
+
+    def __init__(self):
+        self.modules = dict((name, FakeModule(name)) for name in MODULES)
+        self.idc = self.modules["idc"]
+        self.idaapi = self.modules["idaapi"]
+        self.idautils = self.modules["idautils"]
+        self.segments = []
+        self.flags = {}
+        self.bytes = {}
+        self.names = {}
+        self.entries = []
+        self.calls = collections.Counter()
+
+        self.idc.BADADDR = 0xffffffffffffffff
+        self.idc.__EA64__ = True
+        self.idc.FT_ELF = 18
+        self.idc.INF_FILETYPE = 0
+        self.idc.INF_START_AF = 1
+        self.idc.AF_IMMOFF = 2
+        self.idc.SEGATTR_TYPE = 3
+        self.idc.SEG_CODE = 2
+        self.idc.SEG_DATA = 3
+        self.idc.SEG_XTRN = 1
+        self.idc.SEG_BSS = 9
+        self.filetype = self.idc.FT_ELF
+        self.begin_ea = 0
+        self.short_prms = {}
+
+        idc = self.idc
+        self._api(idc, "GetFlags", lambda ea: self.flags.get(ea, 0))
+        self._api(idc, "isCode", lambda flags: bool(flags & FF_CODE))
+        self._api(idc, "isData", lambda flags: bool(flags & FF_DATA))
+        self._api(idc, "hasValue", lambda flags: bool(flags & FF_VALUE))
+        self._api(idc, "Byte", lambda ea: self.bytes.get(ea, 0))
+        self._api(idc, "GetLongPrm", lambda prm: self.filetype)
+        self._api(idc, "BeginEA", lambda: self.begin_ea)
+        self._api(idc, "GetTrueNameEx", lambda frm, ea: self.names.get(ea, ""))
+        self._api(idc, "GetCommentEx", lambda ea, rpt: None)
+        self._api(idc, "MakeCode", self._make_code)
+        self._api(idc, "MakeName", self._make_name)
+        self._api(idc, "SegEnd", lambda ea: self._segment(ea).endEA)
+        self._api(idc, "SegName", lambda ea: self._segment(ea).name)
+        self._api(idc, "GetSegmentAttr",
+                  lambda ea, attr: self._segment(ea).type)
+        self._api(idc, "NextHead", self._next_head)
+        self._api(idc, "Name", lambda ea: self.names.get(ea, ""))
+        self._api(idc, "GetInputFile", lambda: "fake")
+        self._api(idc, "GetShortPrm", lambda prm: self.short_prms.get(prm, 0))
+        self._api(idc, "SetShortPrm", self.short_prms.__setitem__)
+
+        idaapi = self.idaapi
+        self._api(idaapi, "getseg", self._segment)
+        self._api(idaapi, "autoWait", lambda: True)
+        self._api(idaapi, "get_many_bytes", self._get_many_bytes)
+        self._api(idaapi, "add_func", lambda ea, end: True)
+        self._api(idaapi, "nextthat", self._next_that)
+        self._api(idaapi, "get_import_module_qty", lambda: 0)
+        idaapi.FF_IVL = FF_VALUE
+        idaapi.PR_USE64 = 1
+        idaapi.ph = Processor(idaapi.PR_USE64)
+
+        self._api(self.idautils, "Segments",
+                  lambda: iter([seg.startEA for seg in self.segments]))
+        self._api(self.idautils, "Entries", self._entries)
+
+    def _api(self, module, name, func):
+        def api(*args):
+            self.calls[name] += 1
+            return func(*args)
+        api.__name__ = name
+        setattr(module, name, api)
+
+    def install(self):
+        """Replace the IDA API modules with this database's."""
+        sys.modules.update(self.modules)
+
+    def add_segment(self, start, data, type, name="seg", perm=5):
+        """Add a segment at `start` holding the bytes in `data`. A `None`
+        byte has no value."""
+        self.segments.append(
+            Segment(start, start + len(data), type, name, perm))
+        for i, b in enumerate(data):
+            if b is not None:
+                self.bytes[start + i] = b
+                self.flags[start + i] = FF_VALUE
+
+    def _segment(self, ea):
+        for seg in self.segments:
+            if seg.startEA <= ea < seg.endEA:
+                return seg
+        return None
+
+    def _get_many_bytes(self, ea, size):
+        if any(not self.flags.get(i, 0) & FF_VALUE
+               for i in range(ea, ea + size)):
+            return None
+        return "".join(chr(self.bytes[i]) for i in range(ea, ea + size))
+
+    def _next_that(self, ea, maxea, test):
+        for i in range(ea + 1, maxea):
+            if test(self.flags.get(i, 0)):
+                return i
+        return self.idc.BADADDR
+
+    def _next_head(self, ea, maxea):
+        # Every byte with flags is an item of its own.
+        for i in range(ea + 1, maxea):
+            if self.flags.get(i, 0):
+                return i
+        return self.idc.BADADDR
+
+    def _entries(self):
+        for i, (ea, name) in enumerate(self.entries):
+            yield i, i, ea, name
+
+    def _make_code(self, ea):
+        self.flags[ea] = (self.flags.get(ea, 0) & ~FF_DATA) | FF_CODE
+        return 1
+
+    def _make_name(self, ea, name):
+        self.names[ea] = name
+        return True
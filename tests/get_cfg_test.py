@@ -0,0 +1,198 @@
+import unittest
+import sys
+import os
+
+import fake_ida
+
+IDA_DIR = os.path.realpath(
+    os.path.join(os.path.dirname(__file__), "..", "tools", "mcsema_disass", "ida"))
+
+
+def load_get_cfg(db):
+    """Import `get_cfg.py`, and point it at the fake database `db`."""
+    db.install()
+    if "get_cfg" not in sys.modules:
+        # Only the messages that `get_cfg.py` builds are used here.
+        sys.modules["CFG_pb2"] = fake_ida.FakeModule("CFG_pb2")
+        sys.path.append(IDA_DIR)
+
+    import get_cfg
+    get_cfg.idc = db.idc
+    get_cfg.idaapi = db.idaapi
+    get_cfg.idautils = db.idautils
+    get_cfg.resetSegmentSnapshots()
+    get_cfg.resetFileType()
+    get_cfg.resetAddressClasses()
+    return get_cfg
+
+
+@unittest.skipUnless(sys.version_info[0] == 2,
+                     "get_cfg.py is Python 2 only, like IDAPython")
+class AddressClassTest(unittest.TestCase):
+    """ Test the memoized classification of addresses. """
+
+    def setUp(self):
+        self.db = fake_ida.FakeDatabase()
+        self.db.begin_ea = 0x1000  # Linked.
+        self.db.add_segment(
+            0x1000, [0xc3, 0x00, 0x00, 0x00], self.db.idc.SEG_CODE, ".text")
+        self.db.flags[0x1000] |= fake_ida.FF_CODE
+        self.get_cfg = load_get_cfg(self.db)
+
+    def testVerdictIsCached(self):
+        get_cfg = self.get_cfg
+        self.assertEqual(get_cfg.ADDR_INTERNAL_CODE,
+                         get_cfg.classifyAddress(0x1000))
+        calls = dict(self.db.calls)
+
+        self.assertTrue(get_cfg.isInternalCode(0x1000))
+        self.assertFalse(get_cfg.isExternalReference(0x1000))
+        self.assertEqual(calls, dict(self.db.calls))
+
+        self.assertEqual(get_cfg.ADDR_INVALID, get_cfg.classifyAddress(0x2000))
+
+    def testMarkAsCodeDropsVerdict(self):
+        get_cfg = self.get_cfg
+        self.assertFalse(get_cfg.isInternalCode(0x1001))
+        get_cfg.mark_as_code(0x1001)
+        self.assertTrue(get_cfg.isInternalCode(0x1001))
+
+    def testSetNameDropsVerdict(self):
+        get_cfg = self.get_cfg
+        self.assertFalse(get_cfg.isExternalReference(0x1002))
+        get_cfg.set_name(0x1002, "stdout@@GLIBC_2.2.5")
+        self.assertTrue(get_cfg.isExternalReference(0x1002))
+
+    def testAnalysisDropsAllVerdicts(self):
+        get_cfg = self.get_cfg
+        self.assertEqual(get_cfg.ADDR_DATA, get_cfg.classifyAddress(0x1003))
+
+        # IDA's auto-analysis can change addresses that we never touched.
+        self.db.flags[0x1003] |= fake_ida.FF_CODE
+        self.assertEqual(get_cfg.ADDR_DATA, get_cfg.classifyAddress(0x1003))
+        get_cfg.waitForAnalysis()
+        self.assertEqual(get_cfg.ADDR_INTERNAL_CODE,
+                         get_cfg.classifyAddress(0x1003))
+
+
+@unittest.skipUnless(sys.version_info[0] == 2,
+                     "get_cfg.py is Python 2 only, like IDAPython")
+class SegmentSnapshotTest(unittest.TestCase):
+    """ Test reading segments whose bytes don't all have values. """
+
+    def setUp(self):
+        self.db = fake_ida.FakeDatabase()
+        self.get_cfg = load_get_cfg(self.db)
+
+    def testUninitializedTail(self):
+        # E.g. a PE `.data` whose virtual size is bigger than its raw size.
+        data = [1, 2, 3, 4] + [None] * 4096
+        self.db.add_segment(0x1000, data, self.db.idc.SEG_DATA, ".data")
+
+        snap = self.get_cfg.getSegmentSnapshot(0x1000)
+        self.assertEqual("\x01\x02\x03\x04" + "\x00" * 4096, snap.data)
+        self.assertLessEqual(self.db.calls["get_many_bytes"], 2)
+        self.assertLessEqual(self.db.calls["GetFlags"], 2)
+
+    def testMixed(self):
+        data = [1, None, 2, 3, None, None]
+        self.db.add_segment(0x1000, data, self.db.idc.SEG_DATA, ".data")
+
+        snap = self.get_cfg.getSegmentSnapshot(0x1000)
+        self.assertEqual("\x01\x00\x02\x03\x00\x00", snap.data)
+
+    def testBss(self):
+        self.db.add_segment(
+            0x1000, [None] * 4096, self.db.idc.SEG_BSS, ".bss")
+
+        snap = self.get_cfg.getSegmentSnapshot(0x1000)
+        self.assertEqual("\x00" * 4096, snap.data)
+        self.assertEqual(0, self.db.calls["get_many_bytes"])
+
+
+@unittest.skipUnless(sys.version_info[0] == 2,
+                     "get_cfg.py is Python 2 only, like IDAPython")
+class PreprocessTest(unittest.TestCase):
+    """ Test that later preprocessing passes only visit new code. """
+
+    def setUp(self):
+        self.db = fake_ida.FakeDatabase()
+        self.db.add_segment(0x1000, [0x90] * 32, self.db.idc.SEG_CODE, ".text")
+        self.get_cfg = load_get_cfg(self.db)
+
+        self.visited = []
+        self.refs = {}
+        def preprocessHead(head, seen_code):
+            seen_code.add(head)
+            self.visited.append(head)
+            return self.refs.get(head, [])
+        self.preprocessHead = self.get_cfg.preprocessHead
+        self.get_cfg.preprocessHead = preprocessHead
+
+    def tearDown(self):
+        self.get_cfg.preprocessHead = self.preprocessHead
+
+    def testNewCode(self):
+        code = fake_ida.FF_VALUE | fake_ida.FF_CODE
+        seen_code = set()
+        for ea in (0x1000, 0x1001, 0x1002):
+            self.db.flags[ea] = code
+            seen_code.add(ea)
+
+        # Code made at 0x1008 runs into already seen code at 0x1000 through
+        # a jump from 0x1009, and to new code at 0x1010.
+        for ea in (0x1008, 0x1009, 0x1010, 0x1011):
+            self.db.flags[ea] = code
+        self.refs[0x1009] = [0x1000, 0x1010]
+
+        self.get_cfg.preprocessNewCode([0x1008], seen_code)
+        self.assertEqual([0x1008, 0x1009, 0x1010, 0x1011], self.visited)
+
+
+@unittest.skipUnless(sys.version_info[0] == 2,
+                     "get_cfg.py is Python 2 only, like IDAPython")
+class FunctionCostTest(unittest.TestCase):
+    """ Test that the calls into the IDA API are counted per function. """
+
+    class NewEAs(set):
+        parents = {}
+        current = None
+
+    class Function(object):
+        blocks = []
+
+    def setUp(self):
+        self.db = fake_ida.FakeDatabase()
+        self.db.add_segment(0x1000, [0x90] * 16, self.db.idc.SEG_CODE)
+        self.get_cfg = load_get_cfg(self.db)
+        self.get_cfg.resetFunctionCosts()
+
+        get_cfg = self.get_cfg
+        def recoverFunctionFromSet(M, F, blockset, new_eas):
+            for ea in blockset:
+                get_cfg.idc.GetFlags(ea)
+        self.saved = (get_cfg.getFunctionBlocks, get_cfg.recoverFunctionFromSet)
+        get_cfg.getFunctionBlocks = lambda ea: [ea, ea + 1, ea + 2]
+        get_cfg.recoverFunctionFromSet = recoverFunctionFromSet
+
+    def tearDown(self):
+        get_cfg = self.get_cfg
+        get_cfg.getFunctionBlocks, get_cfg.recoverFunctionFromSet = self.saved
+        get_cfg.API_CALL_COUNTER = None
+
+    def _recover(self, ea):
+        self.get_cfg.recoverFunction(None, self.Function(), ea, self.NewEAs())
+        return self.get_cfg.FUNCTION_COSTS[-1]
+
+    def testNotCounted(self):
+        self.assertIsNone(self._recover(0x1000).api_calls)
+
+    def testCounted(self):
+        self.get_cfg.enableApiCallCounter()
+        self.assertEqual(3, self._recover(0x1000).api_calls)
+        self.assertEqual(3, self._recover(0x1004).api_calls)
+        self.assertEqual(6, self.db.calls["GetFlags"])
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
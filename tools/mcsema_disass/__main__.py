@@ -2,6 +2,7 @@
 # Copyright 2017 Peter Goodman (peter@trailofbits.com), all rights reserved.
 
 import argparse
+import json
 import os
 import shutil
 import sys
@@ -13,6 +14,8 @@ import textwrap
 SUPPORTED_OS = ('linux', 'windows',)
 SUPPORTED_ARCH = ('x86', 'amd64',)
 
+DISASS_DIR = os.path.dirname(os.path.abspath(__file__))
+
 def main(args=None):
   arg_parser = argparse.ArgumentParser(
     formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -20,7 +23,13 @@ def main(args=None):
     Additional arguments are passed to the disassembler script directly. These include:
     
       --std-defs <file>       Load additional external function definitions from <file>
-      --pie-mode              Change disassembler heuristics to work on position independent code"""))
+      --pie-mode              Change disassembler heuristics to work on position independent code
+
+    Recovered CFGs are cached, keyed by the contents of the binary, the definitions
+    files, and the arguments. Repeated runs on the same inputs reuse the cached CFG.
+
+    With --jobs N, the entry points are split across N disassembler processes. Their
+    CFGs are merged, with functions, data, and externals deduplicated and sorted."""))
 
   arg_parser.add_argument(
       '--disassembler',
@@ -57,6 +66,62 @@ def main(args=None):
       help="The entrypoint where disassembly should begin",
       required=True)
 
+  arg_parser.add_argument(
+      '--jobs',
+      type=int,
+      default=1,
+      help="Split the entry points across this many concurrent disassembler processes, and merge their CFGs.")
+
+  arg_parser.add_argument(
+      '--profile',
+      help="Write a JSON profile of the time, memory, and counts of each phase of disassembly to this file.")
+
+  arg_parser.add_argument(
+      '--function-costs',
+      help="Write the time and work spent recovering each function to this CSV file.")
+
+  arg_parser.add_argument(
+      '--api-profile',
+      help="Count and time calls into the disassembler's API, writing a summary to this file, and collapsed stacks to the file with .folded appended.")
+
+  arg_parser.add_argument(
+      '--record-trace',
+      help="Record the disassembler's API calls to this file, so that the run can be replayed without the disassembler.")
+
+  arg_parser.add_argument(
+      '--server',
+      default=os.environ.get("MCSEMA_DISASS_SERVER", None),
+      help="Submit the job to the mcsema-disass-server listening on this UNIX socket. The server saves loading the driver and compiling the standard definitions, and limits how many jobs run at once. IDA, get_cfg.py and CFG_pb2 are still loaded once per job.")
+
+  arg_parser.add_argument(
+      '--cache-dir',
+      default=os.environ.get("MCSEMA_DISASS_CACHE_DIR", None),
+      help="Directory in which to cache recovered CFGs. Defaults to ~/.cache/mcsema-disass")
+
+  arg_parser.add_argument(
+      '--cache-size',
+      type=int,
+      default=1024,
+      help="Maximum size of the CFG cache, in megabytes.")
+
+  arg_parser.add_argument(
+      '--db-cache-size',
+      type=int,
+      default=4096,
+      help="Maximum size of the cache of analyzed disassembler databases, in megabytes.")
+
+  arg_parser.add_argument(
+      '--no-cache',
+      action='store_true',
+      default=False,
+      help="Always disassemble from scratch, neither using nor updating the CFG and database caches.")
+
+  arg_parser.add_argument(
+      '--cache-stats',
+      action='store_true',
+      default=False,
+      help="Print the CFG and database cache hit/miss statistics when done.")
+
   args, command_args = arg_parser.parse_known_args()
 
   if not os.path.isfile(args.binary):
@@ -73,9 +138,30 @@ def main(args=None):
     arg_parser.error("{} passed to --os is not supported. Valid options are: {}".format(
       args.os, SUPPORTED_OS))
 
+  if args.jobs < 1:
+    arg_parser.error("--jobs must be at least 1.")
+    return 1
+
+  if 'ida' not in args.disassembler:
+    arg_parser.error("{} passed to --disassembler is not known.".format(
+        args.disassembler))
+    return 1
+
   args.binary = os.path.abspath(args.binary)
   args.output = os.path.abspath(args.output)
   args.log_file = os.path.abspath(args.log_file)
+  if args.profile:
+    args.profile = os.path.abspath(args.profile)
+  if args.function_costs:
+    args.function_costs = os.path.abspath(args.function_costs)
+  if args.api_profile:
+    args.api_profile = os.path.abspath(args.api_profile)
+  if args.record_trace:
+    args.record_trace = os.path.abspath(args.record_trace)
+  if args.server:
+    args.server = os.path.abspath(args.server)
+  if args.cache_dir:
+    args.cache_dir = os.path.abspath(args.cache_dir)
 
   fixed_command_args = []
   # ensure that any paths in arguments to the disassembler
@@ -86,9 +172,54 @@ def main(args=None):
     else:
       fixed_command_args.append(fix_arg)
 
-  disass_dir = os.path.dirname(os.path.abspath(__file__))
-  os.chdir(disass_dir)
-  sys.path.append(disass_dir)
+  os.chdir(DISASS_DIR)
+  sys.path.append(DISASS_DIR)
+
+  if args.server:
+    import server
+    return server.submit(args.server, args, fixed_command_args)
+
+  return disassemble(args, fixed_command_args)
+
+
+def disassemble(args, fixed_command_args):
+  """Recover the CFG of `args.binary` into `args.output`. `args` must already
+  be validated, and its paths made absolute. Returns the exit code."""
+
+  # Export stubs are generated from the full list of entry points, and so
+  # can't be split across processes.
+  if args.jobs > 1 and "--make-export-stubs" in fixed_command_args:
+    sys.stderr.write("Ignoring --jobs because --make-export-stubs is used.\n")
+    args.jobs = 1
+
+  # A trace can only be replayed as a single run.
+  if args.jobs > 1 and args.record_trace:
+    sys.stderr.write("Ignoring --jobs because --record-trace is used.\n")
+    args.jobs = 1
+
+  import cache
+  cache_dir = args.cache_dir or cache.DEFAULT_CACHE_DIR
+  caches = []
+
+  # Export stubs are written next to the output, and so can't be cached.
+  cfg_cache = None
+  if not args.no_cache and "--make-export-stubs" not in fixed_command_args:
+    cfg_cache = cache.ResultCache(cache_dir, args.cache_size * 1024 * 1024)
+    caches.append(("CFG", cfg_cache))
+    cache_key = cache.cache_key(args, fixed_command_args, [
+        os.path.join(DISASS_DIR, "ida", "get_cfg.py"),
+        os.path.join(DISASS_DIR, "ida", "defsdb.py"),
+        os.path.join(DISASS_DIR, "defs", "{}.txt".format(args.os))])
+
+    # Function costs and API calls can only be measured by really recovering
+    # the CFG.
+    measuring = args.function_costs or args.api_profile or args.record_trace
+    if not measuring and cfg_cache.lookup(cache_key, args.output):
+      if args.profile:
+        write_cached_profile(args.profile)
+      if args.cache_stats:
+        print_cache_stats(caches)
+      return 0
 
   workspace_dir = tempfile.mkdtemp()
   temp_bin_path = os.path.join(workspace_dir, os.path.basename(args.binary))
@@ -99,7 +230,43 @@ def main(args=None):
   try:
     if 'ida' in args.disassembler:
       import ida.disass
-      ret = ida.disass.execute(args, fixed_command_args)
+      disass_args = list(fixed_command_args)
+      if args.profile:
+        disass_args.extend(["--profile", args.profile])
+      if args.function_costs:
+        disass_args.extend(["--function-costs", args.function_costs])
+      if args.api_profile:
+        disass_args.extend(["--api-profile", args.api_profile])
+      if args.record_trace:
+        disass_args.extend(["--record-trace", args.record_trace])
+
+      # Reuse the database from an earlier run on the same binary, so that
+      # IDA doesn't have to auto-analyze it again. If there isn't one, then
+      # have the script save the database once auto-analysis is done.
+      db_cache = None
+      db_save_path = None
+      if not args.no_cache:
+        db_ext = ida.disass.database_extension(args)
+        db_cache = cache.ResultCache(
+            os.path.join(cache_dir, "databases"),
+            args.db_cache_size * 1024 * 1024,
+            suffix=db_ext)
+        caches.append(("Database", db_cache))
+        db_key = cache.database_key(args, ida.disass.ANALYSIS_OPTIONS)
+        db_path = os.path.splitext(args.binary)[0] + db_ext
+        if db_cache.lookup(db_key, db_path):
+          args.binary = db_path
+        else:
+          db_save_path = os.path.join(workspace_dir, "analyzed" + db_ext)
+          disass_args.extend(["--save-database", db_save_path])
+
+      if args.jobs > 1:
+        ret = ida.disass.execute_sharded(args, disass_args, args.jobs, workspace_dir)
+      else:
+        ret = ida.disass.execute(args, disass_args)
+
+      if db_save_path is not None and os.path.isfile(db_save_path):
+        db_cache.store(db_key, db_save_path)
 
       # in case IDA somehow says success, but no output was generated
       if not os.path.exists(args.output) or not os.path.isfile(args.output) :
@@ -115,18 +282,39 @@ def main(args=None):
 
       else:
           # assume it all went well
-          pass
+          if cfg_cache is not None:
+            cfg_cache.store(cache_key, args.output)
 
 
     else:
-      arg_parser.error("{} passed to --disassembler is not known.".format(
+      sys.stderr.write("{} passed to --disassembler is not known.\n".format(
           args.disassembler))
 
   finally:
     shutil.rmtree(workspace_dir)
 
+  if args.cache_stats:
+    print_cache_stats(caches)
+
   return ret
 
 
+def write_cached_profile(path):
+  """Write the profile of a run that was answered from the CFG cache."""
+  with open(path, "w") as f:
+    json.dump({"cached": True, "phases": [], "counts": {}}, f, indent=2)
+
+
+def print_cache_stats(caches):
+  for name, result_cache in caches:
+    stats = result_cache.stats()
+    lookups = stats["hits"] + stats["misses"]
+    sys.stderr.write(
+        "{} cache: {} hits, {} misses ({:.1f}% hit rate), {} stores, {} evictions\n".format(
+            name, stats["hits"], stats["misses"],
+            (100.0 * stats["hits"] / lookups) if lookups else 0.0,
+            stats["stores"], stats["evictions"]))
+
+
 if "__main__" == __name__:
   exit(main())
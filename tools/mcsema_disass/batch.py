@@ -0,0 +1,365 @@
+#!/usr/bin/env python
+# Copyright 2017 Peter Goodman (peter@trailofbits.com), all rights reserved.
+
+import argparse
+import csv
+import importlib
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+  import resource
+except ImportError:
+  resource = None  # Not available on Windows.
+
+
+# How often to check on the running jobs, in seconds.
+POLL_INTERVAL = 0.1
+
+# How much of a failed job's error output to keep in its result.
+ERROR_TAIL_SIZE = 2000
+
+
+class Job(object):
+  """One binary to disassemble, as described by a manifest entry."""
+
+  def __init__(self, id, binary, output, arch, os_name, entrypoint,
+               std_defs=(), log_file=None, extra_args=()):
+    self.id = id
+    self.binary = binary
+    self.output = output
+    self.arch = arch
+    self.os = os_name
+    self.entrypoint = entrypoint
+    self.std_defs = list(std_defs)
+    self.log_file = log_file
+    self.extra_args = list(extra_args)
+
+    # Set while the job is running.
+    self.process = None
+    self.start_time = None
+    self.stderr = None
+
+
+def _split_list(value):
+  """Manifest lists are JSON lists, or `;`-separated strings in CSV files."""
+  if not value:
+    return []
+  if isinstance(value, list):
+    return value
+  return [v for v in value.split(";") if v]
+
+
+def read_manifest(path, defaults):
+  """Read the jobs listed in the JSON or CSV manifest at `path`. A JSON
+  manifest is a list of objects; a CSV manifest has a header row. Each entry
+  needs a `binary`, and may override `output`, `arch`, `os`, `entrypoint`,
+  `std_defs`, `log_file`, `extra_args`, and `id`. Missing settings are taken
+  from `defaults`. Relative paths are relative to the manifest."""
+  base_dir = os.path.dirname(os.path.abspath(path))
+  with open(path, "r") as f:
+    if path.endswith(".json"):
+      entries = json.load(f)
+    else:
+      entries = list(csv.DictReader(f))
+
+  def fix_path(p):
+    if not p:
+      return p
+    return os.path.normpath(os.path.join(base_dir, os.path.expanduser(p)))
+
+  jobs = []
+  ids = set()
+  for entry in entries:
+    if not entry.get("binary"):
+      raise ValueError("Manifest entry {} has no binary".format(entry))
+
+    binary = fix_path(entry["binary"])
+    output = fix_path(entry.get("output"))
+    if not output:
+      output = os.path.join(
+          defaults.output_dir, os.path.basename(binary) + ".cfg")
+
+    job_id = entry.get("id") or output
+    if job_id in ids:
+      raise ValueError("Manifest has more than one job with id {}".format(job_id))
+    ids.add(job_id)
+
+    jobs.append(Job(
+        job_id, binary, output,
+        entry.get("arch") or defaults.arch,
+        entry.get("os") or defaults.os,
+        entry.get("entrypoint") or defaults.entrypoint,
+        [fix_path(p) for p in _split_list(entry.get("std_defs"))],
+        fix_path(entry.get("log_file")),
+        _split_list(entry.get("extra_args"))))
+
+  return jobs
+
+
+def read_finished(results_path):
+  """Returns the ids of the jobs that succeeded in an earlier run, according
+  to the results file at `results_path`."""
+  finished = set()
+  if not os.path.isfile(results_path):
+    return finished
+
+  with open(results_path, "r") as f:
+    for line in f:
+      try:
+        result = json.loads(line)
+      except ValueError:
+        continue  # E.g. a partial line written by a crashed batch.
+      if "ok" == result.get("status"):
+        finished.add(result["id"])
+  return finished
+
+
+def count_functions(cfg_path):
+  """Returns the number of functions in the CFG at `cfg_path`, or `None` if
+  the CFG can't be read."""
+  import merge
+  try:
+    return len(merge.load_cfg(cfg_path).internal_funcs)
+  except (EnvironmentError, merge.DecodeError):
+    return None
+
+
+def _limit_memory(max_memory):
+  """Returns a function that limits the memory of a child process, and of
+  the disassembler processes that it starts."""
+  def limit():
+    os.setsid()  # So that a timed-out job can be killed as a group.
+    if max_memory and resource is not None:
+      resource.setrlimit(resource.RLIMIT_AS, (max_memory, max_memory))
+  return limit
+
+
+class BatchRunner(object):
+  """Runs disassembly jobs through a bounded pool of `mcsema-disass`
+  subprocesses, and appends one JSON line per finished job to a results
+  file."""
+
+  def __init__(self, args, results_file):
+    self.args = args
+    self.results_file = results_file
+    self.main_path = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "__main__.py")
+
+  def command(self, job):
+    cmd = [sys.executable, self.main_path,
+           "--disassembler", self.args.disassembler,
+           "--arch", job.arch,
+           "--os", job.os,
+           "--binary", job.binary,
+           "--output", job.output,
+           "--entrypoint", job.entrypoint]
+    if job.log_file:
+      cmd.extend(["--log_file", job.log_file])
+    for defs in job.std_defs:
+      cmd.extend(["--std-defs", defs])
+    cmd.extend(job.extra_args)
+    cmd.extend(self.args.extra_args)
+    return cmd
+
+  def start(self, job):
+    output_dir = os.path.dirname(job.output)
+    if output_dir and not os.path.isdir(output_dir):
+      os.makedirs(output_dir)
+
+    job.stderr = tempfile.TemporaryFile()
+    job.start_time = time.time()
+    kwargs = {}
+    if os.name == "posix":
+      kwargs["preexec_fn"] = _limit_memory(self.args.max_memory * 1024 * 1024)
+    job.process = subprocess.Popen(
+        self.command(job),
+        stdin=None,
+        stdout=job.stderr,
+        stderr=job.stderr,
+        **kwargs)
+
+  def kill(self, job):
+    try:
+      if os.name == "posix":
+        os.killpg(job.process.pid, signal.SIGKILL)
+      else:
+        job.process.kill()
+    except OSError:
+      pass
+    job.process.wait()
+
+  def finish(self, job, status):
+    result = {
+      "id": job.id,
+      "binary": job.binary,
+      "output": job.output,
+      "status": status,
+      "returncode": job.process.returncode,
+      "duration": round(time.time() - job.start_time, 3),
+      "cfg_size": None,
+      "function_count": None,
+    }
+
+    if "ok" == status:
+      result["cfg_size"] = os.path.getsize(job.output)
+      result["function_count"] = count_functions(job.output)
+    else:
+      job.stderr.seek(0, os.SEEK_END)
+      job.stderr.seek(max(0, job.stderr.tell() - ERROR_TAIL_SIZE))
+      result["error"] = job.stderr.read().decode("utf-8", "replace")
+    job.stderr.close()
+
+    self.results_file.write(json.dumps(result, sort_keys=True) + "\n")
+    self.results_file.flush()
+    return result
+
+  def run(self, jobs):
+    """Run all of `jobs`. Returns the number of jobs that didn't succeed."""
+    pending = list(reversed(jobs))
+    running = []
+    failures = 0
+
+    while pending or running:
+      while pending and len(running) < self.args.workers:
+        job = pending.pop()
+        self.start(job)
+        running.append(job)
+
+      time.sleep(POLL_INTERVAL)
+
+      still_running = []
+      for job in running:
+        ret = job.process.poll()
+        if ret is None:
+          if self.args.timeout and \
+             (time.time() - job.start_time) > self.args.timeout:
+            self.kill(job)
+            status = "timeout"
+          else:
+            still_running.append(job)
+            continue
+        elif 0 == ret and os.path.isfile(job.output):
+          status = "ok"
+        else:
+          status = "failed"
+
+        result = self.finish(job, status)
+        if "ok" != status:
+          failures += 1
+        sys.stderr.write("[{}] {} ({:.1f}s)\n".format(
+            result["status"], job.id, result["duration"]))
+
+      running = still_running
+
+    return failures
+
+
+def main():
+  arg_parser = argparse.ArgumentParser(
+      description="Disassemble every binary listed in a manifest with mcsema-disass.")
+
+  arg_parser.add_argument(
+      'manifest',
+      help="JSON or CSV file listing the binaries to disassemble.")
+
+  arg_parser.add_argument(
+      '--disassembler',
+      help='Path to disassembler binary',
+      required=True)
+
+  arg_parser.add_argument(
+      '--results',
+      help="JSONL file to which the result of each job is appended.",
+      required=True)
+
+  arg_parser.add_argument(
+      '--output-dir',
+      default=os.getcwd(),
+      help="Where to put CFGs of manifest entries that don't name an output.")
+
+  arg_parser.add_argument(
+      '--arch',
+      help="Default architecture for manifest entries.")
+
+  arg_parser.add_argument(
+      '--os',
+      help="Default OS for manifest entries.")
+
+  arg_parser.add_argument(
+      '--entrypoint',
+      default="main",
+      help="Default entrypoint for manifest entries.")
+
+  arg_parser.add_argument(
+      '--workers',
+      type=int,
+      default=1,
+      help="Maximum number of binaries to disassemble at once.")
+
+  arg_parser.add_argument(
+      '--timeout',
+      type=int,
+      default=0,
+      help="Kill jobs that run for longer than this many seconds.")
+
+  arg_parser.add_argument(
+      '--max-memory',
+      type=int,
+      default=0,
+      help="Limit the address space of each job to this many megabytes.")
+
+  arg_parser.add_argument(
+      '--no-resume',
+      action='store_true',
+      default=False,
+      help="Also re-run jobs that succeeded according to the results file.")
+
+  args, extra_args = arg_parser.parse_known_args()
+  args.extra_args = extra_args
+  args.disassembler = os.path.abspath(args.disassembler)
+  args.output_dir = os.path.abspath(args.output_dir)
+
+  if args.workers < 1:
+    arg_parser.error("--workers must be at least 1.")
+
+  try:
+    jobs = read_manifest(args.manifest, args)
+  except (IOError, ValueError) as e:
+    arg_parser.error("Could not read manifest {}: {}".format(args.manifest, e))
+
+  for job in jobs:
+    if not job.arch or not job.os:
+      arg_parser.error("Job {} needs an arch and an OS.".format(job.id))
+
+  if not args.no_resume:
+    finished = read_finished(args.results)
+    skipped = len(jobs)
+    jobs = [job for job in jobs if job.id not in finished]
+    skipped -= len(jobs)
+    if skipped:
+      sys.stderr.write("Skipping {} already finished jobs.\n".format(skipped))
+
+  disass_dir = os.path.dirname(os.path.abspath(__file__))
+  sys.path.append(disass_dir)
+
+  # Needed to count the functions in the produced CFGs. Fail now, rather
+  # than after the first job.
+  try:
+    importlib.import_module("merge")
+  except ImportError as e:
+    arg_parser.error("Could not load the CFG format: {}".format(e))
+
+  with open(args.results, "a") as results_file:
+    failures = BatchRunner(args, results_file).run(jobs)
+
+  return 1 if failures else 0
+
+
+if "__main__" == __name__:
+  exit(main())
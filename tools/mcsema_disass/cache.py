@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# Copyright 2017 Peter Goodman (peter@trailofbits.com), all rights reserved.
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.path.expanduser('~'), ".cache", "mcsema-disass")
+
+
+def hash_file(path):
+  """Returns the SHA-256 hex digest of the contents of the file at `path`."""
+  hasher = hashlib.sha256()
+  with open(path, "rb") as f:
+    while True:
+      chunk = f.read(1 << 20)
+      if not chunk:
+        break
+      hasher.update(chunk)
+  return hasher.hexdigest()
+
+
+def disassembler_version(path):
+  """Returns something that changes when the disassembler at `path` is
+  updated, or `None` if it can't be found."""
+  try:
+    st = os.stat(path)
+  except OSError:
+    return None
+  return [st.st_size, int(st.st_mtime)]
+
+
+def cache_key(args, command_args, extra_files=()):
+  """Compute the cache key of a disassembly. This covers the contents of the
+  binary, every option that can change the produced CFG, and the contents of
+  every file named on the command line (e.g. `--std-defs` files). The
+  contents of `extra_files` (e.g. the disassembler script itself, and the
+  built-in definitions), and the version of the disassembler, are included
+  so that updating them invalidates the cache."""
+  parts = {
+    "binary": hash_file(args.binary),
+    "arch": args.arch,
+    "os": args.os,
+    "entrypoint": args.entrypoint,
+    "disassembler": os.path.abspath(args.disassembler),
+    "disassembler_version": disassembler_version(args.disassembler),
+    "command_args": [],
+    "extra_files": [],
+  }
+
+  for arg in command_args:
+    if os.path.isfile(arg):
+      parts["command_args"].append("file:" + hash_file(arg))
+    else:
+      parts["command_args"].append(arg)
+
+  for path in extra_files:
+    if os.path.isfile(path):
+      parts["extra_files"].append(hash_file(path))
+
+  blob = json.dumps(parts, sort_keys=True).encode("utf-8")
+  return hashlib.sha256(blob).hexdigest()
+
+
+def database_key(args, analysis_options):
+  """Compute the cache key of the disassembler's database for a binary. This
+  covers the contents of the binary, which disassembler made the database,
+  and the disassembler options (`analysis_options`) that change what its
+  initial auto-analysis does."""
+  parts = {
+    "binary": hash_file(args.binary),
+    "disassembler": os.path.abspath(args.disassembler),
+    "analysis_options": analysis_options,
+  }
+
+  # Invalidate databases made by an older version of the disassembler.
+  parts["disassembler_version"] = disassembler_version(args.disassembler)
+
+  blob = json.dumps(parts, sort_keys=True).encode("utf-8")
+  return hashlib.sha256(blob).hexdigest()
+
+
+def _replace(src, dst):
+  """Atomically move `src` over `dst`."""
+  try:
+    os.rename(src, dst)
+  except OSError:
+    # Windows won't rename over an existing file.
+    os.unlink(dst)
+    os.rename(src, dst)
+
+
+class ResultCache(object):
+  """A content-addressed cache of produced files, keyed by `cache_key`. The
+  total size of the cache is bounded, and the least recently used entries
+  are evicted to stay under the bound. Hit and miss counts are kept in the
+  cache directory, so that they accumulate across runs."""
+
+  def __init__(self, cache_dir, max_size, suffix=".cfg"):
+    self.cache_dir = cache_dir
+    self.max_size = max_size
+    self.suffix = suffix
+    self.entries_dir = os.path.join(cache_dir, "entries")
+    self.stats_path = os.path.join(cache_dir, "stats.json")
+    if not os.path.isdir(self.entries_dir):
+      os.makedirs(self.entries_dir)
+
+  def _entry_path(self, key):
+    return os.path.join(self.entries_dir, key + self.suffix)
+
+  def lookup(self, key, output_path):
+    """Copy the cached file for `key` to `output_path`. Returns `True` if
+    there was a cached file."""
+    entry_path = self._entry_path(key)
+    try:
+      shutil.copyfile(entry_path, output_path)
+    except (IOError, OSError):
+      self._count("misses")
+      return False
+
+    # Mark this as recently used.
+    os.utime(entry_path, None)
+    self._count("hits")
+    return True
+
+  def store(self, key, path):
+    """Add the file at `path` to the cache under `key`, then evict old
+    entries if the cache is too big."""
+    fd, temp_path = tempfile.mkstemp(dir=self.entries_dir)
+    os.close(fd)
+    shutil.copyfile(path, temp_path)
+
+    # Atomic, so concurrent runs never see a partially written entry.
+    _replace(temp_path, self._entry_path(key))
+    self._count("stores")
+    self.evict()
+
+  def evict(self):
+    """Remove the least recently used entries until the cache fits within
+    its size bound."""
+    entries = []
+    total_size = 0
+    for name in os.listdir(self.entries_dir):
+      if not name.endswith(self.suffix):
+        continue
+      path = os.path.join(self.entries_dir, name)
+      try:
+        st = os.stat(path)
+      except OSError:
+        continue
+      entries.append((st.st_mtime, st.st_size, path))
+      total_size += st.st_size
+
+    entries.sort()
+    evicted = 0
+    for _, size, path in entries:
+      if total_size <= self.max_size:
+        break
+      try:
+        os.unlink(path)
+      except OSError:
+        continue
+      total_size -= size
+      evicted += 1
+
+    if evicted:
+      self._count("evictions", evicted)
+
+  def stats(self):
+    """Returns the accumulated cache statistics."""
+    stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+    try:
+      with open(self.stats_path, "r") as f:
+        stats.update(json.load(f))
+    except (IOError, OSError, ValueError):
+      pass
+    return stats
+
+  def _count(self, name, amount=1):
+    stats = self.stats()
+    stats[name] += amount
+    fd, temp_path = tempfile.mkstemp(dir=self.cache_dir)
+    with os.fdopen(fd, "w") as f:
+      json.dump(stats, f)
+    _replace(temp_path, self.stats_path)
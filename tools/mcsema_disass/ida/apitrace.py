@@ -0,0 +1,408 @@
+#!/usr/bin/env python
+# Copyright 2017 Peter Goodman (peter@trailofbits.com), all rights reserved.
+
+##
+## Record and replay the calls that `get_cfg.py` makes into the IDA API.
+##
+## Recording happens inside IDA, with `get_cfg.py --record-trace <file>`. The
+## trace holds the API's constants, the answer to every call (keyed by the
+## API and its arguments), and the script's arguments. Replaying runs
+## `get_cfg.main` with the same arguments against the trace instead of IDA,
+## so that it can be benchmarked on machines without IDA:
+##
+##   python apitrace.py --trace ls.trace --output ls.cfg [--compare good.cfg]
+##
+## A replayed run can only ask questions that the recorded run asked, as many
+## times as it asked them. Any other call raises a `ReplayError`. The replay
+## logs at the level that the recorded run did.
+##
+
+import argparse
+import collections
+import gzip
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+import time
+import types
+
+try:
+    _PRIMITIVES = (int, long, float, bool, str, unicode, type(None))
+except NameError:
+    _PRIMITIVES = (int, float, bool, str, bytes, type(None))
+
+TRACE_VERSION = 3
+
+# Options of `get_cfg.py` that aren't replayed, and whether they take a value.
+# The output and log options are replaced by those given to `apitrace.py`.
+_UNREPLAYED_OPTIONS = {
+    "--output": True,
+    "--log_file": True,
+    "--log-jsonl": True,
+    "--record-trace": True,
+    "--api-profile": True,
+    "--function-costs": True,
+    "--profile": True,
+    "-e": True,
+    "--exports-to-lift": True,
+    "-z": True,
+    "--syms": True,
+}
+
+# How deeply to copy the objects returned by the API, e.g. an `insn_t`, its
+# `Operands`, and their attributes.
+SNAPSHOT_DEPTH = 3
+
+# The IDA API modules that are recorded and replayed.
+MODULES = ("idc", "idaapi", "idautils")
+
+
+class ReplayError(Exception):
+    pass
+
+
+class ReplayObject(object):
+    """A copy of an object returned by the IDA API (e.g. an `insn_t` or a
+    `segment_t`). Attributes are copied as-is, and the results of the
+    object's argument-less `get_*` methods are kept so that they can be
+    called again."""
+
+    def __init__(self, type_name, attrs=None, methods=None):
+        self.__dict__.update(attrs or {})
+        self._type = type_name
+        self._methods = methods or {}
+
+    def __getattr__(self, name):
+        methods = self.__dict__.get("_methods", {})
+        if name.startswith("__") or name not in methods:
+            raise AttributeError(name)
+        value = methods[name]
+        return lambda: value
+
+    def __repr__(self):
+        return "<{}>".format(self._type)
+
+
+def snapshot(value, depth=0):
+    """Copy `value` into something that can be pickled, and that behaves like
+    `value` as far as `get_cfg.py` is concerned."""
+    if isinstance(value, _PRIMITIVES):
+        return value
+    if isinstance(value, (list, tuple)):
+        return type(value)([snapshot(v, depth) for v in value])
+    if isinstance(value, ReplayObject) or depth >= SNAPSHOT_DEPTH:
+        return value if isinstance(value, ReplayObject) else None
+
+    attrs = {}
+    methods = {}
+    for name in dir(value):
+        if name.startswith("_") or name in ("this", "thisown"):
+            continue
+        try:
+            attr = getattr(value, name)
+        except Exception:
+            continue
+        if not callable(attr):
+            attrs[name] = snapshot(attr, depth + 1)
+        elif name.startswith("get_"):
+            try:
+                methods[name] = snapshot(attr(), depth + 1)
+            except Exception:
+                pass
+    return ReplayObject(type(value).__name__, attrs, methods)
+
+
+def _key(value):
+    """Returns a hashable stand-in for an argument of an API call."""
+    if isinstance(value, _PRIMITIVES):
+        return value
+    if isinstance(value, (list, tuple)):
+        return tuple(_key(v) for v in value)
+    return "<{}>".format(getattr(value, "_type", type(value).__name__))
+
+
+class Trace(object):
+    """The recorded answers to API calls. `calls` maps `(api, args)` to the
+    list of answers, in the order they were given. Each answer is a
+    `(result, outs, is_generator)` tuple, where `outs` holds the state of
+    any objects passed in as arguments once the call returned (e.g. the
+    `opinfo_t` filled in by `get_opinfo`). Reading a module attribute that
+    is an object (e.g. `idaapi.cmd`) is recorded as a call with `args` of
+    `None`."""
+
+    def __init__(self):
+        self.constants = dict((module, {}) for module in MODULES)
+        self.classes = dict((module, set()) for module in MODULES)
+        self.calls = collections.defaultdict(list)
+        self.meta = {}
+
+    def save(self, path):
+        with gzip.open(path, "wb") as f:
+            pickle.dump({
+                "version": TRACE_VERSION,
+                "constants": self.constants,
+                "classes": self.classes,
+                "calls": dict(self.calls),
+                "meta": self.meta,
+            }, f, pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def load(path):
+        with gzip.open(path, "rb") as f:
+            data = pickle.load(f)
+        if data.get("version") != TRACE_VERSION:
+            raise ReplayError("Unsupported trace version {}".format(
+                data.get("version")))
+        trace = Trace()
+        trace.constants = data["constants"]
+        trace.classes = data["classes"]
+        trace.calls.update(data["calls"])
+        trace.meta = data["meta"]
+        return trace
+
+
+class _RecordingModule(object):
+    """Stands in for one of the IDA API modules, passing everything through
+    to the real module while recording the answers in a `Trace`."""
+
+    def __init__(self, trace, module):
+        self._trace = trace
+        self._module = module
+        self._name = module.__name__
+
+        # Constants like `idc.__EA64__` are recorded too, but the module's
+        # other dunder attributes (e.g. `__loader__`) are left alone.
+        for name in dir(module):
+            value = getattr(module, name)
+            if isinstance(value, _PRIMITIVES):
+                trace.constants[self._name][name] = value
+            elif name.startswith("__"):
+                continue
+            elif isinstance(value, type) or type(value).__name__ == "classobj":
+                trace.classes[self._name].add(name)
+
+    def __getattr__(self, name):
+        attr = getattr(self._module, name)
+        api = "{}.{}".format(self._name, name)
+        if isinstance(attr, (types.FunctionType, types.BuiltinFunctionType)):
+            attr = self._wrap(api, attr)
+            setattr(self, name, attr)
+        elif not isinstance(attr, _PRIMITIVES) and \
+             name not in self._trace.classes[self._name]:
+            self._trace.calls[(api, None)].append(
+                (snapshot(attr), None, False))
+        return attr
+
+    def _wrap(self, api, func):
+        calls = self._trace.calls
+        def wrapper(*args):
+            result = func(*args)
+            outs = None
+            if any(not isinstance(arg, _PRIMITIVES) for arg in args):
+                outs = tuple(None if isinstance(arg, _PRIMITIVES) else snapshot(arg)
+                             for arg in args)
+
+            answers = calls[(api, _key(args))]
+            if _isIterator(result):
+                items = []
+                answers.append((items, outs, True))
+                return _recordGenerator(result, items)
+
+            answers.append((snapshot(result), outs, False))
+            return result
+        wrapper.__name__ = func.__name__
+        return wrapper
+
+
+def _isIterator(value):
+    """Is `value` a generator, or some other one-shot iterator (e.g. the
+    `iter` of a list)?"""
+    if isinstance(value, types.GeneratorType):
+        return True
+    return not isinstance(value, _PRIMITIVES) and \
+           hasattr(value, "__iter__") and iter(value) is value
+
+
+def _recordGenerator(gen, items):
+    """Record the items of `gen` as they are consumed, so that a generator
+    that isn't run to completion is replayed the same way."""
+    for item in gen:
+        items.append(snapshot(item))
+        yield item
+
+
+class TraceRecorder(object):
+    """Records the calls into the IDA API made through the modules returned
+    by `wrap`."""
+
+    def __init__(self):
+        self.trace = Trace()
+
+    def wrap(self, module):
+        return _RecordingModule(self.trace, module)
+
+    def save(self, path, **meta):
+        self.trace.meta.update(meta)
+        self.trace.save(path)
+
+
+class ReplayModule(object):
+    """Stands in for one of the IDA API modules by answering calls from a
+    `Trace`. Calls with the same arguments are answered in the order that
+    they were recorded; once the answers run out, the replayed run has
+    drifted from the recorded one, and a `ReplayError` is raised."""
+
+    def __init__(self, trace, name):
+        self.__name__ = name
+        self._trace = trace
+        self._next = collections.defaultdict(int)
+        self.__dict__.update(trace.constants[name])
+
+    def _answer(self, api, args):
+        key = (api, _key(args) if args is not None else None)
+        answers = self._trace.calls.get(key)
+        if not answers:
+            raise ReplayError("No recorded answer for {}{}".format(
+                api, "" if args is None else repr(args)))
+        index = self._next[key]
+        if index >= len(answers):
+            raise ReplayError("Only {} answer(s) were recorded for {}{}".format(
+                len(answers), api, "" if args is None else repr(args)))
+        self._next[key] = index + 1
+        return answers[index]
+
+    def unread(self):
+        """Returns how many of the recorded answers for this module's calls
+        were never asked for."""
+        prefix = self.__name__ + "."
+        return sum(len(answers) - self._next[key]
+                   for key, answers in self._trace.calls.items()
+                   if key[0].startswith(prefix))
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+
+        if name in self._trace.classes[self.__name__]:
+            return lambda *args: ReplayObject(name)
+
+        api = "{}.{}".format(self.__name__, name)
+        if (api, None) in self._trace.calls:
+            return self._answer(api, None)[0]
+
+        def replay(*args):
+            result, outs, is_generator = self._answer(api, args)
+            for arg, out in zip(args, outs or ()):
+                if isinstance(arg, ReplayObject) and out is not None:
+                    arg.__dict__.update(out.__dict__)
+            if is_generator:
+                return iter(result)
+            return result
+        replay.__name__ = name
+        return replay
+
+
+def install_replay(trace):
+    """Replace the IDA API modules with ones that answer from `trace`. This
+    must happen before `get_cfg` is imported."""
+    modules = [ReplayModule(trace, name) for name in MODULES]
+    for module in modules:
+        sys.modules[module.__name__] = module
+    return modules
+
+
+def replay_args(trace, output, log_file, temp_dir):
+    """Returns the arguments for `get_cfg.main` that replay the recorded run,
+    writing the CFG to `output` and the log to `log_file`. The recorded
+    exports and symbols are written to files in `temp_dir`."""
+    argv = []
+    recorded = iter(trace.meta["argv"])
+    for arg in recorded:
+        opt = arg.split("=", 1)[0]
+        if opt not in _UNREPLAYED_OPTIONS:
+            argv.append(arg)
+        elif _UNREPLAYED_OPTIONS[opt] and "=" not in arg:
+            next(recorded, None)
+
+    argv.extend(["--output", output, "--log_file", log_file])
+    for opt, lines in (("--exports-to-lift", trace.meta["exports"]),
+                       ("--syms", trace.meta["syms"])):
+        if lines is not None:
+            path = os.path.join(temp_dir, opt.lstrip("-"))
+            with open(path, "w") as f:
+                f.writelines(lines)
+            argv.extend([opt, path])
+    return argv
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(
+        description="Run get_cfg.py against a recorded trace of IDA API calls.")
+
+    arg_parser.add_argument(
+        '--trace',
+        required=True,
+        help="Trace recorded with `get_cfg.py --record-trace`.")
+
+    arg_parser.add_argument(
+        '--output',
+        required=True,
+        help="Where to write the recovered CFG.")
+
+    arg_parser.add_argument(
+        '--log_file',
+        default=os.devnull,
+        help="Where to write the log.")
+
+    arg_parser.add_argument(
+        '--compare',
+        help="Check that the recovered CFG is equivalent to this one.")
+
+    args = arg_parser.parse_args()
+
+    trace = Trace.load(args.trace)
+    modules = install_replay(trace)
+
+    ida_dir = os.path.dirname(os.path.abspath(__file__))
+    sys.path.append(ida_dir)
+    sys.path.append(os.path.dirname(ida_dir))
+    import get_cfg
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        argv = replay_args(trace, args.output, args.log_file, temp_dir)
+        start = time.time()
+        ret = get_cfg.main(argv)
+        elapsed = time.time() - start
+    finally:
+        shutil.rmtree(temp_dir)
+
+    if ret or not os.path.getsize(args.output):
+        sys.stderr.write("Replay of {} failed; see the log.\n".format(args.trace))
+        return 1
+
+    sys.stderr.write("Replayed {} in {:.3f}s\n".format(args.trace, elapsed))
+
+    unread = sum(module.unread() for module in modules)
+    if unread:
+        sys.stderr.write(
+            "{} recorded answer(s) were never asked for; the replay drifted "
+            "from the recorded run\n".format(unread))
+        return 1
+
+    if args.compare:
+        import merge
+        if not merge.cfg_files_equivalent(args.output, args.compare):
+            sys.stderr.write("CFG differs from {}\n".format(args.compare))
+            return 1
+        sys.stderr.write("CFG is equivalent to {}\n".format(args.compare))
+
+    return 0
+
+
+if "__main__" == __name__:
+    # Traces refer to `apitrace.ReplayObject`, not `__main__.ReplayObject`.
+    import apitrace
+    exit(apitrace.main())
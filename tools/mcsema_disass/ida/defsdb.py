@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+# Copyright 2017 Peter Goodman (peter@trailofbits.com), all rights reserved.
+
+##
+## Compiled standard-definitions databases.
+##
+## A definitions file (e.g. `defs/linux.txt`) is compiled into a database that
+## is opened with `mmap`, and searched on demand, so that `get_cfg.py` doesn't
+## have to parse the whole text file on every run. A database is laid out as:
+##
+##   header | function records | data records | string table
+##
+## Records are fixed-width and sorted by name, so a name is found by binary
+## search. Names and signatures live in the string table. The header holds
+## the SHA-256 digest of the text that the database was compiled from.
+##
+## Databases are compiled as part of the build (see `setup.py`), or with:
+##
+##   python defsdb.py defs/linux.txt defs/windows.txt
+##
+## which writes `linux.txt.db` next to `linux.txt`. When `open_defs` finds no
+## up-to-date database next to the text file, it compiles one into a cache
+## directory, keyed by the digest of the text.
+##
+
+import argparse
+import hashlib
+import mmap
+import os
+import struct
+import sys
+import tempfile
+
+MAGIC = b"MCSDEFS\0"
+VERSION = 1
+
+CACHE_DIR = os.path.join(
+    os.path.expanduser("~"), ".cache", "mcsema-disass", "defs")
+
+# Magic, version, digest of the source text, number of function records,
+# number of data records, and the offset of the string table.
+_HEADER = struct.Struct("<8sI32sIII")
+
+# Name offset, name length, argument count, calling convention, whether the
+# function doesn't return, signature length, and signature offset.
+_FUNCTION_RECORD = struct.Struct("<IHHccHI")
+
+# Name offset, name length, and size. A size of `POINTER_SIZE` means that the
+# data is pointer-sized, which depends on the architecture.
+_DATA_RECORD = struct.Struct("<IHxxi")
+
+POINTER_SIZE = -1
+
+# Calling conventions, as written in definitions files. `M` is the convention
+# of `MCSEMA` lines, which name mcsema's own internal functions.
+CONVENTIONS = ("C", "E", "F", "M")
+
+
+class DefsError(Exception):
+    pass
+
+
+def _to_bytes(s):
+    if isinstance(s, bytes):
+        return s
+    return s.encode("utf-8")
+
+
+def _to_str(b):
+    if isinstance(b, str):
+        return b
+    return b.decode("utf-8")
+
+
+def hash_defs(path):
+    """Returns the SHA-256 digest of the definitions file at `path`."""
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).digest()
+
+
+def parse_defs(lines):
+    """Parse the lines of a definitions file. Returns a dict mapping function
+    names to `(argc, conv, ret, sign)`, and one mapping data names to their
+    sizes. Later definitions of a name replace earlier ones."""
+    functions = {}
+    data = {}
+    for l in lines:
+        l = _to_str(l).strip()
+        if not l or l[0] == "#":
+            continue
+
+        line_args = l.split()
+        if line_args[0] == "DATA:":
+            if len(line_args) != 3:
+                raise DefsError("Malformed data definition: " + l)
+            size = line_args[2]
+            data[line_args[1]] = POINTER_SIZE if "PTR" in size else int(size)
+            continue
+
+        sign = None
+        if len(line_args) == 2:
+            fname, conv = line_args
+            if conv != "MCSEMA":
+                raise DefsError("Unknown calling convention: " + conv)
+            functions[fname] = (1, "M", "N", None)
+            continue
+        elif len(line_args) == 4:
+            fname, argc, conv, ret = line_args
+        elif len(line_args) == 5:
+            fname, argc, conv, ret, sign = line_args
+        else:
+            raise DefsError("Malformed function definition: " + l)
+
+        if conv not in CONVENTIONS[:3]:
+            raise DefsError("Unknown calling convention: " + l)
+        if ret not in ("Y", "N"):
+            raise DefsError("Unknown return type: " + ret)
+        functions[fname] = (int(argc), conv, ret, sign)
+
+    return functions, data
+
+
+def _replace(src, dst):
+    """Atomically move `src` over `dst`."""
+    try:
+        os.rename(src, dst)
+    except OSError:
+        # Windows won't rename over an existing file.
+        os.unlink(dst)
+        os.rename(src, dst)
+
+
+def compile_defs(source_path, db_path=None):
+    """Compile the definitions file at `source_path` into a database at
+    `db_path` (by default, next to the source). Returns `db_path`."""
+    if db_path is None:
+        db_path = source_path + ".db"
+
+    with open(source_path, "rb") as f:
+        text = f.read()
+    functions, data = parse_defs(text.splitlines())
+
+    strings = bytearray()
+    def add_string(s):
+        offset = len(strings)
+        strings.extend(_to_bytes(s))
+        return offset
+
+    records = bytearray()
+    for name in sorted(functions, key=_to_bytes):
+        argc, conv, ret, sign = functions[name]
+        name_off = add_string(name)
+        sign_off = add_string(sign or "")
+        records.extend(_FUNCTION_RECORD.pack(
+            name_off, len(_to_bytes(name)), argc, _to_bytes(conv),
+            _to_bytes(ret), len(_to_bytes(sign or "")), sign_off))
+
+    for name in sorted(data, key=_to_bytes):
+        name_off = add_string(name)
+        records.extend(_DATA_RECORD.pack(
+            name_off, len(_to_bytes(name)), data[name]))
+
+    header = _HEADER.pack(
+        MAGIC, VERSION, hashlib.sha256(text).digest(), len(functions),
+        len(data), _HEADER.size + len(records))
+
+    # Written to a temporary file first, so that concurrent runs never open a
+    # partially written database.
+    db_dir = os.path.dirname(os.path.abspath(db_path))
+    if not os.path.isdir(db_dir):
+        os.makedirs(db_dir)
+    fd, temp_path = tempfile.mkstemp(dir=db_dir)
+    with os.fdopen(fd, "wb") as f:
+        f.write(header)
+        f.write(records)
+        f.write(strings)
+    _replace(temp_path, db_path)
+    return db_path
+
+
+class DefsDatabase(object):
+    """A compiled definitions database, opened with `mmap`. Lookups read only
+    the records that the binary search visits."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self._mm) < _HEADER.size:
+            raise DefsError("Truncated definitions database: " + path)
+        (magic, version, self.digest, self._num_functions, self._num_data,
+         self._strings) = _HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or version != VERSION:
+            raise DefsError("Unsupported definitions database: " + path)
+
+        self._functions = _HEADER.size
+        self._data = self._functions + \
+                     self._num_functions * _FUNCTION_RECORD.size
+
+    def __len__(self):
+        return self._num_functions + self._num_data
+
+    def close(self):
+        self._mm.close()
+
+    def _string(self, offset, length):
+        start = self._strings + offset
+        return self._mm[start:start + length]
+
+    def _search(self, name, base, count, record):
+        name = _to_bytes(name)
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            fields = record.unpack_from(self._mm, base + mid * record.size)
+            probe = self._string(fields[0], fields[1])
+            if probe == name:
+                return fields
+            elif probe < name:
+                lo = mid + 1
+            else:
+                hi = mid
+        return None
+
+    def function(self, name):
+        """Returns the `(argc, conv, ret, sign)` of the function `name`, or
+        `None` if it isn't defined. `sign` is `None` if the definition has no
+        signature."""
+        fields = self._search(
+            name, self._functions, self._num_functions, _FUNCTION_RECORD)
+        if fields is None:
+            return None
+        _, _, argc, conv, ret, sign_len, sign_off = fields
+        sign = None
+        if sign_len:
+            sign = _to_str(self._string(sign_off, sign_len))
+        return argc, _to_str(conv), _to_str(ret), sign
+
+    def data(self, name):
+        """Returns the size of the data `name`, `POINTER_SIZE` if it is
+        pointer-sized, or `None` if it isn't defined."""
+        fields = self._search(name, self._data, self._num_data, _DATA_RECORD)
+        if fields is None:
+            return None
+        return fields[2]
+
+
+def _open_if_current(db_path, digest):
+    """Open the database at `db_path` if it exists and was compiled from the
+    text with the SHA-256 digest `digest`."""
+    if not os.path.isfile(db_path):
+        return None
+    try:
+        db = DefsDatabase(db_path)
+    except (DefsError, EnvironmentError, ValueError):
+        return None
+    if db.digest != digest:
+        db.close()
+        return None
+    return db
+
+
+def open_defs(source_path, cache_dir=CACHE_DIR):
+    """Open the database compiled from the definitions file at `source_path`,
+    compiling it if there is no up-to-date database."""
+    digest = hash_defs(source_path)
+    db = _open_if_current(source_path + ".db", digest)
+    if db is not None:
+        return db
+
+    db_path = os.path.join(cache_dir, "{}.db".format(
+        hashlib.sha256(digest).hexdigest()[:32]))
+    db = _open_if_current(db_path, digest)
+    if db is not None:
+        return db
+
+    return DefsDatabase(compile_defs(source_path, db_path))
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(
+        description="Compile definitions files into indexed databases.")
+
+    arg_parser.add_argument(
+        'defs',
+        nargs='+',
+        help="Definitions files to compile. Each is compiled into <file>.db.")
+
+    args = arg_parser.parse_args()
+
+    for path in args.defs:
+        try:
+            db_path = compile_defs(path)
+        except (DefsError, EnvironmentError, ValueError) as e:
+            sys.stderr.write("Could not compile {}: {}\n".format(path, e))
+            return 1
+        sys.stderr.write("Compiled {} into {}\n".format(path, db_path))
+
+    return 0
+
+
+if "__main__" == __name__:
+    exit(main())
@@ -3,17 +3,38 @@
 
 import argparse
 import collections
+import copy
 import itertools
+import json
 import os
+import shutil
 import subprocess
 import sys
+import threading
 import traceback
 
+# Options that `get_cfg.py` changes before waiting for IDA's initial
+# auto-analysis. A saved database can only be reused by runs that would have
+# analyzed the binary in the same way.
+ANALYSIS_OPTIONS = "INF_START_AF&=~AF_IMMOFF"
+
+def database_extension(args):
+  """Returns the file extension of the databases made by `args.disassembler`."""
+  if "64" in os.path.basename(args.disassembler):
+    return ".i64"
+  return ".idb"
+
+def is_database(path):
+  return os.path.splitext(path)[1] in (".idb", ".i64")
+
 def execute(args, command_args):
   """Execute IDA Pro as a subprocess, passing this file in as a batch-mode
   script for IDA to run. This forwards along arguments passed to `mcsema-disass`
   down into the IDA script. `command_args` contains unparsed arguments passed
-  to `mcsema-disass`. This script may handle extra arguments."""
+  to `mcsema-disass`. This script may handle extra arguments.
+
+  If `args.binary` is an IDA database, then IDA opens it directly, and no
+  initial auto-analysis is needed."""
 
   ida_disass_path = os.path.abspath(__file__)
   ida_dir = os.path.dirname(ida_disass_path)
@@ -44,7 +65,10 @@ def execute(args, command_args):
 
   cmd = []
   cmd.append(r'"{}"'.format(args.disassembler))  # Path to IDA.
-  cmd.append("-B")  # Batch mode.
+  if is_database(args.binary):
+    cmd.append("-A")  # Autonomous mode; the database already exists.
+  else:
+    cmd.append("-B")  # Batch mode.
   cmd.append("-S\"{}\"".format(" ".join(script_cmd)))
   cmd.append(args.binary)
 
@@ -62,3 +86,126 @@ def execute(args, command_args):
   except subprocess.CalledProcessError as e:
     sys.stderr.write(traceback.format_exc())
     return 1
+
+def _take_arg(command_args, name):
+  """Remove the option `name` and its value from `command_args`, returning
+  the value, or `None` if the option isn't there."""
+  if name not in command_args:
+    return None
+  i = command_args.index(name)
+  value = command_args[i + 1]
+  del command_args[i:i + 2]
+  return value
+
+def _combine_profiles(shard_paths, path):
+  shard_profiles = []
+  for shard_path in shard_paths:
+    try:
+      with open(shard_path) as f:
+        shard_profiles.append(json.load(f))
+    except (IOError, ValueError):
+      shard_profiles.append(None)
+  with open(path, "w") as f:
+    json.dump({"shards": shard_profiles}, f, indent=2)
+
+def _combine_csvs(shard_paths, path):
+  with open(path, "w") as out:
+    wrote_header = False
+    for shard_path in shard_paths:
+      if not os.path.isfile(shard_path):
+        continue
+      with open(shard_path) as f:
+        header = f.readline()
+        if not wrote_header:
+          out.write(header)
+          wrote_header = True
+        shutil.copyfileobj(f, out)
+
+def _combine_api_profiles(shard_paths, path):
+  # Flame graph tools add up the counts of repeated stacks.
+  for suffix in ("", ".folded"):
+    with open(path + suffix, "w") as out:
+      for index, shard_path in enumerate(shard_paths):
+        if not os.path.isfile(shard_path + suffix):
+          continue
+        if not suffix:
+          out.write("# Shard {}\n".format(index))
+        with open(shard_path + suffix) as f:
+          shutil.copyfileobj(f, out)
+
+# Options naming a file that the script writes. Under `execute_sharded`,
+# each copy writes its own file, and these are combined with the function.
+SHARD_OUTPUTS = {
+  "--profile": _combine_profiles,
+  "--function-costs": _combine_csvs,
+  "--api-profile": _combine_api_profiles,
+}
+
+def execute_sharded(args, command_args, jobs, workspace_dir):
+  """Execute `jobs` copies of IDA Pro concurrently, each of which lifts an
+  equal share of the entry points, and then merge their CFGs into
+  `args.output`. Each copy works on its own copy of the binary, so that they
+  don't fight over the database."""
+  import merge
+
+  # Only one copy needs to save the auto-analyzed database.
+  save_args = []
+  other_args = list(command_args)
+  save_path = _take_arg(other_args, "--save-database")
+  if save_path:
+    save_args = ["--save-database", save_path]
+
+  outputs = {}
+  for name in SHARD_OUTPUTS:
+    path = _take_arg(other_args, name)
+    if path:
+      outputs[name] = path
+
+  shard_args = []
+  for index in range(jobs):
+    shard_dir = os.path.join(workspace_dir, "shard{}".format(index))
+    os.mkdir(shard_dir)
+
+    sargs = copy.copy(args)
+    sargs.binary = os.path.join(shard_dir, os.path.basename(args.binary))
+    sargs.output = os.path.join(shard_dir, "shard.cfg")
+    if args.log_file != os.devnull:
+      sargs.log_file = "{}.shard{}".format(args.log_file, index)
+    shutil.copyfile(args.binary, sargs.binary)
+
+    scommand_args = (save_args if 0 == index else []) + other_args
+    for name in sorted(outputs):
+      scommand_args.extend([name, os.path.join(shard_dir, name.lstrip("-"))])
+    scommand_args.extend(["--shard", "{}/{}".format(index, jobs)])
+    shard_args.append((sargs, scommand_args))
+
+  rets = [1] * jobs
+  def run_shard(index):
+    sargs, scommand_args = shard_args[index]
+    rets[index] = execute(sargs, scommand_args)
+
+  threads = [threading.Thread(target=run_shard, args=(index,))
+             for index in range(jobs)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+
+  for index, (sargs, _) in enumerate(shard_args):
+    if rets[index] != 0 or not os.path.isfile(sargs.output):
+      sys.stderr.write("Shard {} of {} failed.\n".format(index, jobs))
+      return 1
+
+  for name, path in outputs.items():
+    shard_paths = [os.path.join(workspace_dir, "shard{}".format(index),
+                                name.lstrip("-"))
+                   for index in range(jobs)]
+    SHARD_OUTPUTS[name](shard_paths, path)
+
+  conflicts = merge.merge_cfg_files(
+      [sargs.output for sargs, _ in shard_args], args.output)
+  for field, key in conflicts:
+    sys.stderr.write("Shards disagree about {} entry {}; kept the first.\n".format(
+        field, key))
+
+  return 0
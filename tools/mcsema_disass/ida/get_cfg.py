@@ -16,11 +16,28 @@ import sys
 from os import path
 import os
 import argparse
+import array
 import struct
 #import syslog
 import traceback
 import collections
 import itertools
+import bisect
+import csv
+import heapq
+import json
+import time
+import types
+
+try:
+    import resource
+except ImportError:
+    resource = None  # Not available on Windows.
+
+try:
+    import numpy
+except ImportError:
+    numpy = None  # Pointer scans fall back on `array`.
 
 
 #hack for IDAPython to see google protobuf lib
@@ -36,15 +53,50 @@ tools_disass_dir = os.path.dirname(tools_disass_ida_dir)
 # Note: The bootstrap file will copy CFG_pb2.py into this dir!!
 import CFG_pb2
 
-_DEBUG = False
-_DEBUG_FILE = sys.stderr
+if tools_disass_ida_dir not in sys.path:
+    sys.path.append(tools_disass_ida_dir)
+import defsdb
+
+# Log levels, from most to least verbose.
+LOG_DEBUG = 10
+LOG_INFO = 20
+LOG_WARNING = 30
+LOG_ERROR = 40
+LOG_OFF = 100
+
+LOG_LEVELS = collections.OrderedDict([
+    ("debug", LOG_DEBUG),
+    ("info", LOG_INFO),
+    ("warning", LOG_WARNING),
+    ("error", LOG_ERROR),
+    ("off", LOG_OFF)])
+
+_LOG_LEVEL_NAMES = dict((level, name) for name, level in LOG_LEVELS.items())
+
+# How many of the most recent messages that weren't logged (because they
+# were below the log level) to keep. These are dumped if recovery fails.
+LOG_RING_SIZE = 1000
+
+_LOG_LEVEL = LOG_OFF
+_LOG_FILE = None
+_LOG_JSONL = None
+_LOG_RING = collections.deque(maxlen=LOG_RING_SIZE)
 
 EXTERNALS = set()
+
+# Maps the original `(start, end)` of every data segment to the `(start, end)`
+# where it will live in the CFG. These are the same, unless the data came
+# from an executable segment, in which case it is moved elsewhere.
 DATA_SEGMENTS = {}
 
 RECOVERED_EAS = set()
+
+# Addresses of jump table entries, i.e. data accessed via a JMP.
 ACCESSED_VIA_JMP = set()
 
+# Decoded jump tables, keyed by the EA of the jump that uses them.
+JUMP_TABLES = {}
+
 EMAP = {}
 EMAP_DATA = {}
 
@@ -126,37 +178,418 @@ EXTERNAL_DATA_COMMENTS = [
         "Copy of shared data",
         ]
 
-def DEBUG(s):
-    global _DEBUG, _DEBUG_FILE
-    if _DEBUG:
-        _DEBUG_FILE.write("{}\n".format(str(s)))
+def configureLogging(level=LOG_DEBUG, stream=None, jsonl_path=None,
+                     ring_size=LOG_RING_SIZE):
+    """Log messages at or above `level` to `stream` and/or as JSON lines to
+    `jsonl_path`. The last `ring_size` messages below `level` are kept in
+    memory, unformatted, and only written out by `dumpLogRing`."""
+    global _LOG_LEVEL, _LOG_FILE, _LOG_JSONL, _LOG_RING
+    _LOG_FILE = stream
+    _LOG_JSONL = None
+    if jsonl_path:
+        _LOG_JSONL = open(jsonl_path, "w", 1)  # Line buffered.
+    if _LOG_FILE is None and _LOG_JSONL is None:
+        level = LOG_OFF
+    _LOG_LEVEL = level
+    _LOG_RING = collections.deque(maxlen=ring_size) if ring_size else None
+
+def _formatMessage(fmt, args):
+    if args:
+        return fmt.format(*args)
+    return str(fmt)
+
+def _emit(level, fmt, args):
+    msg = _formatMessage(fmt, args)
+    if _LOG_FILE is not None:
+        _LOG_FILE.write("{}\n".format(msg))
+    if _LOG_JSONL is not None:
+        _LOG_JSONL.write("{}\n".format(json.dumps({
+            "time": round(time.time(), 6),
+            "level": _LOG_LEVEL_NAMES[level],
+            "message": msg})))
+
+# Messages are formatted as `fmt.format(*args)`, but only if they will
+# really be written somewhere.
+def log(level, fmt, *args):
+    if level >= _LOG_LEVEL:
+        _emit(level, fmt, args)
+    elif _LOG_RING is not None:
+        _LOG_RING.append((level, fmt, args))
+
+def DEBUG(fmt, *args):
+    if LOG_DEBUG >= _LOG_LEVEL:
+        _emit(LOG_DEBUG, fmt, args)
+    elif _LOG_RING is not None:
+        _LOG_RING.append((LOG_DEBUG, fmt, args))
+
+def INFO(fmt, *args):
+    log(LOG_INFO, fmt, *args)
+
+def WARNING(fmt, *args):
+    log(LOG_WARNING, fmt, *args)
+
+def ERROR(fmt, *args):
+    log(LOG_ERROR, fmt, *args)
+
+def dumpLogRing():
+    """Write out the recent messages that were below the log level, e.g. to
+    explain a failure. They go to the log file if there is one, and to
+    stderr otherwise."""
+    if not _LOG_RING:
+        return
+    out = _LOG_FILE or sys.stderr
+    out.write("Last {} unlogged messages:\n".format(len(_LOG_RING)))
+    for level, fmt, args in _LOG_RING:
+        try:
+            msg = _formatMessage(fmt, args)
+        except Exception:
+            msg = "{!r} % {!r}".format(fmt, args)
+        out.write("[{}] {}\n".format(_LOG_LEVEL_NAMES[level], msg))
+    _LOG_RING.clear()
 
 _PREFIX_ITYPES = (idaapi.NN_lock, idaapi.NN_rep,
                   idaapi.NN_repe, idaapi.NN_repne)
 
+class _DecodedOperand(object):
+    """The parts of an `op_t` that we look at after decoding."""
+
+    __slots__ = ('n', 'type', 'value', 'addr', 'reg', 'offb')
+
+    def __init__(self, op):
+        self.n = op.n
+        self.type = op.type
+        self.value = op.value
+        self.addr = op.addr
+        self.reg = op.reg
+        self.offb = op.offb
+
+class _DecodedInstruction(object):
+    """A compact, cacheable stand-in for an `insn_t`. If the instruction had
+    an independently-decoded prefix, then `bytes` includes the prefix, but
+    the other fields describe the prefixed instruction."""
+
+    __slots__ = ('ea', 'itype', 'size', 'Operands', 'bytes', 'personality')
+
+    def __init__(self, insn_t, decoded_bytes):
+        self.ea = insn_t.ea
+        self.itype = insn_t.itype
+        self.size = insn_t.size
+        self.bytes = decoded_bytes
+        self.personality = _PERSONALITIES[insn_t.itype]
+
+        # Keep every operand slot, including the unused (`o_void`) ones, so
+        # that code looping over `Operands` sees what it would in an `insn_t`.
+        self.Operands = tuple(_DecodedOperand(op) for op in insn_t.Operands)
+
+    @property
+    def Op1(self):
+        return self.Operands[0]
+
+# Decoded instructions, keyed by EA. This is bounded so that a pathological
+# input can't exhaust memory; once full, the oldest decodings are evicted.
+_DECODE_CACHE = collections.OrderedDict()
+_DECODE_CACHE_MAX_SIZE = 1 << 20
+_DECODE_CACHE_HITS = 0
+_DECODE_CACHE_MISSES = 0
+
 def _decode_instruction(ea):
     """Read the bytes of an x86/amd64 instruction. This handles things like
     combining the bytes of an instruction with its prefix. IDA Pro sometimes
-    treats these as separate."""
-    global _PREFIX_ITYPES
+    treats these as separate.
 
-    decoded_inst = idautils.DecodeInstruction(ea)
-    if not decoded_inst:
+    Decodings are cached, so each instruction is only decoded once per run."""
+    global _DECODE_CACHE_HITS, _DECODE_CACHE_MISSES
+
+    decoded_inst = _DECODE_CACHE.get(ea)
+    if decoded_inst is not None:
+        _DECODE_CACHE_HITS += 1
+        return decoded_inst, decoded_inst.bytes
+
+    _DECODE_CACHE_MISSES += 1
+    decoded_inst = _decode_instruction_uncached(ea)
+    if decoded_inst is None:
         return None, tuple()
 
-    assert decoded_inst.ea == ea
-    end_ea = ea + decoded_inst.size
-    decoded_bytes = "".join(chr(idc.Byte(byte_ea)) for byte_ea in range(ea, end_ea))
+    if len(_DECODE_CACHE) >= _DECODE_CACHE_MAX_SIZE:
+        _DECODE_CACHE.popitem(last=False)
+    _DECODE_CACHE[ea] = decoded_inst
+    return decoded_inst, decoded_inst.bytes
+
+def _decode_instruction_uncached(ea):
+    global _PREFIX_ITYPES
+
+    insn_t = idautils.DecodeInstruction(ea)
+    if not insn_t:
+        return None
+
+    assert insn_t.ea == ea
+    end_ea = ea + insn_t.size
+    decoded_bytes = readBytes(ea, end_ea)
 
     # We've got an instruction with a prefix, but the prefix is treated as
     # independent.
-    if 1 == decoded_inst.size and decoded_inst.itype in _PREFIX_ITYPES:
-        decoded_inst, extra_bytes = _decode_instruction(end_ea)
-        DEBUG("Extended instruction at {:08x} by {} bytes".format(
-            ea, len(extra_bytes)))
+    if 1 == insn_t.size and insn_t.itype in _PREFIX_ITYPES:
+        insn_t, extra_bytes = _decode_instruction(end_ea)
+        DEBUG("Extended instruction at {:08x} by {} bytes",
+            ea, len(extra_bytes))
+        if insn_t is None:
+            return None
         decoded_bytes += extra_bytes
+        return _DecodedInstruction(insn_t, decoded_bytes)
+
+    return _DecodedInstruction(insn_t, decoded_bytes)
+
+def _reset_decode_cache():
+    global _DECODE_CACHE_HITS, _DECODE_CACHE_MISSES
+    _DECODE_CACHE.clear()
+    _DECODE_CACHE_HITS = 0
+    _DECODE_CACHE_MISSES = 0
+
+def _report_decode_cache():
+    INFO("Instruction decode cache: {} hits, {} misses, {} cached",
+        _DECODE_CACHE_HITS, _DECODE_CACHE_MISSES, len(_DECODE_CACHE))
+
+class PhaseProfile(object):
+    """Wall time, CPU time, and peak memory use of each phase of CFG
+    recovery, along with counts of what was recovered. Starting a phase ends
+    the current one."""
+
+    def __init__(self):
+        self.phases = []
+        self.counts = collections.OrderedDict()
+        self.current = None
+
+    def _sample(self):
+        times = os.times()
+        return time.time(), times[0] + times[1]
 
-    return decoded_inst, decoded_bytes
+    def begin(self, name):
+        self.end()
+        wall, cpu = self._sample()
+        self.current = (name, wall, cpu)
+
+    def end(self):
+        if self.current is None:
+            return
+        name, wall_start, cpu_start = self.current
+        wall, cpu = self._sample()
+        self.phases.append(collections.OrderedDict([
+            ("name", name),
+            ("wall_time", round(wall - wall_start, 6)),
+            ("cpu_time", round(cpu - cpu_start, 6)),
+            ("peak_rss_kb", getPeakRss())]))
+        self.current = None
+
+    def count(self, name, amount=1):
+        self.counts[name] = self.counts.get(name, 0) + amount
+
+    def write(self, path):
+        self.end()
+        profile = collections.OrderedDict([
+            ("module", idc.GetInputFile()),
+            ("phases", self.phases),
+            ("counts", self.counts),
+            ("wall_time", round(sum(p["wall_time"] for p in self.phases), 6)),
+            ("cpu_time", round(sum(p["cpu_time"] for p in self.phases), 6)),
+            ("peak_rss_kb", getPeakRss())])
+        with open(path, "w") as f:
+            json.dump(profile, f, indent=2)
+        DEBUG("Wrote profile to {}", path)
+
+PROFILE = PhaseProfile()
+
+def getPeakRss():
+    """Returns the peak resident set size of this process, in kilobytes, or
+    `None` if it isn't known."""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        rss //= 1024  # Reported in bytes instead of kilobytes.
+    return rss
+
+def countRecovered(M):
+    """Record how much was recovered into `M` in the profile."""
+    blocks = 0
+    insts = 0
+    for F in M.internal_funcs:
+        blocks += len(F.blocks)
+        for B in F.blocks:
+            insts += len(B.insts)
+
+    PROFILE.count("functions", len(M.internal_funcs))
+    PROFILE.count("blocks", blocks)
+    PROFILE.count("instructions", insts)
+    PROFILE.count("data_segments", len(M.internal_data))
+    PROFILE.count("relocations", sum(len(D.symbols) for D in M.internal_data))
+    PROFILE.count("offset_tables", len(M.offset_tables))
+    PROFILE.count("external_functions", len(M.external_funcs))
+    PROFILE.count("external_data", len(M.external_data))
+    PROFILE.count("decode_cache_hits", _DECODE_CACHE_HITS)
+    PROFILE.count("decode_cache_misses", _DECODE_CACHE_MISSES)
+
+class ApiProfiler(object):
+    """Counts and times the calls that this script makes into the IDA API.
+    Calls are broken down by API, by the function in this script that made
+    them, and by the full call stack within this script. Iterating over the
+    result of an API that returns a generator (e.g. `idautils.Heads`) is
+    counted separately, as `<api>/next`."""
+
+    # How many of the most expensive APIs to list in the log.
+    TOP_N = 30
+
+    def __init__(self):
+        self.calls = 0
+        self.by_api = collections.defaultdict(lambda: [0, 0.0])
+        self.by_caller = collections.defaultdict(lambda: [0, 0.0])
+        self.stacks = collections.defaultdict(float)
+
+    def record(self, api, frame, elapsed):
+        self.calls += 1
+        stat = self.by_api[api]
+        stat[0] += 1
+        stat[1] += elapsed
+
+        stat = self.by_caller[(frame.f_code.co_name, api)]
+        stat[0] += 1
+        stat[1] += elapsed
+
+        stack = [api]
+        filename = frame.f_code.co_filename
+        while frame is not None and frame.f_code.co_filename == filename:
+            stack.append(frame.f_code.co_name)
+            frame = frame.f_back
+        self.stacks[";".join(reversed(stack))] += elapsed
+
+    def wrap(self, api, func):
+        profiler = self
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            try:
+                result = func(*args, **kwargs)
+            finally:
+                profiler.record(api, sys._getframe(1), time.time() - start)
+            if isinstance(result, types.GeneratorType):
+                result = profiler._wrapGenerator(api + "/next", result)
+            return result
+        wrapper.__name__ = func.__name__
+        return wrapper
+
+    def _wrapGenerator(self, api, gen):
+        while True:
+            start = time.time()
+            try:
+                item = next(gen)
+            except StopIteration:
+                self.record(api, sys._getframe(1), time.time() - start)
+                return
+            self.record(api, sys._getframe(1), time.time() - start)
+            yield item
+
+    def write(self, path):
+        """Log the most expensive APIs, and write the full summary table to
+        `path` and the collapsed stacks (in microseconds, for flame graph
+        tools) to `path + ".folded"`."""
+        apis = sorted(self.by_api.items(), key=lambda kv: (-kv[1][1], kv[0]))
+        INFO("{} calls into the IDA API; most expensive:", self.calls)
+        INFO("  {:>10} {:>10} {:>9}  {}", "calls", "total (s)", "mean (us)", "api")
+        for api, (calls, total) in apis[:self.TOP_N]:
+            INFO("  {:>10} {:>10.4f} {:>9.2f}  {}",
+                calls, total, 1e6 * total / calls, api)
+
+        with open(path, "w") as f:
+            f.write("# Calls into the IDA API, by API\n")
+            f.write("api\tcalls\ttotal_s\tmean_us\n")
+            for api, (calls, total) in apis:
+                f.write("{}\t{}\t{:.6f}\t{:.2f}\n".format(
+                    api, calls, total, 1e6 * total / calls))
+
+            f.write("# Calls into the IDA API, by calling function\n")
+            f.write("caller\tapi\tcalls\ttotal_s\n")
+            callers = sorted(self.by_caller.items(),
+                             key=lambda kv: (-kv[1][1], kv[0]))
+            for (caller, api), (calls, total) in callers:
+                f.write("{}\t{}\t{}\t{:.6f}\n".format(caller, api, calls, total))
+
+        with open(path + ".folded", "w") as f:
+            for stack in sorted(self.stacks):
+                f.write("{} {}\n".format(stack, int(round(1e6 * self.stacks[stack]))))
+
+        DEBUG("Wrote IDA API profile to {}", path)
+
+class ApiCallCounter(object):
+    """Only counts the calls that this script makes into the IDA API. This is
+    much cheaper than an `ApiProfiler`, and is enough for `FunctionCost`.
+    Unlike an `ApiProfiler`, iterating over a generator isn't counted."""
+
+    def __init__(self):
+        self.calls = 0
+
+    def wrap(self, api, func):
+        counter = self
+        def wrapper(*args, **kwargs):
+            counter.calls += 1
+            return func(*args, **kwargs)
+        wrapper.__name__ = func.__name__
+        return wrapper
+
+class _ProfiledModule(object):
+    """Stands in for one of the IDA API modules, passing calls to its
+    functions through an `ApiProfiler` or `ApiCallCounter`. Everything else
+    (constants, classes) is looked up on the real module."""
+
+    def __init__(self, profiler, module):
+        self._profiler = profiler
+        self._module = module
+
+    def __getattr__(self, name):
+        attr = getattr(self._module, name)
+        if isinstance(attr, (types.FunctionType, types.BuiltinFunctionType)):
+            attr = self._profiler.wrap(
+                "{}.{}".format(self._module.__name__, name), attr)
+            setattr(self, name, attr)
+        return attr
+
+API_PROFILER = None
+
+def enableApiProfiler():
+    """Route this script's calls into `idc`, `idaapi` and `idautils` through
+    an `ApiProfiler`. This slows everything down, and so is opt-in."""
+    global API_PROFILER, idc, idaapi, idautils
+    API_PROFILER = ApiProfiler()
+    idc = _ProfiledModule(API_PROFILER, idc)
+    idaapi = _ProfiledModule(API_PROFILER, idaapi)
+    idautils = _ProfiledModule(API_PROFILER, idautils)
+
+# Counts the calls into the IDA API for `FunctionCost`, or `None`.
+API_CALL_COUNTER = None
+
+def enableApiCallCounter():
+    """Count this script's calls into `idc`, `idaapi` and `idautils`. If the
+    `ApiProfiler` is enabled, then it already counts them."""
+    global API_CALL_COUNTER, idc, idaapi, idautils
+    if API_PROFILER:
+        API_CALL_COUNTER = API_PROFILER
+        return
+    API_CALL_COUNTER = ApiCallCounter()
+    idc = _ProfiledModule(API_CALL_COUNTER, idc)
+    idaapi = _ProfiledModule(API_CALL_COUNTER, idaapi)
+    idautils = _ProfiledModule(API_CALL_COUNTER, idautils)
+
+API_RECORDER = None
+
+def enableApiRecorder():
+    """Record the answers to this script's calls into `idc`, `idaapi` and
+    `idautils`, so that the run can be replayed without IDA. See
+    `apitrace.py`."""
+    global API_RECORDER, idc, idaapi, idautils
+    if tools_disass_ida_dir not in sys.path:
+        sys.path.append(tools_disass_ida_dir)
+    import apitrace
+    API_RECORDER = apitrace.TraceRecorder()
+    idc = API_RECORDER.wrap(idc)
+    idaapi = API_RECORDER.wrap(idaapi)
+    idautils = API_RECORDER.wrap(idautils)
 
 # Python 2.7's xrange doesn't work with `long`s.
 def xrange(begin, end=None, step=1):
@@ -178,26 +611,38 @@ def ReftypeString(rt):
         return "UNKNOWN!"
 
 def readByte(ea):
-    byte = readBytesSlowly(ea, ea+1)
+    byte = readBytes(ea, ea+1)
     byte = ord(byte)
     return byte
 
 def readDword(ea):
-    bytestr = readBytesSlowly(ea, ea+4)
-    dword = struct.unpack("<L", bytestr)[0]
-    return dword
+    return unpackBytes("<L", 4, ea)
 
 def readQword(ea):
-    bytestr = readBytesSlowly(ea, ea+8)
-    qword = struct.unpack("<Q", bytestr)[0]
-    return qword
+    return unpackBytes("<Q", 8, ea)
+
+# Properties of the input file. These don't change during a run, so they are
+# only queried once.
+_IS_ELF = None
+_IS_LINKED_ELF = None
 
 def isElf():
-    return idc.GetLongPrm(idc.INF_FILETYPE) == idc.FT_ELF
+    global _IS_ELF
+    if _IS_ELF is None:
+        _IS_ELF = idc.GetLongPrm(idc.INF_FILETYPE) == idc.FT_ELF
+    return _IS_ELF
 
 def isLinkedElf():
-    return idc.GetLongPrm(idc.INF_FILETYPE) == idc.FT_ELF and \
-        idc.BeginEA() not in [0xffffffffL, 0xffffffffffffffffL]
+    global _IS_LINKED_ELF
+    if _IS_LINKED_ELF is None:
+        _IS_LINKED_ELF = isElf() and \
+            idc.BeginEA() not in [0xffffffffL, 0xffffffffffffffffL]
+    return _IS_LINKED_ELF
+
+def resetFileType():
+    global _IS_ELF, _IS_LINKED_ELF
+    _IS_ELF = None
+    _IS_LINKED_ELF = None
 
 def IsString(ea):
     return idc.isASCII(idaapi.getFlags(ea))
@@ -260,7 +705,7 @@ def isJmpTable(ea):
 
     if not is_jmp: return False
 
-    if idaapi.get_switch_info_ex(ea):
+    if getJumpTable(ea) is not None:
         return True
 
     return False
@@ -301,21 +746,21 @@ def entryPointHandler(M, ep, name, args_from_stddef=False):
 
     F = addFunction(M, ep)
 
-    DEBUG("At EP {0}:{1:x}".format(name,ep))
+    DEBUG("At EP {0}:{1:x}", name,ep)
 
     return F
 
 def basicBlockHandler(F, block, blockset, processed_blocks):
     B = F.blocks.add()
     B.base_address = block.startEA
-    DEBUG("BB: {0:x}".format(block.startEA))
+    DEBUG("BB: {0:x}", block.startEA)
 
     B.block_follows.extend(block.succs)
 
-    if _DEBUG:
+    if LOG_DEBUG >= _LOG_LEVEL:
         str_l = ["{0:x}".format(i) for i in block.succs]
         if len(str_l) > 0:
-            DEBUG("Successors: {0}".format(", ".join(str_l)))
+            DEBUG("Successors: {0}", ", ".join(str_l))
 
     return B
 
@@ -323,18 +768,68 @@ def readInstructionBytes(inst):
     _, decoded_bytes = _decode_instruction(inst)
     return decoded_bytes
 
-def isInternalCode(ea):
-
+# Verdicts of `classifyAddress`.
+ADDR_INVALID = 0
+ADDR_DATA = 1
+ADDR_INTERNAL_CODE = 2
+ADDR_EXTERNAL_CODE = 3
+ADDR_EXTERNAL_DATA = 4
+
+# Per-run table of `classifyAddress` verdicts, keyed by EA. The same targets
+# get classified over and over again from different places, so this saves a
+# lot of round trips into IDA. Entries are forgotten when we change an
+# address, and the whole table is dropped whenever IDA's auto-analysis runs.
+ADDRESS_CLASSES = {}
+
+def forgetAddressClass(ea):
+    ADDRESS_CLASSES.pop(ea, None)
+
+def resetAddressClasses():
+    ADDRESS_CLASSES.clear()
+
+def classifyAddress(ea):
+    """Classify `ea` as one of the `ADDR_*` verdicts."""
+    verdict = ADDRESS_CLASSES.get(ea)
+    if verdict is None:
+        verdict = _classifyAddress(ea)
+        ADDRESS_CLASSES[ea] = verdict
+    return verdict
+
+def _classifyAddress(ea):
+    seg = findSegment(ea)
+    if seg is None:
+        return ADDR_INVALID
+
+    if _isExternalReference(ea, seg):
+        fn = fixExternalName(getFunctionName(ea))
+        if fn in EMAP_DATA and fn not in EMAP:
+            return ADDR_EXTERNAL_DATA
+        return ADDR_EXTERNAL_CODE
+
+    if _hasCodeFlags(ea):
+        return ADDR_INTERNAL_CODE
+
+    return ADDR_DATA
+
+def _hasCodeFlags(ea):
     pf = idc.GetFlags(ea)
-    if idc.isCode(pf) and not idc.isData(pf):
+    return idc.isCode(pf) and not idc.isData(pf)
+
+def isInternalCode(ea):
+    verdict = classifyAddress(ea)
+    if verdict == ADDR_INTERNAL_CODE:
         return True
 
+    # Externality is decided first, but some external references are code
+    # too, e.g. versioned functions in a shared library.
+    if verdict in (ADDR_EXTERNAL_CODE, ADDR_EXTERNAL_DATA):
+        return _hasCodeFlags(ea)
+
     # find stray 0x90 (NOP) bytes in .text that IDA
     # thinks are data items
-    if readByte(ea) == 0x90:
-        seg = idc.SegStart(ea)
-        segtype = idc.GetSegmentAttr(seg, idc.SEGATTR_TYPE)
-        if segtype == idc.SEG_CODE:
+    if verdict == ADDR_DATA and readByte(ea) == 0x90:
+        seg = findSegment(ea)
+        if seg.type == idc.SEG_CODE:
             mark_as_code(ea)
             return True
 
@@ -346,30 +841,28 @@ def isNotCode(ea):
     return not idc.isCode(pf)
 
 def isExternalReference(ea):
+    return classifyAddress(ea) in (ADDR_EXTERNAL_CODE, ADDR_EXTERNAL_DATA)
+
+def _isExternalReference(ea, seg):
     # see if this is in an internal or external code ref
-    DEBUG("Testing {0:x} for externality".format(ea))
+    DEBUG("Testing {0:x} for externality", ea)
     ext_types = [idc.SEG_XTRN]
-    seg = idc.SegStart(ea)
-    if seg == idc.BADADDR:
-        DEBUG("WARNING: Could not get segment addr for: {0:x}".format(ea))
-        return False
 
-    segtype = idc.GetSegmentAttr(seg, idc.SEGATTR_TYPE)
-    if segtype in ext_types:
+    if seg.type in ext_types:
         return True
 
     if isLinkedElf():
         fn = getFunctionName(ea)
         for extsign in EXTERNAL_NAMES:
             if extsign in fn:
-                DEBUG("Assuming external reference because: {} in {}".format(extsign, fn))
+                DEBUG("Assuming external reference because: {} in {}", extsign, fn)
                 return True
 
         if isExternalData(fn):
             if hasExternalDataComment(ea):
                 return True
             else:
-                DEBUG("WARNING: May have missed external data ref {} at {:x}".format(fn, ea))
+                WARNING("WARNING: May have missed external data ref {} at {:x}", fn, ea)
 
     return False
 
@@ -505,9 +998,12 @@ def isTrap(insn_t):
     return insn_t.itype in TRAPS
 
 def findRelocOffset(ea, size):
-    for i in xrange(ea,ea+size):
-        if idc.GetFixupTgtOff(i) != -1:
-            return i-ea
+    fixups = getFixups()
+    index = bisect.bisect_left(fixups.eas, ea)
+    while index < len(fixups.eas) and fixups.eas[index] < ea+size:
+        if fixups.targets[index] != -1:
+            return fixups.eas[index]-ea
+        index += 1
 
     return -1
 
@@ -538,21 +1034,86 @@ def handleExternalRef(fn):
     EXTERNALS.add(fixfn)
     return fixfn
 
+class DataSegmentIndex(object):
+    """The `[start, end)` ranges of the data segments as they will be laid out
+    in the CFG (i.e. the values of `DATA_SEGMENTS`). `ranges` holds them as
+    added. Overlapping ranges are merged into the sorted, non-overlapping
+    `starts` and `ends`, so that lookups are a binary search over the start
+    addresses."""
+
+    def __init__(self):
+        self.ranges = []
+        self.starts = []
+        self.ends = []
+        self.max_end = 0
+
+    def find(self, ea):
+        """Returns the index of the merged range containing `ea`, or -1."""
+        index = bisect.bisect_right(self.starts, ea) - 1
+        if index >= 0 and ea < self.ends[index]:
+            return index
+        return -1
+
+    def _merge(self, start, end):
+        # Empty ranges never contain anything.
+        if start >= end:
+            return
+
+        # The merged ranges that overlap `[start, end)`. Ranges that only
+        # touch it are kept apart.
+        lo = bisect.bisect_right(self.ends, start)
+        hi = bisect.bisect_left(self.starts, end)
+        if lo < hi:
+            DEBUG("{0:x}-{1:x} overlaps with an existing data segment",
+                start, end)
+            start = min(start, self.starts[lo])
+            end = max(end, self.ends[hi-1])
+
+        self.starts[lo:hi] = [start]
+        self.ends[lo:hi] = [end]
+
+    def add(self, start, end):
+        bisect.insort(self.ranges, (start, end))
+        if end > self.max_end:
+            self.max_end = end
+        self._merge(start, end)
+
+    def remove(self, start, end):
+        index = bisect.bisect_left(self.ranges, (start, end))
+        if index == len(self.ranges) or self.ranges[index] != (start, end):
+            return
+
+        # What's left of a merged range isn't known, so start over.
+        del self.ranges[index]
+        self.starts = []
+        self.ends = []
+        self.max_end = 0
+        for start, end in self.ranges:
+            self.max_end = max(self.max_end, end)
+            self._merge(start, end)
+
+DATA_SEGMENT_INDEX = DataSegmentIndex()
+
 def isInData(start_ea, end_ea):
-    for (start,end) in DATA_SEGMENTS.values():
-        if start_ea >= start and start_ea < end:
-            DEBUG("Data Range: {0:x} <= {1:x} < {2:x}".format(start, start_ea, end))
-            DEBUG("Data Range: {:x} - {:x}".format(start_ea, end_ea))
-            if end_ea <= end:
-                return True
-            else:
-                DEBUG("{0:x} NOT <= {1:x}".format(end_ea, end))
-                DEBUG("{0:x}-{1:x} overlaps with: {2:x}-{3:x}".format(start_ea, end_ea, start, end))
-                raise Exception("Overlapping data segments!")
+    index = DATA_SEGMENT_INDEX.find(start_ea)
+    if index != -1:
+        start = DATA_SEGMENT_INDEX.starts[index]
+        end = DATA_SEGMENT_INDEX.ends[index]
+        DEBUG("Data Range: {0:x} <= {1:x} < {2:x}", start, start_ea, end)
+        DEBUG("Data Range: {:x} - {:x}", start_ea, end_ea)
+        if end_ea <= end:
+            return True
         else:
-            if end_ea > start and end_ea <= end:
-                DEBUG("Overlaps with: {0:x}-{1:x}".format(start, end))
-                raise Exception("Overlapping data segments!")
+            DEBUG("{0:x} NOT <= {1:x}", end_ea, end)
+            DEBUG("{0:x}-{1:x} overlaps with: {2:x}-{3:x}", start_ea, end_ea, start, end)
+            raise Exception("Overlapping data segments!")
+
+    # Does the end of the range land inside of some segment?
+    index = bisect.bisect_left(DATA_SEGMENT_INDEX.starts, end_ea) - 1
+    if index >= 0 and end_ea <= DATA_SEGMENT_INDEX.ends[index]:
+        DEBUG("Overlaps with: {0:x}-{1:x}",
+            DATA_SEGMENT_INDEX.starts[index], DATA_SEGMENT_INDEX.ends[index])
+        raise Exception("Overlapping data segments!")
 
     return False
 
@@ -600,7 +1161,7 @@ def sanityCheckJumpTableSize(table_ea, ecount):
 
     table_insn = idautils.DecodeInstruction(table_ea)
     if table_insn is None:
-        DEBUG("Could not decode instruction at {:x}".format(table_insn))
+        DEBUG("Could not decode instruction at {:x}", table_insn)
         return ecount
 
     # This code is only reached if we *already know this is a jump table
@@ -610,7 +1171,7 @@ def sanityCheckJumpTableSize(table_ea, ecount):
     if table_insn.Operands[0].type != idc.o_reg:
         return ecount
 
-    DEBUG("Sanity checking table at {:x}".format(table_ea))
+    DEBUG("Sanity checking table at {:x}", table_ea)
 
     # get register we jump with
     jmp_reg = table_insn.Operands[0].value
@@ -646,83 +1207,188 @@ def sanityCheckJumpTableSize(table_ea, ecount):
                     new_count = 1 + inst.Operands[1].value
                     # compare to ecount. Take the bigger value.
                     if new_count > ecount:
-                        DEBUG("Overriding old JMP count of {} with {} for table at {:x}".format(ecount, new_count, table_ea))
+                        DEBUG("Overriding old JMP count of {} with {} for table at {:x}", ecount, new_count, table_ea)
                         return new_count
             return ecount
 
     return ecount
 
+class JumpTable(object):
+    """The decoded entries of a jump table used by the jump at `ea`."""
+
+    __slots__ = ('ea', 'element_size', 'base', 'entries')
+
+    def __init__(self, ea, element_size, base, entries):
+        self.ea = ea
+        self.element_size = element_size
+        self.base = base
+        self.entries = entries
+
+def decodeJumpTable(ea, si):
+    """Read all entries of the jump table described by the switch info `si`
+    in one go. The entry count is sanity checked, and offset-based entries
+    are rebased."""
+    esize = si.get_jtable_element_size()
+    if esize not in (4, 8):
+        raise Exception("Jump table is not a valid size: {}".format(esize))
+
+    base = si.jumps
+    count = si.get_jtable_size()
+    count = sanityCheckJumpTableSize(ea, count)
+
+    fmt = "<{}{}".format(count, {4: "L", 8: "Q"}[esize])
+    entries = struct.unpack(fmt, readBytes(base, base+count*esize))
+
+    # check if this is an offset based jump table
+    if si.flags & idaapi.SWI_ELBASE == idaapi.SWI_ELBASE:
+        entries = tuple(je + si.elbase for je in entries)
+
+    return JumpTable(ea, esize, base, entries)
+
+def registerJumpTable(ea, si):
+    """Decode and remember the jump table used by the jump at `ea`, and
+    mark its entries as being accessed via a JMP."""
+    table = decodeJumpTable(ea, si)
+    JUMP_TABLES[ea] = table
+    for i in xrange(len(table.entries)):
+        fulladdr = table.base+i*table.element_size
+        DEBUG("Address accessed via JMP: {:x}", fulladdr)
+        ACCESSED_VIA_JMP.add(fulladdr)
+    return table
+
+def getJumpTable(ea):
+    """Returns the `JumpTable` used by the jump at `ea`, or `None`. Tables
+    are normally found by `preprocessBinary`, but this falls back on asking
+    IDA for jumps that weren't code back then."""
+    table = JUMP_TABLES.get(ea)
+    if table is None:
+        si = idaapi.get_switch_info_ex(ea)
+        if si:
+            table = decodeJumpTable(ea, si)
+            JUMP_TABLES[ea] = table
+    return table
+
+def resetJumpTables():
+    JUMP_TABLES.clear()
+    ACCESSED_VIA_JMP.clear()
+
 def handleJmpTable(I, inst, new_eas):
-    si = idaapi.get_switch_info_ex(inst)
-    jsize = si.get_jtable_element_size()
-    jstart = si.jumps
+    table = getJumpTable(inst)
+    jsize = table.element_size
+    jstart = table.base
 
     # accept 32-bit jump tables in 64-bit, for now
     valid_sizes = [4, getBitness()/8]
-    readers = { 4: readDword,
-                8: readQword }
 
     if jsize not in valid_sizes:
         raise Exception("Jump table is not a valid size: {}".format(jsize))
         return
 
-    DEBUG("\tJMPTable Start: {0:x}".format(jstart))
-    seg_start = idc.SegStart(jstart)
+    DEBUG("\tJMPTable Start: {0:x}", jstart)
+    seg = findSegment(jstart)
 
-    if seg_start != idc.BADADDR:
-        I.jump_table.offset_from_data = jstart - seg_start
-        DEBUG("\tJMPTable offset from data: {:x}".format(I.jump_table.offset_from_data))
+    if seg is not None:
+        I.jump_table.offset_from_data = jstart - seg.start
+        DEBUG("\tJMPTable offset from data: {:x}", I.jump_table.offset_from_data)
 
     I.jump_table.zero_offset = 0
-    i = 0
-    entries = si.get_jtable_size()
-    entries = sanityCheckJumpTableSize(inst, entries)
-    for i in xrange(entries):
-        je = readers[jsize](jstart+i*jsize)
-        # check if this is an offset based jump table
-        if si.flags & idaapi.SWI_ELBASE == idaapi.SWI_ELBASE:
-            je += si.elbase
-
+    for i, je in enumerate(table.entries):
         I.jump_table.table_entries.append(je)
         if je not in RECOVERED_EAS and isStartOfFunction(je):
             new_eas.add(je)
 
-        DEBUG("\t\tAdding JMPTable {0}: {1:x}".format(i, je))
+        DEBUG("\t\tAdding JMPTable {0}: {1:x}", i, je)
     #je = idc.GetFixupTgtOff(jstart+i*jsize)
     #while je != -1:
     #    I.jump_table.table_entries.append(je)
     #    if je not in RECOVERED_EAS:
     #        new_eas.add(je)
-    #    DEBUG("\t\tAdding JMPTable {0}: {1:x}".format( i, je))
+    #    DEBUG("\t\tAdding JMPTable {0}: {1:x}",  i, je)
     #    i += 1
     #    je = idc.GetFixupTgtOff(jstart+i*jsize)
 
-def isElfThunk(ea):
-    if not isLinkedElf():
-        return False, None
+# Sections of the PLT stubs of a linked ELF, and of the GOT slots that the
+# stubs jump through.
+ELF_PLT_SECTIONS = (".plt", ".plt.got", ".plt.sec")
+ELF_GOT_SECTIONS = (".got.plt",)
+
+# Maps the address of each thunk (e.g. a PLT stub) to the name of the import
+# that it jumps to, or to `None` if the address isn't a thunk. Built by
+# `buildElfThunks`; thunks outside of the PLT sections are added as they are
+# found.
+ELF_THUNKS = None
 
+# Maps the GOT slots in `ELF_GOT_SECTIONS` to the imports that they hold.
+ELF_GOT_NAMES = {}
+
+def resolveElfThunk(ea, got_names):
+    """Returns the name of the import that the jump at `ea` goes to, or
+    `None`. `got_names` maps GOT slots to the imports that they hold."""
     insn_t, _ = _decode_instruction(ea)
-    if isUnconditionalJump(insn_t):
-        real_ext_ref = None
+    if not insn_t or not isUnconditionalJump(insn_t):
+        return None
 
-        for cref in idautils.CodeRefsFrom(ea, 0):
-            if isExternalReference(cref):
-                real_ext_ref = cref
-                break
+    for cref in idautils.CodeRefsFrom(ea, 0):
+        if isExternalReference(cref):
+            return getFunctionName(cref)
 
-        if real_ext_ref is None:
-            for dref in idautils.DataRefsFrom(ea):
-                if idc.SegName(dref) in [".got.plt"]:
-                    # this is an external call after all
-                    for extref in idautils.DataRefsFrom(dref):
-                        if isExternalReference(extref):
-                            real_ext_ref = extref
+    # this is an external call after all if it goes through the GOT
+    fn = None
+    for dref in idautils.DataRefsFrom(ea):
+        if dref in got_names:
+            fn = got_names[dref]
+    return fn
 
-        if real_ext_ref is not None:
-            fn = getFunctionName(real_ext_ref)
-            return True, fn
+def getGotNames():
+    """Returns the names of the imports held by the GOT slots."""
+    got_names = {}
+    for seg in getSegments():
+        if seg.name not in ELF_GOT_SECTIONS:
+            continue
+        for slot in idautils.Heads(seg.start, seg.end):
+            for extref in idautils.DataRefsFrom(slot):
+                if isExternalReference(extref):
+                    got_names[slot] = getFunctionName(extref)
+    return got_names
+
+def buildElfThunks():
+    """Resolve every stub in the PLT sections to the import that it jumps to,
+    in one pass over the PLT and GOT."""
+    global ELF_THUNKS, ELF_GOT_NAMES
+    ELF_GOT_NAMES = getGotNames()
+    ELF_THUNKS = {}
+    for seg in getSegments():
+        if seg.name not in ELF_PLT_SECTIONS:
+            continue
+        for head in idautils.Heads(seg.start, seg.end):
+            if idc.isCode(idc.GetFlags(head)):
+                ELF_THUNKS[head] = resolveElfThunk(head, ELF_GOT_NAMES)
+    reportElfThunks()
+
+def reportElfThunks():
+    """Log the thunks that have been resolved so far."""
+    thunks = sorted((ea, fn) for ea, fn in ELF_THUNKS.iteritems() if fn)
+    INFO("Resolved {} ELF thunks", len(thunks))
+    for ea, fn in thunks:
+        DEBUG("  {:x} => {}", ea, fn)
+
+def resetElfThunks():
+    global ELF_THUNKS, ELF_GOT_NAMES
+    ELF_THUNKS = None
+    ELF_GOT_NAMES = {}
+
+def isElfThunk(ea):
+    if not isLinkedElf():
+        return False, None
 
-    return False, None
+    if ELF_THUNKS is None:
+        buildElfThunks()
+
+    if ea not in ELF_THUNKS:
+        ELF_THUNKS[ea] = resolveElfThunk(ea, ELF_GOT_NAMES)
+
+    fn = ELF_THUNKS[ea]
+    return fn is not None, fn
 
 def manualRelocOffset(I, inst, dref):
     insn_t = idautils.DecodeInstruction(inst)
@@ -775,7 +1441,7 @@ def opAtOffset(insn_t, off):
             if op.type in [idaapi.o_imm, idaapi.o_mem, idaapi.o_near, idaapi.o_far]:
                 return "IMM"
 
-            DEBUG("ERROR: Unknown op type {}, assuming MEM".format(op.type))
+            ERROR("ERROR: Unknown op type {}, assuming MEM", op.type)
             return "MEM"
 
     return None
@@ -788,7 +1454,7 @@ def setReference(I, optype, reftype, ref):
         I.mem_reference = ref
         I.mem_ref_type = reftype
     else:
-        DEBUG("ERROR: Unknown ref type: {}".format(optype))
+        ERROR("ERROR: Unknown ref type: {}", optype)
 
 def addDataReference(M, I, inst, dref, new_eas):
     if inValidSegment(dref):
@@ -800,16 +1466,16 @@ def addDataReference(M, I, inst, dref, new_eas):
             fn = handleExternalRef(fn)
             if isExternalData(fn):
                 I.ext_data_name = fn
-                DEBUG("EXTERNAL DATA REF FROM {0:x} to {1}".format(inst, fn))
+                DEBUG("EXTERNAL DATA REF FROM {0:x} to {1}", inst, fn)
             else:
                 I.ext_call_name = fn
-                DEBUG("EXTERNAL CODE REF FROM {0:x} to {1}".format(inst, fn))
+                DEBUG("EXTERNAL CODE REF FROM {0:x} to {1}", inst, fn)
 
             return
 
         which_op = manualRelocOffset(I, inst, dref)
         if which_op is None:
-            DEBUG("ERROR: could not decode instruction at {:x}".format(inst))
+            ERROR("ERROR: could not decode instruction at {:x}", inst)
             return
 
         ref = None
@@ -821,18 +1487,18 @@ def addDataReference(M, I, inst, dref, new_eas):
                 new_eas.add(dref)
         else:
             dref_size = idc.ItemSize(dref)
-            DEBUG("\t\tData Ref: {0:x}, size: {1}".format(
-                dref, dref_size))
+            DEBUG("\t\tData Ref: {0:x}, size: {1}",
+                dref, dref_size)
             ref = handleDataRelocation(M, dref, new_eas)
             reftype = CFG_pb2.Instruction.DataRef
 
 
-        DEBUG("\t\tSetting {} ref at {:x}: to {:x} type: {}".format(
-            which_op, inst, ref, ReftypeString(reftype)))
+        DEBUG("\t\tSetting {} ref at {:x}: to {:x} type: {}",
+            which_op, inst, ref, ReftypeString(reftype))
         setReference(I, which_op, reftype, ref)
 
     else:
-        DEBUG("WARNING: Data not in valid segment {0:x}".format(dref))
+        WARNING("WARNING: Data not in valid segment {0:x}", dref)
 
 def instructionHandler(M, B, addr, new_eas):
     insn_t, inst_bytes = _decode_instruction(addr)
@@ -849,8 +1515,8 @@ def instructionHandler(M, B, addr, new_eas):
     if isHlt(insn_t):
         return None, False
 
-    #DEBUG("\t\tinst: {0}".format(idc.GetDisasm(addr)))
-    #DEBUG("\t\tBytes: {0}".format(inst_bytes))
+    #DEBUG("\t\tinst: {0}", idc.GetDisasm(addr))
+    #DEBUG("\t\tBytes: {0}", inst_bytes)
 
     I = addInst(B, addr, insn_t, inst_bytes)
 
@@ -862,7 +1528,7 @@ def instructionHandler(M, B, addr, new_eas):
     # mark that this is an offset table
     if PIE_MODE and addr in OFFSET_TABLES:
         table_va = OFFSET_TABLES[addr].start_addr
-        DEBUG("JMP at {:08x} has offset table {:08x}".format(addr, table_va))
+        DEBUG("JMP at {:08x} has offset table {:08x}", addr, table_va)
         I.offset_table_addr = table_va
 
     crefs_from_here = idautils.CodeRefsFrom(addr, 0)
@@ -883,12 +1549,12 @@ def instructionHandler(M, B, addr, new_eas):
     # this is a call $+5, needs special handling
     if insn_t.itype == idaapi.NN_call and insn_t.Op1.addr == next_ea:
         selfCallEA = next_ea
-        DEBUG("INTERNAL CALL to next instruction: {0:x}".format(selfCallEA))
+        DEBUG("INTERNAL CALL to next instruction: {0:x}", selfCallEA)
         DEBUG("LOCAL NORETURN CALL!")
         I.local_noreturn = True
 
         if selfCallEA not in RECOVERED_EAS:
-            DEBUG("Adding new EA: {0:x}".format(selfCallEA))
+            DEBUG("Adding new EA: {0:x}", selfCallEA)
             new_eas.add(selfCallEA)
             I.mem_reference = selfCallEA
             I.mem_ref_type = CFG_pb2.Instruction.CodeRef
@@ -896,7 +1562,7 @@ def instructionHandler(M, B, addr, new_eas):
             return I, True
 
     for cref in crefs:
-        DEBUG("Checking code ref {:x}".format(cref))
+        DEBUG("Checking code ref {:x}", cref)
         had_refs = True
         fn = getFunctionName(cref)
         if is_call:
@@ -904,12 +1570,12 @@ def instructionHandler(M, B, addr, new_eas):
             elfy, fn_replace = isElfThunk(cref)
             if elfy:
                 fn = fn_replace
-                DEBUG("Found external call via ELF thunk {:x} => {}".format(cref, fn_replace))
+                DEBUG("Found external call via ELF thunk {:x} => {}", cref, fn_replace)
 
             if isExternalReference(cref) or elfy:
                 fn = handleExternalRef(fn)
                 I.ext_call_name = fn
-                DEBUG("EXTERNAL CALL: {0}".format(fn))
+                DEBUG("EXTERNAL CALL: {0}", fn)
 
                 if doesNotReturn(fn):
                     return I, True
@@ -920,19 +1586,19 @@ def instructionHandler(M, B, addr, new_eas):
                 if cref not in RECOVERED_EAS:
                     new_eas.add(cref)
 
-                DEBUG("INTERNAL CALL: {0}".format(fn))
+                DEBUG("INTERNAL CALL: {0}", fn)
 
         elif isUnconditionalJump(insn_t):
             if isExternalReference(cref):
                 fn = handleExternalRef(fn)
                 I.ext_call_name = fn
-                DEBUG("EXTERNAL JMP: {0}".format(fn))
+                DEBUG("EXTERNAL JMP: {0}", fn)
 
                 if doesNotReturn(fn):
                     DEBUG("Nonreturn JMP")
                     return I, True
             else:
-                DEBUG("INTERNAL JMP: {0:x}".format(cref))
+                DEBUG("INTERNAL JMP: {0:x}", cref)
                 I.true_target = cref
 
     #true: jump to where we have a code-ref
@@ -955,11 +1621,11 @@ def instructionHandler(M, B, addr, new_eas):
 
         # don't overwrite an offset set by other means
         if "IMM" == which_op and not I.HasField("imm_reloc_offset"):
-            DEBUG("findRelocOffset setting imm reloc offset at {0:x} to {1:x}".format(addr, relo_off))
+            DEBUG("findRelocOffset setting imm reloc offset at {0:x} to {1:x}", addr, relo_off)
             I.imm_reloc_offset = relo_off
 
         if "MEM" == which_op and not I.HasField("mem_reloc_offset"):
-            DEBUG("findRelocOffset setting mem reloc offset at {0:x} to {1:x}".format(addr, relo_off))
+            DEBUG("findRelocOffset setting mem reloc offset at {0:x} to {1:x}", addr, relo_off)
             I.mem_reloc_offset = relo_off
 
     drefs_from_here = idautils.DataRefsFrom(addr)
@@ -967,18 +1633,18 @@ def instructionHandler(M, B, addr, new_eas):
         had_refs = True
         if dref in crefs:
             continue
-        DEBUG("Adding reference because of data refs from {:x}".format(addr))
+        DEBUG("Adding reference because of data refs from {:x}", addr)
         addDataReference(M, I, addr, dref, new_eas)
         if isUnconditionalJump(insn_t):
             xdrefs = idautils.DataRefsFrom(dref)
             for xref in xdrefs:
-                DEBUG("xref : {0:x}".format(xref))
+                DEBUG("xref : {0:x}", xref)
                 # check if it refers to come instructions; link Control flow
                 if isExternalReference(xref):
                    fn = getFunctionName(xref)
                    fn = handleExternalRef(fn)
                    I.ext_call_name = fn
-                   DEBUG("EXTERNAL CALL : {0}".format(fn))
+                   DEBUG("EXTERNAL CALL : {0}", fn)
 
     if isLinkedElf() and not PIE_MODE:
         for op in insn_t.Operands:
@@ -1000,65 +1666,125 @@ def instructionHandler(M, B, addr, new_eas):
 WEAK_SYMS = set()
 OS_NAME = ""
 
-def parseDefsFile(df):
-    global OS_NAME, WEAK_SYMS
-    emap = {}
-    emap_data = {}
-    is_linux = OS_NAME == "linux"
-    for l in df.readlines():
-        #skip comments / empty lines
-        l = l.strip()
-        if not l or l[0] == "#":
-            continue
+# Calling conventions of the functions in definitions files.
+CALLING_CONVENTIONS = {
+    "C": CFG_pb2.ExternalFunction.CallerCleanup,
+    "E": CFG_pb2.ExternalFunction.CalleeCleanup,
+    "F": CFG_pb2.ExternalFunction.FastCall,
+    "M": CFG_pb2.ExternalFunction.McsemaCall}
+
+# Compiled definitions databases that have been opened, keyed by the path
+# of their definitions file.
+DEFS_DATABASES = {}
+
+def openDefsDatabase(defs_file):
+    """Open the compiled database of `defs_file`, compiling it if it is
+    missing or out of date."""
+    db = DEFS_DATABASES.get(defs_file)
+    if db is None:
+        DEBUG("Loading Standard Definitions file: {0}", defs_file)
+        db = defsdb.open_defs(defs_file)
+        DEFS_DATABASES[defs_file] = db
+    return db
+
+class DefsMap(object):
+    """Maps names to their definitions in compiled definitions databases (see
+    `defsdb.py`). Names are looked up on demand, and the results (including
+    misses) are memoized. The databases themselves are only opened once the
+    first name is looked up. Later `defs_files` take precedence."""
+
+    def __init__(self, lookup, defs_files):
+        self._lookup = lookup
+        self._defs_files = list(defs_files)
+        self._memo = {}
+
+    def _find(self, name):
+        try:
+            return self._memo[name]
+        except KeyError:
+            pass
 
-        if l.startswith('DATA:'):
-            # process as data
-            (marker, symname, dsize) = l.split()
-            if 'PTR' in dsize:
-                dsize = getPointerSize()
-            emap_data[symname] = int(dsize)
+        value = None
+        for defs_file in reversed(self._defs_files):
+            value = self._lookup(openDefsDatabase(defs_file), name)
+            if value is not None:
+                break
+        self._memo[name] = value
+        return value
 
-        else:
-            fname = args = conv = ret = sign = None
-            line_args = l.split()
-            if len(line_args) == 2:
-                fname, conv = line_args
-                if conv == "MCSEMA":
-                    DEBUG("Found mcsema internal function: {}".format(fname))
-                    realconv = CFG_pb2.ExternalFunction.McsemaCall
-                    emap[fname] = (1, realconv, 'N', None)
-                    continue
-                else:
-                    raise Exception("Unknown calling convention:"+str(conv))
-
-            if len(line_args) == 4:
-                (fname, args, conv, ret) = line_args
-            elif len(line_args) == 5:
-                (fname, args, conv, ret, sign) = line_args
-
-            if conv == "C":
-                realconv = CFG_pb2.ExternalFunction.CallerCleanup
-            elif conv == "E":
-                realconv = CFG_pb2.ExternalFunction.CalleeCleanup
-            elif conv == "F":
-                realconv = CFG_pb2.ExternalFunction.FastCall
-            else:
-                raise Exception("Unknown calling convention:"+str(l))
+    def __contains__(self, name):
+        return self._find(name) is not None
 
-            if ret not in ['Y', 'N']:
-                raise Exception("Unknown return type:"+ret)
+    def __getitem__(self, name):
+        value = self._find(name)
+        if value is None:
+            raise KeyError(name)
+        return value
 
-            emap[fname] = (int(args), realconv, ret, sign)
+def _lookupFunctionDef(db, name):
+    entry = db.function(name)
 
-            if is_linux:
-                imp_name = "__imp_{}".format(fname)
-                emap[imp_name] = emap[fname]
-                WEAK_SYMS.add(imp_name)
+    # On Linux, `__imp_foo` is a weak alias of every defined `foo`.
+    if entry is None and OS_NAME == "linux" and name.startswith("__imp_"):
+        entry = db.function(name[len("__imp_"):])
+        if entry is not None:
+            WEAK_SYMS.add(name)
 
+    if entry is None:
+        return None
 
-    df.close()
+    args, conv, ret, sign = entry
+    if conv == "M":
+        DEBUG("Found mcsema internal function: {}", name)
+    return (args, CALLING_CONVENTIONS[conv], ret, sign)
+
+def _lookupDataDef(db, name):
+    size = db.data(name)
+    if size == defsdb.POINTER_SIZE:
+        size = getPointerSize()
+    return size
+
+def loadDefsFiles(defs_files):
+    """Look up external functions and data in `defs_files`. Nothing is read
+    until a name is looked up; see `loadImportedDefs`."""
+    global EMAP, EMAP_DATA
+    EMAP = DefsMap(_lookupFunctionDef, defs_files)
+    EMAP_DATA = DefsMap(_lookupDataDef, defs_files)
+
+def getImportedNames():
+    """Returns the names of everything that the binary imports, according to
+    IDA's import list and the names in its external segments."""
+    names = set()
+
+    def add_import(ea, name, ordinal):
+        if name:
+            names.add(name)
+        return True
 
-    return emap, emap_data
+    for i in xrange(idaapi.get_import_module_qty()):
+        idaapi.enum_import_names(i, add_import)
+
+    for seg_ea in idautils.Segments():
+        if idc.GetSegmentAttr(seg_ea, idc.SEGATTR_TYPE) != idc.SEG_XTRN:
+            continue
+        for head in idautils.Heads(seg_ea, idc.SegEnd(seg_ea)):
+            name = idc.Name(head)
+            if name:
+                names.add(name)
+
+    return names
+
+def loadImportedDefs():
+    """Look up the definitions of the binary's imports up front, in sorted
+    order, so that the binary searches walk the databases front to back.
+    Names that are only referenced later are looked up when they are
+    needed."""
+    names = sorted(set(fixExternalName(name) for name in getImportedNames()))
+    found = 0
+    for name in names:
+        if name in EMAP or name in EMAP_DATA:
+            found += 1
+    INFO("Found definitions for {} of {} imported names", found, len(names))
 
 def processExternalFunction(M, fn):
     global WEAK_SYMS
@@ -1067,7 +1793,7 @@ def processExternalFunction(M, fn):
     ea = idc.LocByName(fn)
     is_weak = idaapi.is_weak_name(ea) or fn in WEAK_SYMS
 
-    DEBUG("Program will reference external{}: {}".format(" (weak)" if is_weak else "", fn))
+    DEBUG("Program will reference external{}: {}", " (weak)" if is_weak else "", fn)
     extfn = M.external_funcs.add()
     extfn.symbol_name = fn
     extfn.calling_convention = conv
@@ -1086,7 +1812,7 @@ def processExternalData(M, dt):
     ea = idc.LocByName(dt)
     is_weak = idaapi.is_weak_name(ea)
 
-    DEBUG("Program will reference external{}: {}".format(" (weak)" if is_weak else "", dt))
+    DEBUG("Program will reference external{}: {}", " (weak)" if is_weak else "", dt)
 
     extdt = M.external_data.add()
     extdt.symbol_name = dt
@@ -1095,27 +1821,170 @@ def processExternalData(M, dt):
 
 def processExternals(M):
 
-    for fn in EXTERNALS:
+    for fn in sorted(EXTERNALS):
         fixedn = fixExternalName(fn)
         if nameInMap(EMAP, fixedn):
             processExternalFunction(M, fixedn)
         elif nameInMap(EMAP_DATA, fixedn):
             processExternalData(M, fixedn)
         else:
-            DEBUG("UNKNOWN API: {0}".format(fixedn))
-
-def readBytesSlowly(start, end):
-    bytestr = ""
-    for i in xrange(start, end):
-        if idc.hasValue(idc.GetFlags(i)):
-            bt = idc.Byte(i)
-            bytestr += chr(bt)
+            DEBUG("UNKNOWN API: {0}", fixedn)
+
+# Snapshots of segment contents, keyed by segment start address. A segment is
+# read out of the database in bulk the first time that any of its bytes are
+# requested, and all later reads are served from the snapshot.
+SEGMENT_SNAPSHOTS = {}
+
+# Every segment in the database, sorted by start address, used to find the
+# segment containing an address without asking IDA.
+SegmentInfo = collections.namedtuple(
+    'SegmentInfo', ['start', 'end', 'type', 'perm', 'name'])
+SEGMENTS = []
+SEGMENT_STARTS = []
+
+class SegmentSnapshot(object):
+    """The bytes of a single segment. Bytes that don't have a value in the
+    database (e.g. `.bss`, or a virtual size that is bigger than the size on
+    disk) are zero-filled."""
+
+    __slots__ = ('start', 'end', 'data')
+
+    def __init__(self, start, end, seg_type=None):
+        self.start = start
+        self.end = end
+
+        # Nothing in a `.bss` segment has a value, so don't go looking.
+        if seg_type == idc.SEG_BSS:
+            chunks = [(start, end, None)]
         else:
-            #virtual size may be bigger than size on disk
-            #pad with nulls
-            #DEBUG("Failed on {0:x}".format(i))
-            bytestr += "\x00"
-    return bytestr
+            chunks = readInitializedChunks(start, end)
+
+        parts = []
+        for chunk_start, chunk_end, chunk in chunks:
+            if chunk is None:
+                chunk = "\x00" * (chunk_end - chunk_start)
+            parts.append(chunk)
+        self.data = "".join(parts)
+
+def _hasValue(flags):
+    return (flags & idaapi.FF_IVL) != 0
+
+def _hasNoValue(flags):
+    return (flags & idaapi.FF_IVL) == 0
+
+def findRunEnd(ea, end, has_value):
+    """Returns the first address in `(ea, end)` whose byte doesn't have a
+    value if `has_value` is true, or does have one otherwise. Returns `end`
+    if there is no such address. IDA does the search; only the flags are
+    passed back to us, so no other API calls are made."""
+    test = _hasNoValue if has_value else _hasValue
+    next_ea = idaapi.nextthat(ea, end, test)
+    if next_ea == idc.BADADDR or next_ea > end:
+        return end
+    return next_ea
+
+def readInitializedChunks(start, end):
+    """Read `[start, end)` out of the database in as few calls as possible.
+    Returns an ordered list of `(start, end, bytes)` chunks covering the whole
+    range, where `bytes` is `None` for bytes that don't have a value. A range
+    that can't be read in one go is split into runs of bytes that do, and
+    that don't, have values; each run costs a few calls, whatever its size."""
+    if start >= end:
+        return []
+
+    chunk = idaapi.get_many_bytes(start, end - start)
+    if chunk is not None:
+        return [(start, end, chunk)]
+
+    chunks = []
+    ea = start
+    while ea < end:
+        has_value = idc.hasValue(idc.GetFlags(ea))
+        run_end = findRunEnd(ea, end, has_value)
+        chunk = None
+        if has_value:
+            chunk = idaapi.get_many_bytes(ea, run_end - ea)
+        chunks.append((ea, run_end, chunk))
+        ea = run_end
+
+    return chunks
+
+def resetSegmentSnapshots():
+    """Forget all cached segment contents and bounds. Needed if the database
+    may have changed since the last recovery (e.g. in the IDA plugin)."""
+    global SEGMENTS, SEGMENT_STARTS
+    SEGMENT_SNAPSHOTS.clear()
+    SEGMENTS = []
+    SEGMENT_STARTS = []
+
+def getSegments():
+    global SEGMENTS, SEGMENT_STARTS
+    if not SEGMENTS:
+        for seg_ea in idautils.Segments():
+            seg = idaapi.getseg(seg_ea)
+            SEGMENTS.append(SegmentInfo(
+                seg_ea,
+                idc.SegEnd(seg_ea),
+                idc.GetSegmentAttr(seg_ea, idc.SEGATTR_TYPE),
+                seg.perm,
+                idc.SegName(seg_ea)))
+        SEGMENTS.sort()
+        SEGMENT_STARTS = [info.start for info in SEGMENTS]
+    return SEGMENTS
+
+def findSegment(ea):
+    """Returns the `SegmentInfo` of the segment containing `ea`, or `None` if
+    `ea` isn't in any segment."""
+    segments = getSegments()
+    index = bisect.bisect_right(SEGMENT_STARTS, ea) - 1
+    if index < 0 or ea >= segments[index].end:
+        return None
+    return segments[index]
+
+def getSegmentSnapshot(ea):
+    """Returns the snapshot of the segment containing `ea`, or `None` if `ea`
+    isn't in any segment."""
+    seg = findSegment(ea)
+    if seg is None:
+        return None
+
+    snap = SEGMENT_SNAPSHOTS.get(seg.start)
+    if snap is None:
+        DEBUG("Reading segment {} ({:x} - {:x})",
+            seg.name, seg.start, seg.end)
+        snap = SegmentSnapshot(seg.start, seg.end, seg.type)
+        SEGMENT_SNAPSHOTS[seg.start] = snap
+    return snap
+
+def readBytes(start, end):
+    """Read the bytes in `[start, end)`. Bytes without a value in the database
+    are read as zeros, as are bytes that aren't inside of any segment."""
+    parts = []
+    ea = start
+    while ea < end:
+        snap = getSegmentSnapshot(ea)
+        if snap is not None:
+            next_ea = min(snap.end, end)
+            parts.append(snap.data[ea - snap.start:next_ea - snap.start])
+        else:
+            # Pad up to the next segment, if any.
+            index = bisect.bisect_right(SEGMENT_STARTS, ea)
+            next_ea = end
+            if index < len(SEGMENT_STARTS):
+                next_ea = min(SEGMENT_STARTS[index], end)
+            parts.append("\x00" * (next_ea - ea))
+        ea = next_ea
+
+    return "".join(parts)
+
+def unpackBytes(fmt, size, ea):
+    """Unpack a `size`-byte `struct` format `fmt` from `ea`."""
+    snap = getSegmentSnapshot(ea)
+    if snap is not None and ea + size <= snap.end:
+        return struct.unpack_from(fmt, snap.data, ea - snap.start)[0]
+
+    # Straddles a segment boundary, or is outside of any segment.
+    return struct.unpack(fmt, readBytes(ea, ea+size))[0]
 
 def handleDataRelocation(M, dref, new_eas):
     dref_size = idc.ItemSize(dref)
@@ -1163,8 +2032,62 @@ def relocationSize(reloc_type):
     return reloc_size
 
 
+class FixupIndex(object):
+    """Every fixup in the database, as parallel arrays sorted by EA. This is
+    built with a single walk over the fixups, and then answers questions
+    about them with a binary search instead of a call into IDA."""
+
+    def __init__(self):
+        self.eas = []
+        self.types = []
+        self.targets = []
+        self.displs = []
+
+        ea = idc.GetFirstFixupEA()
+        while ea != idc.BADADDR:
+            self.eas.append(ea)
+            self.types.append(idc.GetFixupTgtType(ea))
+            self.targets.append(idc.GetFixupTgtOff(ea))
+            self.displs.append(idc.GetFixupTgtDispl(ea))
+            ea = idc.GetNextFixupEA(ea)
+
+        DEBUG("Indexed {} fixups", len(self.eas))
+
+    def find(self, ea):
+        """Returns the index of the fixup at `ea`, or -1."""
+        index = bisect.bisect_left(self.eas, ea)
+        if index < len(self.eas) and self.eas[index] == ea:
+            return index
+        return -1
+
+    def next(self, ea):
+        """Returns the index of the first fixup at or after `ea`. This is
+        `len(self.eas)` if there is no such fixup."""
+        return bisect.bisect_left(self.eas, ea)
+
+FIXUPS = None
+
+def getFixups():
+    global FIXUPS
+    if FIXUPS is None:
+        FIXUPS = FixupIndex()
+    return FIXUPS
+
+def resetFixups():
+    global FIXUPS
+    FIXUPS = None
+
+def getFixup(ea):
+    """Returns the `(type, target, displacement)` of the fixup at `ea`. These
+    are all -1 if there is no fixup at `ea`."""
+    fixups = getFixups()
+    index = fixups.find(ea)
+    if index == -1:
+        return -1, -1, -1
+    return fixups.types[index], fixups.targets[index], fixups.displs[index]
+
 def resolveRelocation(ea):
-    rtype = idc.GetFixupTgtType(ea)
+    rtype, rtarget, rdispl = getFixup(ea)
 
     relocSize = -1
     relocVal = -1
@@ -1173,15 +2096,15 @@ def resolveRelocation(ea):
         if rtype == -1:
             raise Exception("No relocation type at ea: {:x}".format(ea))
 
-        DEBUG("rtype : {0:x}, {1:x}, {2:x}".format(rtype, idc.GetFixupTgtOff(ea), idc.GetFixupTgtDispl(ea)))
-        relocVal = idc.GetFixupTgtDispl(ea) +  idc.GetFixupTgtOff(ea)
+        DEBUG("rtype : {0:x}, {1:x}, {2:x}", rtype, rtarget, rdispl)
+        relocVal = rdispl + rtarget
     else:
         if rtype == idc.FIXUP_OFF32:
             relocVal = readDword(ea)
         elif rtype == -1:
             raise Exception("No relocation type at ea: {:x}".format(ea))
         else:
-            relocVal = idc.GetFixupTgtOff(ea)
+            relocVal = rtarget
 
     relocSize = relocationSize(rtype)
     return relocVal, relocSize
@@ -1196,20 +2119,20 @@ def insertRelocatedSymbol(M, D, reloc_dest, offset, seg_offset, new_eas, itemsiz
     if itemsize == -1:
         itemsize = int(idc.ItemSize(offset))
 
-    DEBUG("Offset: {0:x}, seg_offset: {1:x} => {2:x}".format(offset, seg_offset, reloc_dest))
-    DEBUG("Reloc Base Address: {0:x}".format(DS.base_address))
-    DEBUG("Reloc size: {0:x}".format(itemsize))
+    DEBUG("Offset: {0:x}, seg_offset: {1:x} => {2:x}", offset, seg_offset, reloc_dest)
+    DEBUG("Reloc Base Address: {0:x}", DS.base_address)
+    DEBUG("Reloc size: {0:x}", itemsize)
 
     if isExternalReference(reloc_dest):
         ext_fn = getFunctionName(reloc_dest)
         ext_fn = handleExternalRef(ext_fn)
-        DEBUG("External ref from data at {:x} => {}".format(reloc_dest, ext_fn))
+        DEBUG("External ref from data at {:x} => {}", reloc_dest, ext_fn)
         DS.symbol_name = "ext_{}".format(ext_fn)
         DS.symbol_size = itemsize
     elif idc.isCode(pf):
         DS.symbol_name = "sub_{0:x}".format(reloc_dest)
         DS.symbol_size = itemsize
-        DEBUG("Code Ref: {0:x}!".format(reloc_dest))
+        DEBUG("Code Ref: {0:x}!", reloc_dest)
 
         if reloc_dest not in RECOVERED_EAS:
             new_eas.add(reloc_dest)
@@ -1264,11 +2187,11 @@ def processTable(ea, size):
         for jea in xrange(start, end, readsize):
             pword = read_option(jea)
             if isSaneReference(pword):
-                DEBUG("Sane table entry at: {:x}".format(pword))
+                DEBUG("Sane table entry at: {:x}", pword)
             elif pword == 0:
-                DEBUG("Ignoring NULL entry in possible table: {:x}".format(jea))
+                DEBUG("Ignoring NULL entry in possible table: {:x}", jea)
             else:
-                DEBUG("NOT a table entry at {:x}".format(jea))
+                DEBUG("NOT a table entry at {:x}", jea)
                 return False, table_map, readsize
 
             table_map[jea] = pword
@@ -1282,50 +2205,83 @@ def processTable(ea, size):
 
     return did_find, table, readsz
 
-def parseSingleStruct(ea, idastruct):
-    DEBUG("Parsing idastruct at {:x}".format(ea))
+# Offsets of the pointer-sized members of each structure type, keyed by the
+# type's `tid`. Structure layouts don't change, so they are only asked of
+# IDA once, no matter how many instances of a structure there are.
+STRUCT_POINTER_OFFSETS = {}
+
+def getStructPointerOffsets(tid):
+    """Returns the sorted offsets of the pointer-sized members of the
+    structure type `tid`."""
+    offsets = STRUCT_POINTER_OFFSETS.get(tid)
+    if offsets is not None:
+        return offsets
+
     # get first member offset
-    first_off = idc.GetFirstMember(idastruct.tid);
+    first_off = idc.GetFirstMember(tid);
 
     # get last member offset
-    last_off = idc.GetLastMember(idastruct.tid)
+    last_off = idc.GetLastMember(tid)
 
     # get starting offsets of all members
-    ptrs = {}
     members = set()
-
-    read_size = getPointerSize()
-    read_option = {4 : readDword,
-                   8 : readQword}[read_size]
-
     for i in xrange(first_off, last_off+1):
-        mn = idc.GetMemberName(idastruct.tid, i)
+        mn = idc.GetMemberName(tid, i)
         # skip padding bytes
         if mn is not None:
             members.add(mn)
 
+    offsets = set()
     for member in members:
-        DEBUG("Checking idastruct member: {}".format(member))
-        member_off = idc.GetMemberOffset(idastruct.tid, member)
+        member_off = idc.GetMemberOffset(tid, member)
         assert member_off != -1
         # get element size
-        member_sz = idc.GetMemberSize(idastruct.tid, member_off)
+        member_sz = idc.GetMemberSize(tid, member_off)
         assert member_sz > 0
 
         #if its pointer size, check for ptr
-        if member_sz == read_size:
-            DEBUG("\tit is pointer sized")
-            # check if points to sanity
-            member_ea = ea+member_off
-            pword = read_option(member_ea)
-            if isSaneReference(pword):
-                DEBUG("\tAdding reference from {:x} => {:x}".format(member_ea, pword))
-                ptrs[member_ea] = pword
-            else:
-                DEBUG("\tNot a sane reference ({:x})".format(pword))
-
-
-    return len(ptrs) != 0, ptrs, getPointerSize()
+        if member_sz == getPointerSize():
+            DEBUG("\tstruct member {} at offset {} is pointer sized", member, member_off)
+            offsets.add(member_off)
+
+    offsets = tuple(sorted(offsets))
+    STRUCT_POINTER_OFFSETS[tid] = offsets
+    return offsets
+
+def resetStructLayouts():
+    STRUCT_POINTER_OFFSETS.clear()
+
+def unpackStrided(data, offset, stride, count, size):
+    """Unpack `count` little-endian words of `size` bytes from `data`. The
+    first is at `offset`, and each is `stride` bytes after the last."""
+    if numpy is not None:
+        return numpy.ndarray(
+            (count,), dtype="<u{}".format(size), buffer=data, offset=offset,
+            strides=(stride,)).tolist()
+
+    code = {4: "L", 8: "Q"}[size]
+    fmt = "<" + code + "{}x{}".format(stride - size, code) * (count - 1)
+    return struct.unpack_from(fmt, data, offset)
+
+def inReferenceRanges(words):
+    """Returns which of `words` hold an address that a pointer could refer to
+    (see `getReferenceRanges`)."""
+    starts, ends = getReferenceRanges()
+    if not starts:
+        return [False] * len(words)
+
+    if numpy is not None:
+        words = numpy.array(words, dtype=numpy.uint64)
+        index = numpy.searchsorted(
+            numpy.array(starts, dtype=numpy.uint64), words, side="right") - 1
+        ends = numpy.array(ends, dtype=numpy.uint64)
+        return ((index >= 0) & (words < ends[index])).tolist()
+
+    in_ranges = []
+    for word in words:
+        index = bisect.bisect_right(starts, word) - 1
+        in_ranges.append(index >= 0 and word < ends[index])
+    return in_ranges
 
 def getStructType(ea):
     """
@@ -1347,7 +2303,7 @@ def processStruct(ea, size):
     # get struct size
     idastruct = getStructType(ea)
     if idastruct is None:
-        DEBUG("Could not get structure size at: {:x}".format(ea))
+        DEBUG("Could not get structure size at: {:x}", ea)
         return False, {}, 0
 
     struct_size = idc.GetStrucSize(idastruct.tid)
@@ -1357,13 +2313,23 @@ def processStruct(ea, size):
 
     all_ptrs = {}
 
+    offsets = getStructPointerOffsets(idastruct.tid)
+    if not offsets:
+        return True, all_ptrs, getPointerSize()
+
+    # Read the pointer-sized members of every element of the array at once.
     num_iters = size / struct_size
-    for i in xrange(num_iters):
-        # parse a single struct
-        start_ea = ea + (i * struct_size)
-        worked, ptrs, ptrsize = parseSingleStruct(start_ea, idastruct)
-        if worked:
-            all_ptrs.update(ptrs)
+    data = readBytes(ea, ea + size)
+    for member_off in offsets:
+        pwords = unpackStrided(
+            data, member_off, struct_size, num_iters, getPointerSize())
+        for i, (pword, maybe_ptr) in enumerate(
+                zip(pwords, inReferenceRanges(pwords))):
+            member_ea = ea + (i * struct_size) + member_off
+            # check if points to sanity
+            if maybe_ptr and isSaneReference(pword):
+                DEBUG("\tAdding reference from {:x} => {:x}", member_ea, pword)
+                all_ptrs[member_ea] = pword
 
     return True, all_ptrs, getPointerSize()
 
@@ -1375,13 +2341,13 @@ def processDataChunk(ea, size):
     # Get chunk type
     # if its a string, skip it
     if IsString(ea):
-        DEBUG("Found a string at {:x}".format(ea))
+        DEBUG("Found a string at {:x}", ea)
         return False, {}, 0
     elif IsStruct(ea):
-        DEBUG("Found a struct at {:x}".format(ea))
+        DEBUG("Found a struct at {:x}", ea)
         return processStruct(ea, size)
     else:
-        DEBUG("Found an unknown blob at {:x}, treating as table".format(ea))
+        DEBUG("Found an unknown blob at {:x}, treating as table", ea)
         return processTable(ea, size)
 
 #referenced from
@@ -1390,14 +2356,35 @@ def sign_extend(value, bits):
     sign_bit = 1 << (bits - 1)
     return (value & (sign_bit - 1)) - (value & sign_bit)
 
-def checkIfOffsetTable(ea):
+# Offset table entries are unpacked this many at a time.
+OFFSET_TABLE_CHUNK_SIZE = 64
+
+def readOffsetTableEntries(ea, limit):
+    """Yield the `(address, dword)` entries of a possible offset table at `ea`,
+    up to `limit` or the end of the segment. Entries are unpacked in bulk
+    from the segment's snapshot."""
+    snap = getSegmentSnapshot(ea)
+    if snap is None:
+        return
+
+    end = min(limit, snap.end)
+    entry_va = ea
+    while entry_va + 4 <= end:
+        count = min(OFFSET_TABLE_CHUNK_SIZE, (end - entry_va) / 4)
+        for entry in struct.unpack_from(
+                "<{}L".format(count), snap.data, entry_va - snap.start):
+            yield entry_va, entry
+            entry_va += 4
+
+def checkIfOffsetTable(ea, limit):
     """
     Check if this is an offset table: that is, a table
     off offsets that when added to table base result
-    in the VA of a jump target
+    in the VA of a jump target. The table can't extend
+    past `limit`.
     """
 
-    DEBUG("LOOKING FOR OFFSET TABLE AT: {:08x}".format(ea))
+    DEBUG("LOOKING FOR OFFSET TABLE AT: {:08x}", ea)
     # preconditions
     # can only really do this when all sections are
     # correctly based
@@ -1426,9 +2413,7 @@ def checkIfOffsetTable(ea):
     # 1: EA + EA[n] = beginning of an instruction
     entrycount = 0
     entries = []
-    while True:
-        entry_va = ea+entrycount*4
-        entry = readDword(entry_va)
+    for entry_va, entry in readOffsetTableEntries(ea, limit):
         # no null entries
         if entry == 0:
             break
@@ -1436,7 +2421,7 @@ def checkIfOffsetTable(ea):
         if entrycount > 0:
             refs_to_entry = list(idautils.DataRefsTo(entry_va))
             if len(refs_to_entry) > 0:
-                DEBUG("\tfound other references {} to table entry {} (@ {:x}).".format(refs_to_entry, entrycount, entry_va))
+                DEBUG("\tfound other references {} to table entry {} (@ {:x}).", refs_to_entry, entrycount, entry_va)
                 break
 
         dest_guess = ea + sign_extend(entry, 64)
@@ -1444,11 +2429,11 @@ def checkIfOffsetTable(ea):
         # has to point to code and to the
         # start of an instruction
         if isInternalCode(dest_guess) and isSaneReference(dest_guess):
-            DEBUG("\tAdded destination: {:08x}".format(dest_guess))
+            DEBUG("\tAdded destination: {:08x}", dest_guess)
             entries.append(dest_guess)
             entrycount += 1
         else:
-            DEBUG("\tInvalid destination: {:08x}".format(dest_guess))
+            DEBUG("\tInvalid destination: {:08x}", dest_guess)
             # invalid entry
             break
 
@@ -1490,12 +2475,12 @@ def createOffsetTable(M, table_start, table_entries):
                 # is it a jump?
                 next_insn_t, _ = _decode_instruction(cur_head)
                 if next_insn_t and isUnconditionalJump(next_insn_t):
-                    DEBUG("Found follow unconditional jump at {:08x}".format(cur_head))
+                    DEBUG("Found follow unconditional jump at {:08x}", cur_head)
                     # is it a JMP?
                     jmp_reg = idc.GetOpnd(cur_head, 0)
                     if jmp_reg == dest_reg:
                         # yes: add EA of JMP REG ot jmp_refs
-                        DEBUG("Found JMP using offset table {:08x} at {:08x}".format(table_start, cur_head))
+                        DEBUG("Found JMP using offset table {:08x} at {:08x}", table_start, cur_head)
                         jmp_refs.add(cur_head)
                 cur_head = idc.NextHead(cur_head)
         else:
@@ -1506,72 +2491,179 @@ def createOffsetTable(M, table_start, table_entries):
 
     return jmp_refs
 
-def scanDataForRelocs(M, D, start, end, new_eas, seg_offset):
-    i = start
-    while i < end:
-        if PIE_MODE:
-            (is_table, ecount, entries) = checkIfOffsetTable(i)
-            if is_table:
-                DEBUG("FOUND AN OFFSET TABLE AT: {:08x}".format(i))
-                DEBUG("Table has {} destinations:".format(ecount))
-                for e in entries:
-                    DEBUG("\t{:08x}".format(e))
-                    # these may be the only references to certain
-                    # code islands. Make sure we recover them
-                    #if e not in RECOVERED_EAS:
-                    #    new_eas.add(e)
-
-                refs = createOffsetTable(M, i, entries)
-                for ref in refs:
-                    for e in set(entries):
-                        DEBUG("Adding Offset Table XREF {} => {}".format(ref, e))
-                        idc.AddCodeXref(ref, e, idc.XREF_USER|idc.fl_F)
-
-                i += (4 * ecount) - 1
+def getReferenceRanges():
+    """Returns the sorted starts and ends of the merged address ranges that a
+    pointer in data could refer to: every segment, and every data segment."""
+    ranges = [(info.start, info.end) for info in getSegments()]
+    ranges.extend(zip(DATA_SEGMENT_INDEX.starts, DATA_SEGMENT_INDEX.ends))
+    ranges.sort()
+
+    starts = []
+    ends = []
+    for start, end in ranges:
+        if start >= end:
+            continue
+        if ends and start <= ends[-1]:
+            ends[-1] = max(ends[-1], end)
+        else:
+            starts.append(start)
+            ends.append(end)
+    return starts, ends
+
+# `array` type codes of unsigned integers, keyed by their size in bytes.
+ARRAY_TYPECODES = dict((array.array(code).itemsize, code) for code in "BHIL")
+
+def _findWordsInRangesNumpy(data, count, size, starts, ends, found):
+    """Mark `found[offset]` for every `offset < count` at which the `size`-byte
+    word in `data` falls in one of the ranges."""
+    starts = numpy.array(starts, dtype=numpy.uint64)
+    ends = numpy.array(ends, dtype=numpy.uint64)
+    dtype = numpy.dtype("<u{}".format(size))
+    for shift in xrange(min(size, count)):
+        num_words = (count - shift + size - 1) // size
+        words = numpy.frombuffer(
+            data, dtype=dtype, count=num_words, offset=shift).astype(numpy.uint64)
+        index = numpy.searchsorted(starts, words, side="right") - 1
+        found[shift::size] |= (index >= 0) & (words < ends[index])
+
+def _findWordsInRangesArray(data, count, size, starts, ends, found):
+    """Like `_findWordsInRangesNumpy`, using `array` (or `struct` if there is
+    no `array` type of `size` bytes)."""
+    typecode = ARRAY_TYPECODES.get(size)
+    lowest, highest = starts[0], ends[-1]
+    for shift in xrange(min(size, count)):
+        num_words = (count - shift + size - 1) // size
+        chunk = data[shift:shift + num_words * size]
+        if typecode is not None:
+            words = array.array(typecode, chunk)
+            if sys.byteorder != "little":
+                words.byteswap()
+        else:
+            words = struct.unpack("<{}{}".format(
+                num_words, {4: "L", 8: "Q"}[size]), chunk)
+
+        offset = shift
+        for word in words:
+            if lowest <= word < highest:
+                index = bisect.bisect_right(starts, word) - 1
+                if word < ends[index]:
+                    found[offset] = True
+            offset += size
+
+def findPointerCandidates(start, end, sizes):
+    """Returns the sorted addresses in `[start, end)` at which a little-endian
+    word of one of `sizes` bytes holds an address inside of a segment. Words
+    at every offset, aligned or not, are checked in bulk (with NumPy, if it is
+    available)."""
+    starts, ends = getReferenceRanges()
+    count = end - start
+    if not starts or count <= 0:
+        return []
+
+    data = readBytes(start, end + max(sizes) - 1)
+    if numpy is not None:
+        found = numpy.zeros(count, dtype=bool)
+        for size in sizes:
+            _findWordsInRangesNumpy(data, count, size, starts, ends, found)
+        return [start + int(offset) for offset in numpy.flatnonzero(found)]
+
+    found = [False] * count
+    for size in sizes:
+        _findWordsInRangesArray(data, count, size, starts, ends, found)
+    return [start + offset for offset in xrange(count) if found[offset]]
+
+def scanDataForPointers(start, end):
+    """Make references out of the untyped words in `[start, end)` that look
+    like pointers to code or data. Only words that hold an address inside of
+    some segment (see `findPointerCandidates`) are checked against IDA."""
+    if getBitness() == 64:
+        sizes = (8, 4)
+    else:
+        sizes = (4,)
+
+    for i in findPointerCandidates(start, end, sizes):
+        # Only item heads are checked; this skips over the rest of existing
+        # items, and of the words made by earlier iterations.
+        if idc.ItemHead(i) != i:
+            continue
 
         more_dref = [d for d in idautils.DataRefsFrom(i)]
         dref_size = idc.ItemSize(i) or 1
-        if len(more_dref) == 0 and dref_size == 1 and not PIE_MODE:
-            DEBUG("Testing address: {0:x}... ".format(i))
-
-            # try to read a qword first, then fall back on dword
-            inc_size = 1
-            if getBitness() == 64:
-                pword = readQword(i)
-                make_word = idc.MakeQword
-                inc_size = 8
-                if not isSaneReference(pword):
-                    pword = readDword(i)
-                    make_word = idc.MakeDword
-                    inc_size = 4
-            else:
-                make_word = idc.MakeDword
+        if len(more_dref) != 0 or dref_size != 1:
+            continue
+
+        DEBUG("Testing address: {0:x}... ", i)
+
+        # try to read a qword first, then fall back on dword
+        if getBitness() == 64:
+            pword = readQword(i)
+            make_word = idc.MakeQword
+            if not isSaneReference(pword):
                 pword = readDword(i)
-                inc_size = 4
+                make_word = idc.MakeDword
+        else:
+            make_word = idc.MakeDword
+            pword = readDword(i)
 
-            # check for unmakred references
+        # check for unmakred references
 
-            #TODO(artem) possibly add check that do more reference sanity
-            # checking, such as if pword falls in the middle of a string
-            if isInData(pword, pword+1):# and idc.ItemHead(pword) == pword:
-                if make_word(i):
-                    idc.add_dref(i, pword, idc.XREF_USER|idc.dr_O)
-                    DEBUG("making New Data Reference at: {0:x} => {1:x}".format(i, pword))
-                    dref_size = inc_size
-                else:
-                    DEBUG("WARNING: Could not make reference at {:x}".format(i))
-            # check if code and points to the beginning of an instruction
-            elif isInternalCode(pword) and idc.ItemHead(pword) == pword:
-                if make_word(i):
-                    idc.AddCodeXref(i, pword, idc.XREF_USER|idc.fl_F)
-                    DEBUG("making New Code Reference at: {0:x} => {1:x}".format(i, pword))
-                    dref_size = inc_size
-                else:
-                    DEBUG("WARNING: Could not make reference at {:x}".format(i))
+        #TODO(artem) possibly add check that do more reference sanity
+        # checking, such as if pword falls in the middle of a string
+        if isInData(pword, pword+1):# and idc.ItemHead(pword) == pword:
+            if make_word(i):
+                idc.add_dref(i, pword, idc.XREF_USER|idc.dr_O)
+                DEBUG("making New Data Reference at: {0:x} => {1:x}", i, pword)
             else:
-                DEBUG("not code or data ref")
+                WARNING("WARNING: Could not make reference at {:x}", i)
+        # check if code and points to the beginning of an instruction
+        elif isInternalCode(pword) and idc.ItemHead(pword) == pword:
+            if make_word(i):
+                add_code_xref(i, pword, idc.XREF_USER|idc.fl_F)
+                DEBUG("making New Code Reference at: {0:x} => {1:x}", i, pword)
+            else:
+                WARNING("WARNING: Could not make reference at {:x}", i)
+        else:
+            DEBUG("not code or data ref")
+
+def scanDataForOffsetTables(M, start, end):
+    """Look for offset tables in `[start, end)`. Tables are only looked for
+    at the addresses loaded by `lea` instructions (see `LEA_TARGETS`), as
+    that is how the code that uses a table finds it."""
+    targets = sorted(ea for ea in LEA_TARGETS if start <= ea < end)
+    next_ea = start
+    for index, i in enumerate(targets):
+        if i < next_ea or idc.ItemHead(i) != i:
+            continue
 
-        i += dref_size
+        # Another `lea` target can't be inside of this table.
+        limit = end
+        if index + 1 < len(targets):
+            limit = targets[index + 1]
+
+        (is_table, ecount, entries) = checkIfOffsetTable(i, limit)
+        if is_table:
+            DEBUG("FOUND AN OFFSET TABLE AT: {:08x}", i)
+            DEBUG("Table has {} destinations:", ecount)
+            for e in entries:
+                DEBUG("\t{:08x}", e)
+                # these may be the only references to certain
+                # code islands. Make sure we recover them
+                #if e not in RECOVERED_EAS:
+                #    new_eas.add(e)
+
+            refs = createOffsetTable(M, i, entries)
+            for ref in refs:
+                for e in set(entries):
+                    DEBUG("Adding Offset Table XREF {} => {}", ref, e)
+                    add_code_xref(ref, e, idc.XREF_USER|idc.fl_F)
+
+            next_ea = i + (4 * ecount)
+
+def scanDataForRelocs(M, D, start, end, new_eas, seg_offset):
+    if PIE_MODE:
+        scanDataForOffsetTables(M, start, end)
+    else:
+        scanDataForPointers(start, end)
 
     def insertReference(M, D, ea, pointsto, seg_offset, new_eas, force_size=None):
         # do not make code references for mid-function code accessed via a JMP --
@@ -1580,28 +2672,28 @@ def scanDataForRelocs(M, D, start, end, new_eas, seg_offset):
         if ea in ACCESSED_VIA_JMP and not isStartOfFunction(pointsto):
             # bail only if we are access via JMP and not the start
             # of a function
-            DEBUG("\t\tNOT ADDING REF: {:08x} -> {:08x}".format(ea, pointsto))
+            DEBUG("\t\tNOT ADDING REF: {:08x} -> {:08x}", ea, pointsto)
             return
 
-        DEBUG("\t\tFound a probable ref from: {0:x} => {1:x}".format(ea, pointsto))
+        DEBUG("\t\tFound a probable ref from: {0:x} => {1:x}", ea, pointsto)
         real_size = idc.ItemSize(pointsto)
         if force_size is None:
             reloc_size = idc.ItemSize(ea)
         else:
             reloc_size = force_size
-        DEBUG("\t\tReal Ref: {0:x}, reloc size: {2}, ref size: {1}".format(pointsto, real_size, reloc_size))
+        DEBUG("\t\tReal Ref: {0:x}, reloc size: {2}, ref size: {1}", pointsto, real_size, reloc_size)
         insertRelocatedSymbol(M, D, pointsto, ea, seg_offset, new_eas, reloc_size)
 
 
     i = start
     while i < end:
-        DEBUG("Checking address: {:x}".format(i))
+        DEBUG("Checking address: {:x}", i)
         dref_size = idc.ItemSize(i) or 1
         if dref_size > getPointerSize():
-            DEBUG("Possible table/struct data at {:x}; size: {:x}".format(i, dref_size))
+            DEBUG("Possible table/struct data at {:x}; size: {:x}", i, dref_size)
             (found, addrs, entry_size) = processDataChunk(i, dref_size)
             if found:
-                DEBUG("Its a table/struct, adding {} references".format(len(addrs)))
+                DEBUG("Its a table/struct, adding {} references", len(addrs))
                 for ta in sorted(addrs.keys()):
                     if addrs[ta] != 0:
                         insertReference(M, D, ta, addrs[ta], seg_offset, new_eas, force_size=entry_size)
@@ -1614,16 +2706,16 @@ def scanDataForRelocs(M, D, start, end, new_eas, seg_offset):
                 dw = readDword(i+4)
                 if dw == 0:
                     if idc.MakeQword(i):
-                        DEBUG("Making qword from 32-bit dref at {:x}".format(i))
+                        DEBUG("Making qword from 32-bit dref at {:x}", i)
                         dref_size = 8
                     else:
-                        DEBUG("WARNING: Failed at make qword at {:x}, ignoring ref".format(i))
+                        WARNING("WARNING: Failed at make qword at {:x}, ignoring ref", i)
                         dref_size = 4
                         i += dref_size
                         continue
 
                 else:
-                    DEBUG("WARNING: could not make qword from 32-bit dref at {:x}, ignoring ref".format(i))
+                    WARNING("WARNING: could not make qword from 32-bit dref at {:x}, ignoring ref", i)
                     dref_size = 4
                     i += dref_size
                     continue
@@ -1638,11 +2730,11 @@ def scanDataForRelocs(M, D, start, end, new_eas, seg_offset):
             # do this check since IDA is crazy and sometimes returns data
             # references > 0xff00000000000000
             if len(more_dref) > 0 and more_dref[0] < 0xff00000000000000:
-                DEBUG("\t\tFound a probable ref from: {0:x} => {1:x}".format(i, more_dref[0]))
+                DEBUG("\t\tFound a probable ref from: {0:x} => {1:x}", i, more_dref[0])
                 if len(more_dref) == 1:
                     insertReference(M, D, i, more_dref[0], seg_offset, new_eas)
                 else:
-                    DEBUG("\t\tWARNING: Possible data ref problem");
+                    WARNING("\t\tWARNING: Possible data ref problem");
                     insertReference(M, D, i, more_dref[0], seg_offset, new_eas)
 
         i += dref_size
@@ -1652,11 +2744,12 @@ def processRelocationsInData(M, D, start, end, new_eas, seg_offset):
     if start == 0:
         start = 1
 
-    i = idc.GetNextFixupEA(start-1)
+    fixups = getFixups()
+    index = fixups.next(start)
 
-    DEBUG("Looking for relocations in {:x} - {:x}".format(start, end))
+    DEBUG("Looking for relocations in {:x} - {:x}", start, end)
 
-    if i == idc.BADADDR or i > end:
+    if index == len(fixups.eas) or fixups.eas[index] > end:
         if isLinkedElf():
             DEBUG("No relocations in binary, scanning for data references");
             # no fixups, do manual reloc searching
@@ -1664,10 +2757,11 @@ def processRelocationsInData(M, D, start, end, new_eas, seg_offset):
         else:
             DEBUG("Not scanning data sections of object file for pointer-alikes")
     else:
-        DEBUG("Found relocations in binary: ({:x})..".format(i))
-        while i < end and i != idc.BADADDR:
+        i = fixups.eas[index]
+        DEBUG("Found relocations in binary: ({:x})..", i)
+        while i < end:
             pointsto, itemsize = resolveRelocation(i)
-            DEBUG("{0:x} Found reloc to: {1:x} (size: {2:x})".format(i, pointsto, itemsize))
+            DEBUG("{0:x} Found reloc to: {1:x} (size: {2:x})", i, pointsto, itemsize)
 
             if not isExternalReference(pointsto):
                 # do not add references in jump tables....
@@ -1675,27 +2769,27 @@ def processRelocationsInData(M, D, start, end, new_eas, seg_offset):
                 if i in ACCESSED_VIA_JMP and not isStartOfFunction(pointsto):
                     # bail only if we are access via JMP and not the start
                     # of a function
-                    DEBUG("\t\tNOT ADDING REF: {:08x} -> {:08x}".format(i, pointsto))
+                    DEBUG("\t\tNOT ADDING REF: {:08x} -> {:08x}", i, pointsto)
                 else:
                     insertRelocatedSymbol(M, D, pointsto, i, seg_offset, new_eas, itemsize)
             else:
-                DEBUG("{:x} is an external reference".format(i))
+                DEBUG("{:x} is an external reference", i)
                 insertRelocatedSymbol(M, D, pointsto, i, seg_offset, new_eas, itemsize)
 
-            i = idc.GetNextFixupEA(i)
+            index += 1
+            if index == len(fixups.eas):
+                break
+            i = fixups.eas[index]
 
 def inValidSegment(ea):
-    if idc.SegStart(ea) == idc.BADADDR:
+    if findSegment(ea) is None:
         return False
 
     return True
 
 def findFreeData():
 
-    max_end = 0
-    for (start, end) in DATA_SEGMENTS.values():
-        if end > max_end:
-            max_end = end
+    max_end = DATA_SEGMENT_INDEX.max_end
 
     if idc.__EA64__ is True:
         return max_end+8
@@ -1706,7 +2800,7 @@ def addDataSegment(start, end):
     if end < start:
         raise Exception("Start must be before end")
 
-    seg = idaapi.getseg(start)
+    seg = findSegment(start)
 
     if not seg:
         raise Exception("Data must be in a valid segment")
@@ -1718,18 +2812,40 @@ def addDataSegment(start, end):
     if need_move:
         free_data = findFreeData()
         seg_offset = free_data - start
-        DEBUG("Data Segment {0:x} moved to: {1:x}".format(start, start+seg_offset))
+        DEBUG("Data Segment {0:x} moved to: {1:x}", start, start+seg_offset)
+
+    old_range = DATA_SEGMENTS.get( (start, end,) )
+    if old_range is not None:
+        DATA_SEGMENT_INDEX.remove(*old_range)
 
+    DATA_SEGMENT_INDEX.add(start+seg_offset, end+seg_offset)
     DATA_SEGMENTS[ (start, end,) ] = (start+seg_offset, end+seg_offset,)
 
-    DEBUG("Adding data seg: {0}: {1}-{2}".format(
-        idc.SegName(start),
+    DEBUG("Adding data seg: {0}: {1}-{2}",
+        seg.name,
         hex(start+seg_offset),
-        hex(end+seg_offset)))
+        hex(end+seg_offset))
 
     return seg_offset
 
 def populateDataSegment(M, start, end, new_eas):
+    global _POPULATE_DEPTH
+
+    # Data segments found through a function's references are part of the
+    # cost of recovering that function.
+    cost = _CURRENT_FUNCTION_COST
+    start_time = time.time()
+    _POPULATE_DEPTH += 1
+    try:
+        return _populateDataSegment(M, start, end, new_eas)
+    finally:
+        _POPULATE_DEPTH -= 1
+        if cost is not None:
+            cost.data_segments += 1
+            if not _POPULATE_DEPTH:
+                cost.data_time += time.time() - start_time
+
+def _populateDataSegment(M, start, end, new_eas):
 
     (new_start, new_end) = DATA_SEGMENTS.get( (start, end,), (-1,-1) )
 
@@ -1743,20 +2859,20 @@ def populateDataSegment(M, start, end, new_eas):
 
     SEGPERM_WRITE = 2
 
-    seg = idaapi.getseg(start)
+    seg = findSegment(start)
     if (seg.perm & SEGPERM_WRITE) == 0:
         D.read_only = True
     else:
         D.read_only = False
 
-    D.data = readBytesSlowly(start, end)
+    D.data = readBytes(start, end)
 
     processRelocationsInData(M, D, start, end, new_eas, seg_offset)
 
-    DEBUG("Adding data seg: {0}: {1}-{2}".format(
-        idc.SegName(start),
+    DEBUG("Adding data seg: {0}: {1}-{2}",
+        seg.name,
         hex(new_start),
-        hex(new_end)))
+        hex(new_end))
 
     return seg_offset
 
@@ -1777,7 +2893,7 @@ def recoverFunctionFromSet(M, F, blockset, new_eas):
         block = blockset.pop()
 
         if block.startEA == block.endEA:
-            DEBUG("Zero sized block: {0:x}".format(block.startEA))
+            DEBUG("Zero sized block: {0:x}", block.startEA)
 
         if block.startEA in processed_blocks:
             raise Exception("Attempting to add same block twice: {0:x}".format(block.startEA))
@@ -1786,11 +2902,11 @@ def recoverFunctionFromSet(M, F, blockset, new_eas):
 
         B = basicBlockHandler(F, block, blockset, processed_blocks)
         prevHead = block.startEA
-        DEBUG("Starting insn at: {0:x}".format(prevHead))
+        DEBUG("Starting insn at: {0:x}", prevHead)
         for head in idautils.Heads(block.startEA, block.endEA):
             # we ended the function on a call
 
-            DEBUG("Processing insn at {:x}".format(head))
+            DEBUG("Processing insn at {:x}", head)
             I, endBlock = instructionHandler(M, B, head, new_eas)
             # sometimes there is junk after a terminator due to off-by-ones in
             # IDAPython. Ignore them.
@@ -1799,19 +2915,165 @@ def recoverFunctionFromSet(M, F, blockset, new_eas):
                 break
             prevHead = head
 
-        DEBUG("Ending insn at: {0:x}".format(prevHead))
+        DEBUG("Ending insn at: {0:x}", prevHead)
+
+# The cost of recovering each function, in the order that they were recovered.
+FUNCTION_COSTS = []
+_CURRENT_FUNCTION_COST = None
+_POPULATE_DEPTH = 0
+
+# How many of the most expensive functions to list in the log.
+FUNCTION_COST_TOP_N = 20
+
+class FunctionCost(object):
+    """How long it took to recover a function, and how much work it was.
+    `ida_decodes` counts the instructions that had to be decoded by IDA,
+    i.e. that weren't in the decode cache. `api_calls` counts all calls into
+    the IDA API, and is `None` unless they are counted (see
+    `enableApiCallCounter`). `data_time` is the part of
+    `elapsed` that was spent adding data segments referenced by the
+    function. `parent` is the function whose recovery found this one (see
+    `FunctionWorklist`)."""
+
+    __slots__ = ('ea', 'parent', 'elapsed', 'blocks', 'instructions',
+                 'ida_decodes', 'api_calls', 'new_eas', 'data_segments',
+                 'data_time')
+
+    def __init__(self, ea, parent=None):
+        self.ea = ea
+        self.parent = parent
+        self.elapsed = 0.0
+        self.blocks = 0
+        self.instructions = 0
+        self.ida_decodes = 0
+        self.api_calls = None
+        self.new_eas = 0
+        self.data_segments = 0
+        self.data_time = 0.0
+
+def resetFunctionCosts():
+    global _CURRENT_FUNCTION_COST, _POPULATE_DEPTH
+    del FUNCTION_COSTS[:]
+    _CURRENT_FUNCTION_COST = None
+    _POPULATE_DEPTH = 0
+
+def reportFunctionCosts(csv_path=None):
+    """Log the most expensive functions to recover, and optionally write the
+    costs of all functions to a CSV file."""
+    costs = sorted(FUNCTION_COSTS, key=lambda c: (-c.elapsed, c.ea))
+    if not costs:
+        return
+
+    INFO("Slowest {} of {} functions:",
+        min(FUNCTION_COST_TOP_N, len(costs)), len(costs))
+    INFO("  {:>16} {:>9} {:>9} {:>7} {:>7} {:>7} {:>9} {:>7}  {}",
+        "ea", "time (s)", "data (s)", "blocks", "insts", "decodes",
+        "api_calls", "new_eas", "name")
+    for c in costs[:FUNCTION_COST_TOP_N]:
+        api_calls = "-" if c.api_calls is None else c.api_calls
+        INFO("  {:>16x} {:>9.4f} {:>9.4f} {:>7} {:>7} {:>7} {:>9} {:>7}  {}",
+            c.ea, c.elapsed, c.data_time, c.blocks, c.instructions,
+            c.ida_decodes, api_calls, c.new_eas, getFunctionName(c.ea))
+
+    if csv_path:
+        with open(csv_path, "wb") as f:
+            writer = csv.writer(f)
+            writer.writerow(["ea", "name", "parent", "elapsed", "blocks",
+                             "instructions", "ida_decodes", "api_calls",
+                             "new_eas", "data_segments", "data_time"])
+            for c in costs:
+                parent = ""
+                if c.parent is not None:
+                    parent = "{:x}".format(c.parent)
+                writer.writerow(["{:x}".format(c.ea), getFunctionName(c.ea),
+                                 parent, "{:.6f}".format(c.elapsed), c.blocks,
+                                 c.instructions, c.ida_decodes, c.api_calls,
+                                 c.new_eas, c.data_segments,
+                                 "{:.6f}".format(c.data_time)])
+        DEBUG("Wrote function costs to {}", csv_path)
 
 def recoverFunction(M, F, fnea, new_eas):
-    blockset = getFunctionBlocks(fnea)
-    recoverFunctionFromSet(M, F, blockset, new_eas)
+    global _CURRENT_FUNCTION_COST
+    cost = FunctionCost(fnea, new_eas.parents.get(fnea))
+    new_eas.current = fnea
+    _CURRENT_FUNCTION_COST = cost
+    num_new_eas = len(new_eas)
+    num_decodes = _DECODE_CACHE_MISSES
+    num_api_calls = API_CALL_COUNTER and API_CALL_COUNTER.calls
+    start_time = time.time()
+    try:
+        blockset = getFunctionBlocks(fnea)
+        recoverFunctionFromSet(M, F, blockset, new_eas)
+    finally:
+        cost.elapsed = time.time() - start_time
+        cost.blocks = len(F.blocks)
+        cost.instructions = sum(len(B.insts) for B in F.blocks)
+        cost.ida_decodes = _DECODE_CACHE_MISSES - num_decodes
+        if API_CALL_COUNTER:
+            cost.api_calls = API_CALL_COUNTER.calls - num_api_calls
+        cost.new_eas = max(0, len(new_eas) - num_new_eas)
+        FUNCTION_COSTS.append(cost)
+        _CURRENT_FUNCTION_COST = None
 
 class Block:
     def __init__(self, startEA):
         self.startEA = startEA
         self.endEA = startEA
         self.succs = []
-
-def recoverBlock(startEA):
+        self.heads = []
+
+# Targets of (non-flow) code references anywhere in the binary. These are
+# where basic blocks must begin. The references are collected in the sweep
+# over every head done by `preprocessBinary`, and are kept up-to-date as we
+# add code references of our own.
+BLOCK_LEADERS = set()
+
+# Heads with code references other than their ordinary flow.
+CODE_REF_SOURCES = set()
+
+# Set when new code may have been analyzed since the sweep, and so the above
+# may be incomplete. We then go back to asking IDA.
+_BLOCK_LEADERS_STALE = False
+
+def addBlockLeaders(frm, targets):
+    if targets:
+        CODE_REF_SOURCES.add(frm)
+        BLOCK_LEADERS.update(targets)
+
+def markBlockLeadersStale():
+    global _BLOCK_LEADERS_STALE
+    _BLOCK_LEADERS_STALE = True
+
+def resetBlockLeaders():
+    global _BLOCK_LEADERS_STALE
+    BLOCK_LEADERS.clear()
+    CODE_REF_SOURCES.clear()
+    _BLOCK_LEADERS_STALE = False
+
+def isBlockLeader(ea):
+    """Does anything other than ordinary flow go to `ea`?"""
+    if _BLOCK_LEADERS_STALE:
+        return len(list(idautils.CodeRefsTo(ea, 0))) > 0
+    return ea in BLOCK_LEADERS
+
+def getCodeFollows(curEA, insn_t, nextEA):
+    """Returns the code references from `curEA`, including its ordinary flow
+    to `nextEA`, like `idautils.CodeRefsFrom(curEA, 1)` does. Most instructions
+    only flow to the next one, and we can tell which those are without asking
+    IDA for the references."""
+    if not _BLOCK_LEADERS_STALE and \
+       insn_t.personality == PERSONALITY_INVALID and \
+       len(insn_t.bytes) == insn_t.size and \
+       curEA not in CODE_REF_SOURCES:
+        if idc.isFlow(idc.GetFlags(nextEA)):
+            return [nextEA]
+        return []
+
+    return list(idautils.CodeRefsFrom(curEA, 1))
+
+def recoverBlock(startEA, block_starts=()):
+    """Recover the block beginning at `startEA`. The block is ended early if
+    it would run into the start of a block in `block_starts`."""
     b = Block(startEA)
     curEA = startEA
 
@@ -1822,22 +3084,43 @@ def recoverBlock(startEA):
                 b.endEA = curEA+1
                 return b
             else:
-                DEBUG("WARNING: Couldn't decode insn at: {0:x}. Ending block.".format(curEA))
+                WARNING("WARNING: Couldn't decode insn at: {0:x}. Ending block.", curEA)
                 b.endEA = curEA
                 return b
 
+        b.heads.append(curEA)
+
         # find EA of next inst
         nextEA = curEA+insn_t.size
 
-        crefs = idautils.CodeRefsFrom(curEA, 1)
-
-        # get curEA follows
-        follows = [cref for cref in crefs]
-
-        if follows == [nextEA] or isCall(insn_t):
-            # there is only one following branch, to the next instruction
-            # check if this is a JMP 0; in that case, make a new block
-            if isUnconditionalJump(insn_t):
+        if isCall(insn_t):
+            # calls don't end blocks
+            curEA = nextEA
+        else:
+            # get curEA follows
+            follows = getCodeFollows(curEA, insn_t, nextEA)
+
+            if follows == [nextEA]:
+                # there is only one following branch, to the next instruction
+                # check if this is a JMP 0; in that case, make a new block
+                if isUnconditionalJump(insn_t):
+                    b.endEA = nextEA
+                    for f in follows:
+                        # do not decode external code refs
+                        if not isExternalReference(f):
+                            b.succs.append(f)
+                    return b
+
+                # if its not JMP 0 or call 0,
+                # add next instruction to current block
+                curEA = nextEA
+            # check if we need to make a new block
+            elif len(follows) == 0:
+                # this is a ret, no follows
+                b.endEA = nextEA
+                return b
+            else:
+                # this block has several follow blocks
                 b.endEA = nextEA
                 for f in follows:
                     # do not decode external code refs
@@ -1845,49 +3128,58 @@ def recoverBlock(startEA):
                         b.succs.append(f)
                 return b
 
-            # if its not JMP 0 or call 0,
-            # add next instruction to current block
-            curEA = nextEA
-        # check if we need to make a new block
-        elif len(follows) == 0:
-            # this is a ret, no follows
-            b.endEA = nextEA
-            return b
-        else:
-            # this block has several follow blocks
-            b.endEA = nextEA
-            for f in follows:
-                # do not decode external code refs
-                if not isExternalReference(f):
-                    b.succs.append(f)
-            return b
-
         # right now we know this block has one follows
         # ...but does something else go there?
         # we may need to split the block anyway
-        orefs = idautils.CodeRefsTo(nextEA, 0)
-        # who else calls us?
-
-        orefs_list = [oref for oref in orefs]
-        if len(orefs_list) > 0:
+        if isBlockLeader(nextEA) or nextEA in block_starts:
             b.endEA = nextEA
             b.succs.append(nextEA)
             return b
 
         # else continue with instruction
 
+def splitBlock(block, ea):
+    """Split `block` at the instruction at `ea`, returning the new block that
+    begins at `ea`."""
+    index = block.heads.index(ea)
+
+    newb = Block(ea)
+    newb.endEA = block.endEA
+    newb.succs = block.succs
+    newb.heads = block.heads[index:]
+
+    block.endEA = ea
+    block.succs = [ea]
+    block.heads = block.heads[:index]
+    return newb
+
 def getFunctionBlocks(startea):
     to_recover = [startea]
 
     blocks = {}
 
+    # maps each recovered instruction to the start of its block
+    block_of = {}
+
     while len(to_recover) > 0:
         # get new block start to recover
         bstart = to_recover.pop()
-        # recover the block
-        newb = recoverBlock(bstart)
+        if bstart in blocks:
+            continue
+
+        if bstart in block_of:
+            # this lands inside of an already recovered block;
+            # split it instead of decoding the shared tail again
+            newb = splitBlock(blocks[block_of[bstart]], bstart)
+        else:
+            # recover the block
+            newb = recoverBlock(bstart, blocks)
+
         # save to our recovered block list
         blocks[newb.startEA] = newb
+        for head in newb.heads:
+            block_of[head] = newb.startEA
+
         # add new workers
         for fba in newb.succs:
             if fba not in blocks:
@@ -1900,61 +3192,146 @@ def getFunctionBlocks(startea):
 
     return rv
 
+# Addresses loaded by `lea reg, [rip+X]` instructions, found by the sweep
+# over every head in `preprocessBinary`. In PIE mode, these are the only
+# places where offset tables are looked for.
+LEA_TARGETS = set()
+
 def preprocessBinary():
     # loop through every instruction and
     # keep a list of jump tables references in the
     # data section. These are used so we can
     # avoid generating unwanted function entry points
+    LEA_TARGETS.clear()
     for seg_ea in idautils.Segments():
         segtype = idc.GetSegmentAttr(seg_ea, idc.SEGATTR_TYPE)
         if segtype in [idc.SEG_DATA, idc.SEG_BSS]:
             addDataSegment(seg_ea, idc.SegEnd(seg_ea))
 
+    # Jump table entries that IDA missed are marked as code in one batch at the
+    # end of each pass. That can create new code (with new switches in it), so
+    # keep going until a pass doesn't find anything new. Only the first pass
+    # sweeps the whole database; later ones visit just the new code.
+    seen_code = set()
+    begin_mutation_phase("preprocess")
+    for seg_ea in idautils.Segments():
         for head in idautils.Heads(seg_ea, idc.SegEnd(seg_ea)):
-            if idc.isCode(idc.GetFlags(head)):
-                si = idaapi.get_switch_info_ex(head)
-                insn_t, _ = _decode_instruction(head)
-                if si is not None and insn_t and isUnconditionalJump(insn_t):
-                    DEBUG("Found a jmp based switch at: {0:x}".format(head))
-                    esize = si.get_jtable_element_size()
-                    readers = { 4: readDword,
-                                8: readQword }
-                    base = si.jumps
-                    count = si.get_jtable_size()
-                    count = sanityCheckJumpTableSize(head, count)
-                    jmp_refs = set(idautils.CodeRefsFrom(head, 1))
-                    for i in xrange(count):
-                        fulladdr = base+i*esize
-                        DEBUG("Address accessed via JMP: {:x}".format(fulladdr))
-                        ACCESSED_VIA_JMP.add(fulladdr)
-                        je = readers[esize](fulladdr)
-                        if si.flags & idaapi.SWI_ELBASE == idaapi.SWI_ELBASE:
-                            je += si.elbase
-                        if je not in jmp_refs:
-                            jmp_refs.add(je)
-                            DEBUG("\t\tJMPTable entry not in original; adding ref {:x} => {:x}".format(head, je))
-                            idc.AddCodeXref(head, je, idc.XREF_USER|idc.fl_F)
-                            mark_as_code(je)
-            if PIE_MODE:
-                # convert all immediate operand location references to numbers
-                inslen = idaapi.decode_insn(head)
-                if inslen > 0:
-                    # check every op
-                    for i in range(len(idaapi.cmd.Operands)):
-                        # is this op an immediate?
-                        op = idaapi.cmd.Operands[i]
-                        if op.type == idc.o_imm:
-                            # ensure this is operand is a number, not reference
-                            idaapi.op_num(head, i)
-                            idaapi.del_dref(head, op.value)
-                            idaapi.del_cref(head, op.value, False)
-
-
-def recoverCfg(to_recover, outf, exports_are_apis=False):
+            preprocessHead(head, seen_code)
+    new_code = end_mutation_phase()
+
+    while new_code:
+        begin_mutation_phase("preprocess")
+        preprocessNewCode(new_code, seen_code)
+        new_code = end_mutation_phase()
+
+def preprocessNewCode(eas, seen_code):
+    """Preprocess the code that was made at `eas`, along with any code that
+    IDA's auto-analysis found by following it. Code that was already seen
+    isn't visited again."""
+    work = list(eas)
+    while work:
+        head = work.pop()
+        seg = findSegment(head)
+        if seg is None:
+            continue
+
+        while head != idc.BADADDR and head < seg.end and \
+              head not in seen_code and idc.isCode(idc.GetFlags(head)):
+            work.extend(preprocessHead(head, seen_code))
+            head = idc.NextHead(head, seg.end)
+
+def preprocessHead(head, seen_code):
+    """Look for jump tables and PIE references at `head`, and note the block
+    leaders it refers to. Returns the code that `head` refers to."""
+    if idc.isCode(idc.GetFlags(head)):
+        seen_code.add(head)
+        si = idaapi.get_switch_info_ex(head)
+        insn_t, _ = _decode_instruction(head)
+        if si is not None and insn_t and isUnconditionalJump(insn_t):
+            DEBUG("Found a jmp based switch at: {0:x}", head)
+            table = registerJumpTable(head, si)
+            jmp_refs = set(idautils.CodeRefsFrom(head, 1))
+            for je in table.entries:
+                if je not in jmp_refs:
+                    jmp_refs.add(je)
+                    DEBUG("\t\tJMPTable entry not in original; adding ref {:x} => {:x}", head, je)
+                    add_code_xref(head, je, idc.XREF_USER|idc.fl_F)
+                    mark_as_code(je)
+        if PIE_MODE and insn_t and insn_t.itype == idaapi.NN_lea and \
+           insn_t.Operands[0].type == idc.o_reg and \
+           insn_t.Operands[1].type == idc.o_mem:
+            LEA_TARGETS.add(insn_t.Operands[1].addr)
+    if PIE_MODE:
+        # convert all immediate operand location references to numbers
+        inslen = idaapi.decode_insn(head)
+        if inslen > 0:
+            # check every op
+            for i in range(len(idaapi.cmd.Operands)):
+                # is this op an immediate?
+                op = idaapi.cmd.Operands[i]
+                if op.type == idc.o_imm:
+                    # ensure this is operand is a number, not reference
+                    idaapi.op_num(head, i)
+                    idaapi.del_dref(head, op.value)
+                    idaapi.del_cref(head, op.value, False)
+
+    # sweep up block leaders
+    refs = list(idautils.CodeRefsFrom(head, 0))
+    addBlockLeaders(head, refs)
+    return refs
+
+
+class FunctionWorklist(object):
+    """The entry addresses of the functions that still need to be recovered.
+    Functions are recovered in address order, so that the database is read
+    front to back, and so that the CFG doesn't depend on the order in which
+    functions happened to be found. `parents` maps each function to the one
+    whose recovery found it (`current` when it was added), or to `None` if
+    it was found outside of any function, e.g. in a data segment."""
+
+    def __init__(self):
+        self.heap = []
+        self.pending = set()
+        self.parents = {}
+        self.current = None
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, ea):
+        if ea in self.pending:
+            return
+        self.pending.add(ea)
+        heapq.heappush(self.heap, ea)
+        if ea not in self.parents:
+            self.parents[ea] = self.current
+
+    def difference_update(self, eas):
+        self.pending.difference_update(eas)
+        self.heap = sorted(self.pending)
+
+    def pop(self):
+        """Returns the lowest pending address."""
+        ea = heapq.heappop(self.heap)
+        self.pending.remove(ea)
+        return ea
+
+def recoverCfg(to_recover, outf, exports_are_apis=False, costs_path=None):
     global EMAP
+    resetFunctionCosts()
+    resetSegmentSnapshots()
+    resetFileType()
+    resetAddressClasses()
+    resetFixups()
+    resetJumpTables()
+    resetBlockLeaders()
+    resetStructLayouts()
+    resetElfThunks()
+    _reset_decode_cache()
+
     M = CFG_pb2.Module()
     M.module_name = idc.GetInputFile()
-    DEBUG("PROCESSING: {0}".format(M.module_name))
+    DEBUG("PROCESSING: {0}", M.module_name)
 
     our_entries = []
     entrypoints = idautils.Entries()
@@ -1963,12 +3340,17 @@ def recoverCfg(to_recover, outf, exports_are_apis=False):
     for index,ordinal,exp_ea, exp_name in entrypoints:
         exports[exp_name] = exp_ea
 
-    new_eas = set()
+    new_eas = FunctionWorklist()
 
+    PROFILE.begin("preprocess")
     preprocessBinary()
+    if isLinkedElf():
+        buildElfThunks()
 
+    PROFILE.begin("data_segments")
     processDataSegments(M, new_eas)
 
+    PROFILE.begin("entry_points")
     for name in to_recover:
 
         if name in exports:
@@ -1981,11 +3363,11 @@ def recoverCfg(to_recover, outf, exports_are_apis=False):
         fwdname = isFwdExport(name, ea)
 
         if fwdname is not None:
-            DEBUG("Skipping fwd export {0} : {1}".format(name, fwdname))
+            DEBUG("Skipping fwd export {0} : {1}", name, fwdname)
             continue
 
         if not isInternalCode(ea):
-            DEBUG("Export {0} at {1} does not point to code; skipping".format(name, hex(ea)))
+            DEBUG("Export {0} at {1} does not point to code; skipping", name, hex(ea))
             continue
 
         if name not in EMAP:
@@ -1993,10 +3375,11 @@ def recoverCfg(to_recover, outf, exports_are_apis=False):
 
     recovered_fns = 0
 
-    # process main entry points
+    # process main entry points, in address order
+    our_entries.sort(key=lambda entry: (entry[1], entry[0]))
     for fname, fea in our_entries:
 
-        DEBUG("Recovering: {0}".format(fname))
+        DEBUG("Recovering: {0}", fname)
 
         F = entryPointHandler(M, fea, fname, exports_are_apis)
 
@@ -2006,6 +3389,7 @@ def recoverCfg(to_recover, outf, exports_are_apis=False):
         recovered_fns += 1
 
     # process subfunctions
+    PROFILE.begin("subfunctions")
     new_eas.difference_update(RECOVERED_EAS)
 
     while len(new_eas) > 0:
@@ -2014,7 +3398,11 @@ def recoverCfg(to_recover, outf, exports_are_apis=False):
             raise Exception("Function EA not code: {0:x}".format(cur_ea))
 
         F = addFunction(M, cur_ea)
-        DEBUG("Recovering: {0}".format(hex(cur_ea)))
+        parent = new_eas.parents.get(cur_ea)
+        if parent is not None:
+            DEBUG("Recovering: {0} (found by {1})", hex(cur_ea), hex(parent))
+        else:
+            DEBUG("Recovering: {0}", hex(cur_ea))
         RECOVERED_EAS.add(cur_ea)
 
         recoverFunction(M, F, cur_ea, new_eas)
@@ -2022,17 +3410,24 @@ def recoverCfg(to_recover, outf, exports_are_apis=False):
         recovered_fns += 1
 
     if recovered_fns == 0:
-        DEBUG("COULD NOT RECOVER ANY FUNCTIONS")
+        PROFILE.end()
+        WARNING("COULD NOT RECOVER ANY FUNCTIONS")
         return
 
     mypath = path.dirname(__file__)
+    PROFILE.begin("externals")
     processExternals(M)
 
+    PROFILE.begin("serialize")
     outf.write(M.SerializeToString())
     outf.close()
+    PROFILE.end()
+    countRecovered(M)
 
-    DEBUG("Recovered {0} functions.".format(recovered_fns))
-    DEBUG("Saving to: {0}".format(outf.name))
+    INFO("Recovered {0} functions.", recovered_fns)
+    _report_decode_cache()
+    reportFunctionCosts(costs_path)
+    DEBUG("Saving to: {0}", outf.name)
 
 
 def isFwdExport(iname, ea):
@@ -2122,13 +3517,13 @@ def parseTypeString(typestr, ea):
 
 def getExportType(name, ep):
     try:
-        DEBUG("Processing export name: {} at: {:x}".format(name, ep))
+        DEBUG("Processing export name: {} at: {:x}", name, ep)
         args, conv, ret, sign = getFromEMAP(name)
     except KeyError as ke:
         tp = idc.GetType(ep);
         if tp is None or "__" not in tp:
             #raise Exception("Cannot determine type of function: {0} at: {1:x}".format(name, ep))
-            DEBUG("WARNING: Cannot determine type of function: {0} at: {1:x}".format(name, ep))
+            WARNING("WARNING: Cannot determine type of function: {0} at: {1:x}", name, ep)
             return (0, CFG_pb2.ExternalFunction.CalleeCleanup, "N")
 
         return parseTypeString(tp, ep)
@@ -2221,6 +3616,20 @@ def generateExportStub(cname, eps):
 
     cfile.close()
 
+def getShard(eps, shard):
+    """Returns the entry points in `eps` that belong to `shard`, which is
+    given as `I/N`. The entry points are sorted first so that every shard
+    agrees on how they are split up."""
+    index, count = [int(x) for x in shard.split("/")]
+    return sorted(set(eps))[index::count]
+
+def writeEmptyCfg(outf):
+    """Write a CFG with no functions, for a shard with no entry points."""
+    M = CFG_pb2.Module()
+    M.module_name = idc.GetInputFile()
+    outf.write(M.SerializeToString())
+    outf.close()
+
 def getAllExports() :
     entrypoints = idautils.Entries()
     to_recover = set()
@@ -2231,24 +3640,127 @@ def getAllExports() :
 
     return to_recover
 
+class DeferredMutations(object):
+    """Changes to the database that are queued up during a phase and then
+    applied in one batch, so that IDA's auto-analysis queue only has to be
+    drained once per phase instead of once per change."""
+
+    def __init__(self, phase):
+        self.phase = phase
+        self.code_xrefs = []
+        self.code = []
+        self.funcs = []
+        self.names = []
+
+    def apply(self):
+        """Apply the queued changes. Cross-references come first, then code,
+        then functions (which need the code), then names. Returns the
+        addresses that were newly marked as code."""
+        for frm, to, xref_type in self.code_xrefs:
+            idc.AddCodeXref(frm, to, xref_type)
+
+        made_code = []
+        for address in self.code:
+            if not idc.isCode(idc.GetFlags(address)):
+                DEBUG("Marking {:x} as code", address)
+                idc.MakeCode(address)
+                made_code.append(address)
+
+        if made_code:
+            waitForAnalysis()
+
+        if self.funcs:
+            for address in self.funcs:
+                if not idaapi.add_func(address, idc.BADADDR):
+                    DEBUG("Unable to convert code to function: {}", address)
+            waitForAnalysis()
+
+        for address, name in self.names:
+            idc.MakeName(address, name)
+            forgetAddressClass(address)
+
+        DEBUG("Phase {} issued {} mutations: {} code xrefs, {} code, {} functions, {} names",
+            self.phase, len(self.code_xrefs) + len(made_code) + len(self.funcs) + len(self.names),
+            len(self.code_xrefs), len(made_code), len(self.funcs), len(self.names))
+
+        return made_code
+
+# Drain IDA's auto-analysis queue. This can change any address, and so what
+# we know about every address is forgotten.
+def waitForAnalysis():
+    idaapi.autoWait()
+    resetAddressClasses()
+
+# The mutations of the current phase, or `None` if changes should be applied
+# immediately.
+_MUTATIONS = None
+
+def begin_mutation_phase(phase):
+    """Start deferring changes to the database until `end_mutation_phase`."""
+    global _MUTATIONS
+    if _MUTATIONS is not None:
+        WARNING("WARNING: Discarding unapplied mutations of phase {}",
+            _MUTATIONS.phase)
+    _MUTATIONS = DeferredMutations(phase)
+
+def end_mutation_phase():
+    """Apply the changes deferred since `begin_mutation_phase`. Returns the
+    addresses that were newly marked as code."""
+    global _MUTATIONS
+    mutations, _MUTATIONS = _MUTATIONS, None
+    return mutations.apply()
+
+# Add a user code cross-reference from `frm` to `to`.
+def add_code_xref(frm, to, xref_type):
+    addBlockLeaders(frm, [to])
+    if _MUTATIONS is not None:
+        _MUTATIONS.code_xrefs.append((frm, to, xref_type))
+    else:
+        idc.AddCodeXref(frm, to, xref_type)
+
 # Mark an address as containing code.
 def mark_as_code(address):
+    if _MUTATIONS is not None:
+        _MUTATIONS.code.append(address)
+        return
+
     if not idc.isCode(idc.GetFlags(address)):
-        DEBUG("Marking {:x} as code".format(address))
+        DEBUG("Marking {:x} as code", address)
         idc.MakeCode(address)
-        idaapi.autoWait()
+        forgetAddressClass(address)
+        waitForAnalysis()
+        markBlockLeadersStale()
 
 
-# Mark an address as being the beginning of a function.
+# Mark an address as being the beginning of a function. If changes are being
+# deferred then this always succeeds; failures are logged when applied.
 def try_mark_as_function(address):
+  if _MUTATIONS is not None:
+    _MUTATIONS.funcs.append(address)
+    return True
+
+  forgetAddressClass(address)
   if not idaapi.add_func(address, idc.BADADDR):
-    DEBUG("Unable to convert code to function: {}".format(address))
+    DEBUG("Unable to convert code to function: {}", address)
     return False
-  idaapi.autoWait()
+  waitForAnalysis()
+  markBlockLeadersStale()
   return True
 
 
-if __name__ == "__main__":
+# Give a name to an address.
+def set_name(address, name):
+    if _MUTATIONS is not None:
+        _MUTATIONS.names.append((address, name))
+    else:
+        idc.MakeName(address, name)
+        forgetAddressClass(address)
+
+
+def main(argv):
+    """Recover the CFG of the open database, as asked for by the command-line
+    arguments in `argv`. Returns the exit code to give IDA."""
+    global ADDRESS_SIZE, PIE_MODE, OS_NAME
 
     parser = argparse.ArgumentParser()
 
@@ -2256,6 +3768,16 @@ if __name__ == "__main__":
         default=sys.stderr,
         help="Log to a specific file. Default is stderr.")
 
+    parser.add_argument("--log-level", choices=list(LOG_LEVELS),
+        default="debug",
+        help="Only log messages at or above this level.")
+
+    parser.add_argument("--log-jsonl", type=str, default=None,
+        help="Also log messages as JSON lines to this file.")
+
+    parser.add_argument("--log-ring", type=int, default=LOG_RING_SIZE,
+        help="How many unlogged messages to keep, and dump if recovery fails.")
+
     parser.add_argument(
         '--arch',
         help='Name of the architecture. Valid names are x86, amd64.',
@@ -2297,46 +3819,69 @@ if __name__ == "__main__":
     parser.add_argument("--pie-mode", action="store_true", default=False,
         help="Assume all immediate values are constants (useful for ELFs built with -fPIE")
 
-    args = parser.parse_args(args=idc.ARGV[1:])
+    parser.add_argument("--record-trace", type=str, default=None,
+        help="Record every call into the IDA API to this file, so that the run can be replayed by apitrace.py without IDA.")
+
+    parser.add_argument("--api-profile", type=str, default=None,
+        help="Count and time calls into the IDA API, and write a summary to this file, and collapsed stacks to the file with .folded appended.")
 
-    if args.log_file != os.devnull:
-        _DEBUG = True
-        _DEBUG_FILE = args.log_file
-        DEBUG("Debugging is enabled.")
+    parser.add_argument("--function-costs", type=str, default=None,
+        help="Write the time and work spent recovering each function, including the number of calls into the IDA API, to this CSV file.")
+
+    parser.add_argument("--profile", type=str, default=None,
+        help="Write a JSON profile of the time and memory used by each phase to this file.")
+
+    parser.add_argument("--shard", type=str, default=None,
+        help="Only lift shard I/N of the entry points. Used by `mcsema-disass --jobs`.")
+
+    parser.add_argument("--save-database", type=str, default=None,
+        help="Save the database to this path once IDA's auto-analysis is done, before it is modified.")
+
+    args = parser.parse_args(args=argv)
+
+    # The profiler goes on top, so that it doesn't time the recording.
+    if args.record_trace:
+        enableApiRecorder()
+    if args.api_profile:
+        enableApiProfiler()
+    if args.function_costs:
+        enableApiCallCounter()
+
+    log_stream = None
+    if args.log_file.name != os.devnull:
+        log_stream = args.log_file
+    configureLogging(LOG_LEVELS[args.log_level], log_stream, args.log_jsonl,
+                     args.log_ring)
+    DEBUG("Debugging is enabled.")
 
     addr_size = {"x86": 32, "amd64": 64}.get(args.arch, 0)
     ADDRESS_SIZE = addr_size
     if addr_size > getAvailableBitness():
-        DEBUG("Arch {} address size is too big for IDA's available bitness {}! Did you mean to use idal64?".format(
-            args.arch, getAvailableBitness()))
-        idc.Exit(-1)
+        DEBUG("Arch {} address size is too big for IDA's available bitness {}! Did you mean to use idal64?",
+            args.arch, getAvailableBitness())
+        return -1
 
     if args.pie_mode:
         DEBUG("Using PIE mode.")
         PIE_MODE = True
 
-    EMAP = {}
-    EMAP_DATA = {}
-
     # Try to find the defs file or this OS
     OS_NAME = args.os
     os_defs_file = os.path.join(tools_disass_dir, "defs", "{}.txt".format(args.os))
     if os.path.isfile(os_defs_file):
         args.std_defs.insert(0, os_defs_file)
 
-    # Load in all defs files, include custom ones
-    for defsfile in args.std_defs:
-        with open(defsfile, "r") as df:
-            DEBUG("Loading Standard Definitions file: {0}".format(defsfile))
-            em_update, emd_update = parseDefsFile(df)
-            EMAP.update(em_update)
-            EMAP_DATA.update(emd_update)
+    # Definitions are read on demand, starting with the binary's imports once
+    # auto-analysis has found them.
+    loadDefsFiles(args.std_defs)
 
 
     eps = []
+    exports = None
     try:
         if args.exports_to_lift:
-            eps = args.exports_to_lift.readlines()
+            exports = args.exports_to_lift.readlines()
+            eps = list(exports)
         elif args.entrypoint is None:
             eps = getAllExports()
 
@@ -2344,31 +3889,44 @@ if __name__ == "__main__":
 
     except IOError as e:
         DEBUG("Could not open file of exports to lift. See source for details")
-        idc.Exit(-1)
+        return -1
 
     # for batch mode: ensure IDA is done processing
+    PROFILE.begin("auto_analysis")
     DEBUG("Using Batch mode.")
     analysis_flags = idc.GetShortPrm(idc.INF_START_AF)
     analysis_flags &= ~idc.AF_IMMOFF
     # turn off "automatically make offset" heuristic
     idc.SetShortPrm(idc.INF_START_AF, analysis_flags)
-    idaapi.autoWait()
+    waitForAnalysis()
+
+    # Snapshot the auto-analyzed database so that later runs on the same
+    # binary can skip straight to here.
+    if args.save_database:
+        DEBUG("Saving analyzed database to {}", args.save_database)
+        idc.SaveBase(args.save_database)
 
+    PROFILE.begin("load_defs")
+    loadImportedDefs()
+
+    PROFILE.begin("setup")
     DEBUG("Starting analysis")
     try:
         # Pre-define a bunch of symbol names and their addresses. Useful when reading
         # a core dump.
-        if args.syms:
-            for line in args.syms:
+        syms = args.syms.readlines() if args.syms else []
+        if syms:
+            begin_mutation_phase("symbols")
+            for line in syms:
                 name, ea_str = line.strip().split(" ")
                 ea = int(ea_str, base=16)
                 if not isInternalCode(ea):
                     mark_as_code(ea)
                 try_mark_as_function(ea)
-                idc.MakeName(ea, name)
+                set_name(ea, name)
+            end_mutation_phase()
 
         myname = idc.GetInputFile()
-        mypath = path.dirname(__file__)
         outpath = os.path.dirname(args.output.name)
 
         if args.entrypoint:
@@ -2376,65 +3934,73 @@ if __name__ == "__main__":
 
         assert len(eps) > 0, "Need to have at least one entry point to lift"
 
-        DEBUG("Will lift {0} exports".format(len(eps)))
+        if args.shard:
+            eps = getShard(eps, args.shard)
+            DEBUG("Shard {0} has {1} entry points", args.shard, len(eps))
+            if not eps:
+                writeEmptyCfg(args.output)
+                return 0
+
+        DEBUG("Will lift {0} exports", len(eps))
         if args.make_export_stubs:
             DEBUG("Generating export stubs...");
 
             outdef = path.join(outpath, "{0}.def".format(myname))
-            DEBUG("Output .DEF file: {0}".format(outdef))
+            DEBUG("Output .DEF file: {0}", outdef)
             generateDefFile(outdef, eps)
 
             outstub = path.join(outpath, "{0}_exportstub.c".format(myname))
-            DEBUG("Output export stub file: {0}".format(outstub))
+            DEBUG("Output export stub file: {0}", outstub)
             generateExportStub(outstub, eps)
 
             outbat = path.join(outpath, "{0}.bat".format(myname))
-            DEBUG("Output build .BAT: {0}".format(outbat))
+            DEBUG("Output build .BAT: {0}", outbat)
             generateBatFile(outbat, eps)
 
         outf = args.output
-        DEBUG("CFG Output File file: {0}".format(outf.name))
-
-        recoverCfg(eps, outf, args.exports_are_apis)
+        DEBUG("CFG Output File file: {0}", outf.name)
+
+        recoverCfg(eps, outf, args.exports_are_apis, args.function_costs)
+        if args.profile:
+            PROFILE.write(args.profile)
+        if args.api_profile:
+            API_PROFILER.write(args.api_profile)
+        if args.record_trace:
+            API_RECORDER.save(
+                args.record_trace, argv=list(argv), exports=exports,
+                syms=syms)
     except Exception as e:
-        DEBUG(str(e))
-        DEBUG(traceback.format_exc())
+        ERROR(str(e))
+        ERROR(traceback.format_exc())
+        dumpLogRing()
 
-    idc.Exit(0)
+    return 0
 
 
-def export_cfg(debug_stream, architecture, pie_mode, operating_system, standard_definition_file_list, export_list, function_list, symbol_definition_lines, output_file, generate_export_stubs, exports_are_apis):
-    global _DEBUG, _DEBUG_FILE, ADDRESS_SIZE, PIE_MODE, EMAP, EMAP_DATA, OS_NAME
+def export_cfg(debug_stream, architecture, pie_mode, operating_system, standard_definition_file_list, export_list, function_list, symbol_definition_lines, output_file, generate_export_stubs, exports_are_apis, log_level=LOG_DEBUG):
+    global ADDRESS_SIZE, PIE_MODE, EMAP, EMAP_DATA, OS_NAME
 
-    _DEBUG = True
-    _DEBUG_FILE = debug_stream
+    configureLogging(log_level, debug_stream)
 
     addr_size = {"x86": 32, "amd64": 64}.get(architecture, 0)
     ADDRESS_SIZE = addr_size
     if addr_size > getAvailableBitness():
-        DEBUG("Arch {} address size is too big for IDA's available bitness {}! Did you mean to use idaq64?".format(args.arch, getAvailableBitness()))
+        DEBUG("Arch {} address size is too big for IDA's available bitness {}! Did you mean to use idaq64?", architecture, getAvailableBitness())
         return False
 
     if pie_mode:
         DEBUG("Using PIE mode.")
         PIE_MODE = True
 
-    EMAP = {}
-    EMAP_DATA = {}
-
     # Try to find the defs file or this OS
     OS_NAME = operating_system
     os_defs_file = os.path.join(tools_disass_dir, "defs", "{}.txt".format(operating_system))
     if os.path.isfile(os_defs_file):
         standard_definition_file_list.insert(0, os_defs_file)
 
-    # Load in all defs files, include custom ones
-    for defsfile in standard_definition_file_list:
-        with open(defsfile, "r") as df:
-            DEBUG("Loading Standard Definitions file: {0}".format(defsfile))
-            em_update, emd_update = parseDefsFile(df)
-            EMAP.update(em_update)
-            EMAP_DATA.update(emd_update)
+    # Definitions are read on demand, starting with the binary's imports once
+    # auto-analysis has found them.
+    loadDefsFiles(standard_definition_file_list)
 
     eps = []
     try:
@@ -2455,20 +4021,24 @@ def export_cfg(debug_stream, architecture, pie_mode, operating_system, standard_
 
     # turn off "automatically make offset" heuristic
     idc.SetShortPrm(idc.INF_START_AF, analysis_flags)
-    idaapi.autoWait()
+    waitForAnalysis()
+
+    loadImportedDefs()
 
     DEBUG("Starting analysis")
     try:
         # Pre-define a bunch of symbol names and their addresses. Useful when reading
         # a core dump.
         if symbol_definition_lines:
+            begin_mutation_phase("symbols")
             for line in symbol_definition_lines:
                 name, ea_str = line.strip().split(" ")
                 ea = int(ea_str, base=16)
                 if not isInternalCode(ea):
                     mark_as_code(ea)
                 try_mark_as_function(ea)
-                idc.MakeName(ea, name)
+                set_name(ea, name)
+            end_mutation_phase()
 
         myname = idc.GetInputFile()
         mypath = path.dirname(__file__)
@@ -2481,29 +4051,34 @@ def export_cfg(debug_stream, architecture, pie_mode, operating_system, standard_
             DEBUG("Need to have at least one entry point to lift")
             return False
 
-        DEBUG("Will lift {0} exports".format(len(eps)))
+        DEBUG("Will lift {0} exports", len(eps))
         if generate_export_stubs:
             DEBUG("Generating export stubs...");
 
             outdef = path.join(outpath, "{0}.def".format(myname))
-            DEBUG("Output .DEF file: {0}".format(outdef))
+            DEBUG("Output .DEF file: {0}", outdef)
             generateDefFile(outdef, eps)
 
             outstub = path.join(outpath, "{0}_exportstub.c".format(myname))
-            DEBUG("Output export stub file: {0}".format(outstub))
+            DEBUG("Output export stub file: {0}", outstub)
             generateExportStub(outstub, eps)
 
             outbat = path.join(outpath, "{0}.bat".format(myname))
-            DEBUG("Output build .BAT: {0}".format(outbat))
+            DEBUG("Output build .BAT: {0}", outbat)
             generateBatFile(outbat, eps)
 
         outf = output_file
-        DEBUG("CFG Output File file: {0}".format(output_file))
+        DEBUG("CFG Output File file: {0}", output_file)
 
         recoverCfg(eps, outf, exports_are_apis)
         return True
 
     except Exception as e:
-        DEBUG(str(e))
-        DEBUG(traceback.format_exc())
+        ERROR(str(e))
+        ERROR(traceback.format_exc())
+        dumpLogRing()
         return False
+
+
+if __name__ == "__main__":
+    idc.Exit(main(idc.ARGV[1:]))
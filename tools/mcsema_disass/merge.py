@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# Copyright 2017 Peter Goodman (peter@trailofbits.com), all rights reserved.
+
+import argparse
+import os
+import sys
+
+# The build installs `CFG_pb2.py` next to `get_cfg.py`, in `ida/`.
+_IDA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ida")
+if _IDA_DIR not in sys.path:
+  sys.path.append(_IDA_DIR)
+
+import CFG_pb2
+from google.protobuf.message import DecodeError
+
+
+# How to identify each kind of repeated entry in a `CFG_pb2.Module`. Entries
+# with the same key that come from different CFGs describe the same thing.
+_MODULE_FIELDS = (
+  ("internal_funcs", lambda f: f.entry_address),
+  ("internal_data", lambda d: d.base_address),
+  ("external_funcs", lambda f: f.symbol_name),
+  ("external_data", lambda d: d.symbol_name),
+  ("entries", lambda e: e.entry_name),
+  ("offset_tables", lambda t: t.start_addr),
+)
+
+
+def load_cfg(path):
+  """Parse the CFG file at `path` into a `CFG_pb2.Module`."""
+  M = CFG_pb2.Module()
+  with open(path, "rb") as f:
+    M.ParseFromString(f.read())
+  return M
+
+
+def merge_modules(modules):
+  """Merge the `CFG_pb2.Module`s in `modules` into one module. Entries are
+  deduplicated by their key (see `_MODULE_FIELDS`), and sorted by it, so the
+  result doesn't depend on the order in which the entries were recovered.
+  If two modules disagree about an entry, then the one from the earliest
+  module wins. Returns the merged module and a list of the keys of the
+  entries that disagreed."""
+  merged = CFG_pb2.Module()
+  conflicts = []
+
+  for M in modules:
+    if not merged.module_name:
+      merged.module_name = M.module_name
+    elif M.module_name and M.module_name != merged.module_name:
+      raise ValueError("Cannot merge CFGs of different modules: {} and {}".format(
+          merged.module_name, M.module_name))
+
+  for field, get_key in _MODULE_FIELDS:
+    seen = {}
+    for M in modules:
+      for entry in getattr(M, field):
+        key = get_key(entry)
+        if key not in seen:
+          seen[key] = entry
+        elif seen[key] != entry:
+          conflicts.append((field, key))
+
+    dest = getattr(merged, field)
+    for key in sorted(seen):
+      dest.add().CopyFrom(seen[key])
+
+  return merged, conflicts
+
+
+def canonical_module(M):
+  """Returns a copy of `M` with its entries deduplicated and sorted, as would
+  be produced by `merge_modules`."""
+  canonical, _ = merge_modules([M])
+  return canonical
+
+
+def merge_cfg_files(input_paths, output_path):
+  """Merge the CFG files at `input_paths` into one CFG at `output_path`.
+  Returns the list of conflicting entries (see `merge_modules`)."""
+  merged, conflicts = merge_modules([load_cfg(path) for path in input_paths])
+  with open(output_path, "wb") as f:
+    f.write(merged.SerializeToString())
+  return conflicts
+
+
+def cfg_files_equivalent(path_a, path_b):
+  """Returns `True` if the CFGs at `path_a` and `path_b` describe the same
+  module, regardless of the order in which their entries are listed."""
+  return canonical_module(load_cfg(path_a)) == canonical_module(load_cfg(path_b))
+
+
+def main():
+  arg_parser = argparse.ArgumentParser(
+      description="Merge CFGs recovered from the same binary, or check that two CFGs are equivalent.")
+
+  arg_parser.add_argument(
+      '--compare',
+      action='store_true',
+      default=False,
+      help="Exit with 0 if the two input CFGs are equivalent, and 1 otherwise.")
+
+  arg_parser.add_argument(
+      '--output',
+      help="Where to write the merged CFG.")
+
+  arg_parser.add_argument(
+      'inputs',
+      nargs='+',
+      help="CFG files to merge or compare.")
+
+  args = arg_parser.parse_args()
+
+  if args.compare and len(args.inputs) != 2:
+    arg_parser.error("--compare needs exactly two CFGs.")
+
+  if not args.compare and not args.output:
+    arg_parser.error("--output is required when merging.")
+
+  try:
+    if args.compare:
+      if cfg_files_equivalent(*args.inputs):
+        return 0
+      sys.stderr.write("CFGs {} and {} differ.\n".format(*args.inputs))
+      return 1
+
+    conflicts = merge_cfg_files(args.inputs, args.output)
+  except (IOError, DecodeError) as e:
+    sys.stderr.write("Could not read CFG: {}\n".format(e))
+    return 1
+
+  for field, key in conflicts:
+    sys.stderr.write("Conflicting {} entry {}; kept the first.\n".format(field, key))
+  return 0
+
+
+if "__main__" == __name__:
+  exit(main())
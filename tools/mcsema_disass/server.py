@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+# Copyright 2017 Peter Goodman (peter@trailofbits.com), all rights reserved.
+
+import argparse
+import importlib
+import json
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+try:
+  import queue
+except ImportError:
+  import Queue as queue
+
+try:
+  import socketserver
+except ImportError:
+  import SocketServer as socketserver
+
+
+# How long a client waits before resubmitting a job that the server turned
+# away because its queue was full, in seconds.
+BUSY_RETRY_INTERVAL = 1.0
+
+
+def _send(sock_file, message):
+  sock_file.write((json.dumps(message) + "\n").encode("utf-8"))
+  sock_file.flush()
+
+
+def _receive(sock_file):
+  line = sock_file.readline()
+  if not line:
+    raise IOError("Connection closed")
+  return json.loads(line.decode("utf-8"))
+
+
+class Job(object):
+  """A disassembly submitted by a client. `args` and `command_args` are as
+  passed to `disassemble` in `__main__.py`. Once the job is done, `stderr`
+  holds what it, and the disassembler that it ran, wrote to stderr."""
+
+  def __init__(self, args, command_args):
+    self.args = args
+    self.command_args = command_args
+    self.returncode = None
+    self.stderr = ""
+    self.done = threading.Event()
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+  """Handles one client connection. The client sends one job as a line of
+  JSON, and gets back a `queued` or `busy` message, then a `done` message
+  with the exit code and diagnostics once the job has been run."""
+
+  def handle(self):
+    server = self.server.disass_server
+    try:
+      request = _receive(self.rfile)
+    except (IOError, ValueError):
+      return
+
+    job = Job(argparse.Namespace(**request["args"]), request["command_args"])
+    position = server.submit(job)
+    if position is None:
+      _send(self.wfile, {"status": "busy"})
+      return
+
+    _send(self.wfile, {"status": "queued", "position": position})
+    job.done.wait()
+    _send(self.wfile, {"status": "done", "returncode": job.returncode,
+                       "stderr": job.stderr})
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+  daemon_threads = True
+
+
+class DisassemblyServer(object):
+  """Runs disassembly jobs received over a UNIX socket on a fixed number of
+  worker threads. At most `max_queue` jobs wait for a worker; past that,
+  clients are told that the server is busy, and should retry later.
+
+  Each job is run in a fork of the server, by calling `run_job(args,
+  command_args)`, which returns the exit code of the job. By default, this
+  is `disassemble` from `__main__.py`. The fork starts with the driver
+  already loaded. The disassembler is still a new process per job, and so
+  it still loads IDA, `get_cfg.py` and `CFG_pb2` every time."""
+
+  def __init__(self, socket_path, workers=1, max_queue=16, run_job=None):
+    if run_job is None:
+      from mcsema_disass.__main__ import disassemble
+      run_job = disassemble
+
+    self.socket_path = socket_path
+    self.run_job = run_job
+    self.queue = queue.Queue(max_queue)
+    self.lock = threading.Lock()
+    self.stats = {"completed": 0, "failed": 0, "rejected": 0}
+
+    self.workers = []
+    for _ in range(workers):
+      worker = threading.Thread(target=self._work)
+      worker.daemon = True
+      worker.start()
+      self.workers.append(worker)
+
+    if os.path.exists(socket_path):
+      os.unlink(socket_path)
+    self.server = _UnixServer(socket_path, _RequestHandler)
+    self.server.disass_server = self
+
+  def submit(self, job):
+    """Queue up `job`. Returns the number of jobs queued ahead of it, or
+    `None` if the queue is full."""
+    try:
+      self.queue.put_nowait(job)
+    except queue.Full:
+      with self.lock:
+        self.stats["rejected"] += 1
+      return None
+    return self.queue.qsize() - 1
+
+  def _run(self, job):
+    """Run `job` in a fork of the server, with its stderr, and so that of
+    the disassembler, going to `job.stderr`. Returns the exit code."""
+    with tempfile.TemporaryFile() as log:
+      sys.stdout.flush()
+      sys.stderr.flush()
+      pid = os.fork()
+      if 0 == pid:
+        returncode = 1
+        try:
+          os.dup2(log.fileno(), sys.stderr.fileno())
+          returncode = self.run_job(job.args, job.command_args)
+        except BaseException:
+          sys.stderr.write(traceback.format_exc())
+        finally:
+          sys.stderr.flush()
+          os._exit(min(returncode or 0, 255))
+
+      _, status = os.waitpid(pid, 0)
+      log.seek(0)
+      job.stderr = log.read().decode("utf-8", "replace")
+
+    if os.WIFEXITED(status):
+      return os.WEXITSTATUS(status)
+    return 1
+
+  def _work(self):
+    while True:
+      job = self.queue.get()
+      try:
+        job.returncode = self._run(job)
+      except Exception:
+        sys.stderr.write(traceback.format_exc())
+        job.returncode = 1
+
+      with self.lock:
+        self.stats["completed"] += 1
+        if job.returncode:
+          self.stats["failed"] += 1
+      job.done.set()
+      self.queue.task_done()
+
+  def serve_forever(self):
+    self.server.serve_forever()
+
+  def shutdown(self):
+    self.server.shutdown()
+    self.server.server_close()
+    if os.path.exists(self.socket_path):
+      os.unlink(self.socket_path)
+
+
+def submit(socket_path, args, command_args):
+  """Run a disassembly on the server listening at `socket_path`, waiting
+  while the server is busy. Returns the exit code of the job."""
+  request = {"args": vars(args), "command_args": command_args}
+  said_busy = False
+  while True:
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      sock.connect(socket_path)
+    except socket.error as e:
+      sock.close()
+      sys.stderr.write(
+          "Could not connect to mcsema-disass-server at {}: {}. Is it "
+          "running?\n".format(socket_path, e))
+      return 1
+    sock_file = sock.makefile("rwb")
+    try:
+      _send(sock_file, request)
+      response = _receive(sock_file)
+      if "busy" == response["status"]:
+        if not said_busy:
+          sys.stderr.write("Server is busy; waiting to submit job.\n")
+          said_busy = True
+        time.sleep(BUSY_RETRY_INTERVAL)
+        continue
+
+      response = _receive(sock_file)
+      sys.stderr.write(response.get("stderr", ""))
+      return response["returncode"]
+    finally:
+      sock_file.close()
+      sock.close()
+
+
+def main():
+  arg_parser = argparse.ArgumentParser(
+      description="Serve mcsema-disass jobs submitted with `mcsema-disass --server`. "
+                  "The server loads the driver and compiles the standard "
+                  "definitions once, and bounds the number of jobs running "
+                  "and waiting. Only the driver's startup is saved: IDA, "
+                  "get_cfg.py and CFG_pb2 are still loaded once per job.")
+
+  arg_parser.add_argument(
+      '--socket',
+      required=True,
+      help="Path of the UNIX socket on which to listen for jobs.")
+
+  arg_parser.add_argument(
+      '--workers',
+      type=int,
+      default=1,
+      help="Number of jobs to run at once.")
+
+  arg_parser.add_argument(
+      '--max-queue',
+      type=int,
+      default=16,
+      help="Number of jobs that can wait for a worker before clients are told to back off.")
+
+  args = arg_parser.parse_args()
+
+  socket_path = os.path.abspath(args.socket)
+
+  # Load the driver, and everything that it uses, once up front. Each job
+  # runs in a fork of the server, and so starts with these loaded.
+  disass_dir = os.path.dirname(os.path.abspath(__file__))
+  sys.path.append(os.path.dirname(disass_dir))
+  sys.path.append(disass_dir)
+  os.chdir(disass_dir)
+  importlib.import_module("cache")
+  importlib.import_module("ida.disass")
+  try:
+    importlib.import_module("merge")
+  except ImportError as e:
+    # `merge` needs `protobuf`. Unsharded jobs don't use it.
+    sys.stderr.write("Jobs using --jobs will fail: {}\n".format(e))
+
+  # The disassembler runs in a new process per job, and so can't share what
+  # the server has loaded. Compile the standard definitions now, so that no
+  # job has to, and each one only maps the compiled databases.
+  defsdb = importlib.import_module("ida.defsdb")
+  defs_dir = os.path.join(disass_dir, "defs")
+  for name in sorted(os.listdir(defs_dir)):
+    if not name.endswith(".txt"):
+      continue
+    try:
+      defsdb.open_defs(os.path.join(defs_dir, name)).close()
+    except (defsdb.DefsError, EnvironmentError, ValueError) as e:
+      sys.stderr.write("Could not compile {}: {}\n".format(name, e))
+
+  server = DisassemblyServer(socket_path, args.workers, args.max_queue)
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.shutdown()
+
+  return 0
+
+
+if "__main__" == __name__:
+  exit(main())
@@ -2,9 +2,27 @@
 # Copyright 2017 Peter Goodman (peter@trailofbits.com), all rights reserved.
 
 import os
+import sys
 os.chdir(os.path.dirname(os.path.abspath(__file__)))
 
 from setuptools import setup, find_packages
+from setuptools.command.build_py import build_py
+
+DEFS_FILES = ["linux.txt", "windows.txt"]
+
+
+class BuildPyWithDefs(build_py):
+  """Also compile the definitions files into indexed databases, so that
+  `get_cfg.py` doesn't need to compile them on its first run."""
+
+  def run(self):
+    build_py.run(self)
+    sys.path.insert(0, os.path.join("mcsema_disass", "ida"))
+    import defsdb
+    defs_dir = os.path.join(self.build_lib, "mcsema_disass", "defs")
+    for name in DEFS_FILES:
+      defsdb.compile_defs(os.path.join(defs_dir, name))
+
 
 setup(name="mcsema-disass",
       description="Binary program disassembler for McSema.",
@@ -15,8 +33,11 @@ setup(name="mcsema-disass",
       license='BSD 3-clause "New" or "Revised License"',
       packages=['mcsema_disass', 'mcsema_disass.ida', 'mcsema_disass.defs'],
       package_data={
-        "mcsema_disass.defs": ["linux.txt", "windows.txt"]},
+        "mcsema_disass.defs": DEFS_FILES},
+      cmdclass={"build_py": BuildPyWithDefs},
       entry_points={
         "console_scripts": [
-          "mcsema-disass = mcsema_disass.__main__:main"
+          "mcsema-disass = mcsema_disass.__main__:main",
+          "mcsema-disass-batch = mcsema_disass.batch:main",
+          "mcsema-disass-server = mcsema_disass.server:main"
         ]})